@@ -0,0 +1,67 @@
+# output files written atomically and the manifest with the fingerprint of every file, used to skip the files whose inputs didn't change
+
+import contextlib
+import json
+import os
+import uuid
+from pathlib import Path
+
+# name of the manifest, saved in the output folder beside the files it describes
+manifest_name = "manifest.json"
+
+@contextlib.contextmanager
+def atomic_path(path):
+    """
+    Context manager used to write a file atomically: it yields a temporary path in the same folder (with the same extension, so the format
+    can be chosen from it, e.g. by savefig) that replaces path only when the block ends without errors
+    Runs sharing the output folder never see a half-written file, and the temporary file is removed if the writing fails
+    """
+    path = Path(path)
+    temp_path = path.with_name(f".tmp-{path.stem}-{os.getpid()}-{uuid.uuid4().hex[:8]}{path.suffix}")
+    try:
+        yield temp_path
+        os.replace(temp_path, path)
+    finally:
+        temp_path.unlink(missing_ok=True)
+
+def write_text(path, text):
+    """
+    Function used to write a text file atomically (see atomic_path)
+    """
+    with atomic_path(path) as temp_path:
+        Path(temp_path).write_text(text, encoding="utf-8")
+
+def read_manifest(output_dir):
+    """
+    Function used to read the manifest of the output folder
+    Returns a dict name of the artifact -> {"fingerprint": ..., "files": [...]}, empty if there is no manifest (or it can't be read)
+    """
+    path = Path(output_dir) / manifest_name
+    try:
+        return json.loads(path.read_text(encoding="utf-8"))
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+def is_current(manifest, output_dir, name, key):
+    """
+    Function used to check if an artifact is up to date: same fingerprint of the last time it was written and all its files still exist
+    """
+    entry = manifest.get(name)
+    return entry is not None and entry.get("fingerprint") == key and all((Path(output_dir) / file).exists() for file in entry.get("files", []))
+
+def update_manifest(output_dir, entries):
+    """
+    Function used to save the fingerprints of the artifacts just written, entries is a dict name -> {"fingerprint": ..., "files": [...]}
+    The manifest is read again just before the update, so the entries written by other runs in the meantime are kept, and it's replaced atomically
+    The files of the previous entry of an artifact that are not among its new files (e.g. the last pages of a table that got shorter) are deleted
+    Returns the updated manifest
+    """
+    if not entries:
+        return read_manifest(output_dir)
+    manifest = read_manifest(output_dir)
+    for name, entry in entries.items():
+        for file in set(manifest.get(name, {}).get("files", [])) - set(entry["files"]):
+            (Path(output_dir) / file).unlink(missing_ok=True)
+    manifest.update(entries)
+    write_text(Path(output_dir) / manifest_name, json.dumps(manifest, indent=1, sort_keys=True))
+    return manifest
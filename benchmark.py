@@ -0,0 +1,237 @@
+# benchmark of the loaders, of the functions and of the stages of the analysis on synthetic data, with baselines saved in json
+
+import argparse
+import importlib.metadata
+import json
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from cache import set_cache
+from synthetic_data import generate
+from utility import (load_data_ISTAT_Deaths, load_data_EUROSTAT_Deaths, load_data_ISTAT_Pop_long, load_data_Eurostat_Pop_long, load_standard_pop,
+                     load_data_EUROSTAT_geo, year_partition, population_view)
+from eurostat_bulk import load_bulk
+from compute_rates import ratio
+from standardize_rates import expected_deaths_year, final, dataframe_final
+from sensitivity_analysis import sensitivity, final_sens, dataframe_final_sens
+from kitagawa_deco import initial_kit, final_kit, dataframe_final_kit
+from plots import graph_1, graph_2, graph_3, graph_4, table_1, table_2, table_3
+from pipeline import STAGES, stage_order, run_pipeline
+
+# sizes of the synthetic data used by the benchmarks
+scales = {"small": {"years": list(range(2020, 2023)), "n_geos": 2, "n_causes": 1},
+          "medium": {"years": list(range(1994, 2024)), "n_geos": 10, "n_causes": 5},
+          "large": {"years": list(range(1994, 2024)), "n_geos": 40, "n_causes": 20}}
+
+def measure(function, *args, repeat=3, **kwargs):
+    """
+    Function used to measure a function: the time is the best of repeat runs, the peak memory is measured in one more run with tracemalloc
+    (tracemalloc slows down the function, so it's never used for the times)
+    Returns a dict with seconds and peak_bytes
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(*args, **kwargs)
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        function(*args, **kwargs)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {"seconds": min(times), "peak_bytes": peak}
+
+def _strata_inputs(data_dir, years, sexes):
+    """
+    Function used to load the synthetic files and to divide them in the dfs of every (year, sex) stratum used by the functions of the analysis
+    Returns a dict with deaths and population of Italy and Europe for every stratum and the standard population
+    """
+    deaths_it = {sex: year_partition(load_data_ISTAT_Deaths(data_dir / f"Deaths_Italy_{sex}.csv")) for sex in sexes}
+    deaths_eu = {sex: year_partition(load_data_EUROSTAT_Deaths(data_dir / f"Deaths_Europe_{sex}.csv")) for sex in sexes}
+    pop_it = pd.concat([load_data_ISTAT_Pop_long(data_dir / f"Italian_Population_{year}.csv") for year in years], ignore_index=True)
+    pop_eu = load_data_Eurostat_Pop_long(data_dir / "European_Population.csv")
+    strata = [(year, sex) for sex in sexes for year in years]
+    return {"strata": strata, "df_Pop_Std": load_standard_pop(data_dir / "ESP2013.csv"),
+            "deaths_it": {(year, sex): deaths_it[sex][year] for year, sex in strata},
+            "deaths_eu": {(year, sex): deaths_eu[sex][year] for year, sex in strata},
+            "pop_it": {(year, sex): population_view(pop_it, year, sex) for year, sex in strata},
+            "pop_eu": {(year, sex): population_view(pop_eu, year, sex) for year, sex in strata}}
+
+def benchmark_loaders(data_dir, years, repeat=3):
+    """
+    Function used to measure every loader on the synthetic files (the cache of the loaders must be disabled)
+    Returns a dict name -> measure
+    """
+    return {"load_data_ISTAT_Deaths": measure(load_data_ISTAT_Deaths, data_dir / "Deaths_Italy_Tot.csv", repeat=repeat),
+            "load_data_EUROSTAT_Deaths": measure(load_data_EUROSTAT_Deaths, data_dir / "Deaths_Europe_Tot.csv", repeat=repeat),
+            "load_data_ISTAT_Pop_long": measure(load_data_ISTAT_Pop_long, data_dir / f"Italian_Population_{years[0]}.csv", repeat=repeat),
+            "load_data_Eurostat_Pop_long": measure(load_data_Eurostat_Pop_long, data_dir / "European_Population.csv", repeat=repeat),
+            "load_standard_pop": measure(load_standard_pop, data_dir / "ESP2013.csv", repeat=repeat),
+            "load_data_EUROSTAT_geo": measure(load_data_EUROSTAT_geo, data_dir / "Deaths_Europe_Countries.csv", repeat=repeat),
+            "load_bulk": measure(load_bulk, data_dir / "Deaths_Bulk.csv", repeat=repeat)}
+
+def benchmark_functions(data_dir, output_dir, years, sexes=("Tot", "M", "F"), repeat=3, dpi=300):
+    """
+    Function used to measure the functions of the analysis, each one called on every (year, sex) stratum, and the graphs and tables
+    Returns a dict name -> measure
+    """
+    inputs = _strata_inputs(data_dir, years, sexes)
+    strata, df_Pop_Std = inputs["strata"], inputs["df_Pop_Std"]
+    # results of each step, used as inputs of the next one
+    rates_it = {stratum: ratio(inputs["deaths_it"][stratum], inputs["pop_it"][stratum]) for stratum in strata}
+    rates_eu = {stratum: ratio(inputs["deaths_eu"][stratum], inputs["pop_eu"][stratum]) for stratum in strata}
+    df_std = {stratum: expected_deaths_year(rates_it[stratum], rates_eu[stratum], df_Pop_Std) for stratum in strata}
+    df_sens = {stratum: sensitivity(inputs["deaths_it"][stratum], inputs["pop_it"][stratum], inputs["deaths_eu"][stratum], inputs["pop_eu"][stratum], df_Pop_Std)
+               for stratum in strata}
+    df_kit = {stratum: initial_kit(rates_it[stratum], rates_eu[stratum]) for stratum in strata}
+    df_final = dataframe_final([final(df_std[stratum], *stratum) for stratum in strata])
+    df_final_sens = dataframe_final_sens([final_sens(df_sens[stratum], *stratum) for stratum in strata])
+    df_final_kit = dataframe_final_kit([final_kit(df_kit[stratum], *stratum) for stratum in strata])
+    df_age = [df_std[year, "Tot"] for year in years]
+    results = {
+        "ratio": measure(lambda: [ratio(inputs["deaths_it"][stratum], inputs["pop_it"][stratum]) for stratum in strata], repeat=repeat),
+        "expected_deaths_year": measure(lambda: [expected_deaths_year(rates_it[stratum], rates_eu[stratum], df_Pop_Std) for stratum in strata], repeat=repeat),
+        "final": measure(lambda: [final(df_std[stratum], *stratum) for stratum in strata], repeat=repeat),
+        "sensitivity": measure(lambda: [sensitivity(inputs["deaths_it"][stratum], inputs["pop_it"][stratum], inputs["deaths_eu"][stratum],
+                                                    inputs["pop_eu"][stratum], df_Pop_Std) for stratum in strata], repeat=repeat),
+        "final_sens": measure(lambda: [final_sens(df_sens[stratum], *stratum) for stratum in strata], repeat=repeat),
+        "initial_kit": measure(lambda: [initial_kit(rates_it[stratum], rates_eu[stratum]) for stratum in strata], repeat=repeat),
+        "final_kit": measure(lambda: [final_kit(df_kit[stratum], *stratum) for stratum in strata], repeat=repeat)}
+    # the tables round the dfs in place, so they get a copy
+    output_dir = Path(output_dir)
+    results.update({
+        "graph_1": measure(graph_1, df_final, save_path=output_dir / "graph_1.png", dpi=dpi, repeat=repeat),
+        "graph_2": measure(graph_2, df_final, save_path=output_dir / "graph_2.png", dpi=dpi, repeat=repeat),
+        "graph_3": measure(graph_3, *df_age, save_path=output_dir / "graph_3.png", dpi=dpi, repeat=repeat),
+        "graph_4": measure(graph_4, df_final, save_path=output_dir / "graph_4.png", dpi=dpi, repeat=repeat),
+        "table_1": measure(lambda: table_1(df_final.copy(), save_path=output_dir / "table_1.png", csv_path=output_dir / "table_1.csv", dpi=dpi), repeat=repeat),
+        "table_2": measure(lambda: table_2(df_final_sens.copy(), df_final.copy(), save_path=output_dir / "table_2.png", csv_path=output_dir / "table_2.csv", dpi=dpi),
+                           repeat=repeat),
+        "table_3": measure(lambda: table_3(df_final_kit.copy(), save_path=output_dir / "table_3.png", csv_path=output_dir / "table_3.csv", dpi=dpi), repeat=repeat)})
+    return results
+
+def benchmark_stages(data_dir, output_dir, repeat=3, dpi=300, jobs=None):
+    """
+    Function used to measure every stage of pipeline.py
+    Every run of a stage gets an empty state folder and an empty output folder (without the manifest of the graphs and tables, see artifacts.py),
+    so the stage is measured without the results and the files saved by previous runs
+    Returns a dict "stage_<name>" -> measure
+    """
+    output_dir = Path(output_dir)
+    context = run_pipeline(data_dir, output_dir / "pipeline", dpi=dpi, jobs=jobs)
+    def cold_run(name):
+        run_dir = Path(tempfile.mkdtemp(dir=output_dir))
+        (run_dir / ".state").mkdir()
+        stage_context = dict(context, output_dir=run_dir, state_dir=run_dir / ".state")
+        return STAGES[name]["run"](stage_context)
+    return {f"stage_{name}": measure(cold_run, name, repeat=repeat) for name in stage_order(STAGES)}
+
+# modules measured by benchmark_cold_start, with the heavy modules that importing them must not load
+cold_start_modules = {"rate_cube": ["scipy", "matplotlib"], "standardize_rates": ["scipy", "matplotlib"], "pipeline": ["scipy", "matplotlib"], "plots": ["matplotlib"]}
+
+def _cold_import(module, forbidden):
+    """
+    Function used to import a module in a new python process, checking that the forbidden modules are not loaded
+    """
+    code = (f"import sys; sys.path.insert(0, {str(Path(__file__).parent)!r}); import {module}; "
+            f"loaded = [name for name in {forbidden!r} if name in sys.modules]; assert not loaded, f'{module} imports {{loaded}}'")
+    subprocess.run([sys.executable, "-c", code], check=True, capture_output=True)
+
+def benchmark_cold_start(repeat=3):
+    """
+    Function used to measure the cold start of short runs: the time to import each module of cold_start_modules in a new python process
+    matplotlib and scipy are imported only when a graph is drawn or a CI is calculated, the run fails if importing the module loads them
+    Returns a dict "import_<module>" -> measure (the peak memory is the one of this process, not of the new one)
+    """
+    return {f"import_{module}": measure(_cold_import, module, forbidden, repeat=repeat) for module, forbidden in cold_start_modules.items()}
+
+def _version(package):
+    """
+    Function used to read the version of an installed package without importing it
+    """
+    try:
+        return importlib.metadata.version(package)
+    except importlib.metadata.PackageNotFoundError:
+        return None
+
+def _commit():
+    """
+    Function used to find the commit of the code, to compare baselines across commits
+    Returns the hash of the commit or None outside of a git repository
+    """
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=Path(__file__).parent, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmarks(scale="small", repeat=3, dpi=300, jobs=None):
+    """
+    Function used to generate the synthetic data of a scale (see scales) in a temporary folder and to run all the benchmarks on them
+    The cache of the loaders is disabled, so every loader reads its file
+    Returns a dict with the settings, the versions, the commit and the results (name -> seconds and peak_bytes)
+    """
+    settings = scales[scale]
+    set_cache(None)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        data_dir, output_dir = Path(temp_dir) / "data", Path(temp_dir) / "output"
+        output_dir.mkdir()
+        generate(data_dir, **settings)
+        results = benchmark_cold_start(repeat=repeat)
+        results.update(benchmark_loaders(data_dir, settings["years"], repeat=repeat))
+        results.update(benchmark_functions(data_dir, output_dir, settings["years"], repeat=repeat, dpi=dpi))
+        results.update(benchmark_stages(data_dir, output_dir, repeat=repeat, dpi=dpi, jobs=jobs))
+    return {"scale": scale, "settings": settings, "repeat": repeat, "dpi": dpi, "commit": _commit(), "python": platform.python_version(),
+            "numpy": np.__version__, "pandas": pd.__version__, "matplotlib": _version("matplotlib"), "results": results}
+
+def compare(report, baseline, tolerance=0.25, min_seconds=0.005):
+    """
+    Function used to compare a report of run_benchmarks with a baseline (another report)
+    A benchmark is a regression when its time or its peak memory is more than (1 + tolerance) times the one of the baseline;
+    differences in time smaller than min_seconds are ignored, since they are mostly noise
+    Returns a df with the times, the peak memories, their ratios and the Regression column
+    """
+    rows = []
+    for name, result in report["results"].items():
+        if name not in baseline["results"]:
+            continue
+        base = baseline["results"][name]
+        time_ratio = result["seconds"]/base["seconds"] if base["seconds"] > 0 else np.nan
+        memory_ratio = result["peak_bytes"]/base["peak_bytes"] if base["peak_bytes"] > 0 else np.nan
+        rows.append({"Benchmark": name, "Seconds": result["seconds"], "Baseline Seconds": base["seconds"], "Time Ratio": time_ratio,
+                     "Peak MB": result["peak_bytes"]/1024**2, "Baseline Peak MB": base["peak_bytes"]/1024**2, "Memory Ratio": memory_ratio,
+                     "Regression": bool((time_ratio > 1 + tolerance and result["seconds"] - base["seconds"] > min_seconds) or memory_ratio > 1 + tolerance)})
+    return pd.DataFrame(rows)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of the analysis on synthetic data")
+    parser.add_argument("--scale", choices=list(scales), default="small")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--dpi", type=int, default=300)
+    parser.add_argument("--jobs", type=int, default=None, help="processes used by the render stage")
+    parser.add_argument("--output", type=Path, default=None, help="json file where the report is saved (default benchmarks/<scale>.json)")
+    parser.add_argument("--baseline", type=Path, default=None, help="json report to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    args = parser.parse_args()
+    report = run_benchmarks(args.scale, repeat=args.repeat, dpi=args.dpi, jobs=args.jobs)
+    output = Path("benchmarks") / f"{args.scale}.json" if args.output is None else args.output
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(report, indent=2))
+    print(f"Report saved in {output}")
+    df_results = pd.DataFrame(report["results"]).T
+    df_results["peak_MB"] = df_results["peak_bytes"]/1024**2
+    print(df_results[["seconds", "peak_MB"]].round(4).to_string())
+    if args.baseline is not None:
+        df_compare = compare(report, json.loads(args.baseline.read_text()), tolerance=args.tolerance)
+        print(df_compare.round(3).to_string(index=False))
+        if df_compare["Regression"].any():
+            raise SystemExit(f"Regressions found: {', '.join(df_compare.loc[df_compare['Regression'], 'Benchmark'])}")
+
+if __name__ == "__main__":
+    main()
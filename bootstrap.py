@@ -0,0 +1,97 @@
+# parametric (Poisson) bootstrap of crude and standardized rates, rate ratios and Kitagawa effects on the rate cube
+
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from rate_cube import crude_rates
+from kitagawa_deco import kitagawa_effects
+
+# statistics calculated for every replicate
+bootstrap_statistics = ["Crude", "Std", "Rate Ratio", "Effect of Age Structure", "Effect of Rates"]
+# replicates drawn with the same seed: the seeds are spawned for every block, so the results don't depend on the size of the chunks
+seed_block = 1000
+
+def cube_statistics(deaths, population, pop_std, r):
+    """
+    Function used to calculate, with vectorized reductions on the age axis, the statistics of every stratum
+    deaths can have leading replicate axes before [geo, year, sex, age], population is indexed by [geo, year, sex, age], r is the position of the reference geo
+    Returns a dict with Crude and Std rates (per 100k), Rate Ratio (Std of the geo / Std of the reference) and the Kitagawa effects against the reference
+    """
+    weights = pop_std/pop_std.sum()
+    rates = crude_rates(deaths, population)
+    std = np.nan_to_num(rates) @ weights
+    crude = crude_rates(deaths.sum(axis=-1), population.sum(axis=-1))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rate_ratio = std/std[..., r:r+1, :, :]
+    structure_effect, rates_effect = kitagawa_effects(population, rates, population[r], rates[..., r:r+1, :, :, :])
+    return {"Crude": crude, "Std": std, "Rate Ratio": rate_ratio, "Effect of Age Structure": structure_effect, "Effect of Rates": rates_effect}
+
+def _simulate_chunk(job):
+    """
+    Function used to simulate a chunk of replicates (it runs in a worker process when bootstrap_cube uses a pool)
+    job is a tuple (blocks, piece, deaths, population, pop_std, r), blocks is a list of (seed sequence, number of replicates):
+    the replicates of every block are drawn from its own generator, piece replicates at a time (the draws are the same of a single call)
+    Returns a dict statistic -> array with the replicates on the first axis
+    """
+    blocks, piece, deaths, population, pop_std, r = job
+    pieces = []
+    for seed, size in blocks:
+        rng = np.random.default_rng(seed)
+        for start in range(0, size, piece):
+            simulated = rng.poisson(deaths, size=(min(piece, size - start),) + deaths.shape).astype(np.float64)
+            pieces.append(cube_statistics(simulated, population, pop_std, r))
+    return {statistic: np.concatenate([statistics[statistic] for statistics in pieces]) for statistic in bootstrap_statistics}
+
+def bootstrap_cube(cube, ref, n_replicates=10000, alpha=0.05, seed=None, max_bytes=256 * 1024**2, processes=1):
+    """
+    Function used to calculate percentile intervals for every stratum of the cube (see rate_cube.rate_cube) with a parametric bootstrap:
+    the deaths of every (geo, year, sex, age) cell are drawn from a Poisson distribution with mean equal to the observed deaths (the populations are fixed)
+    and crude rates, standardized rates, rate ratios and Kitagawa effects against the reference geo ref are calculated for all the replicates at once
+    The replicates are simulated in chunks, so that the arrays of a chunk use about max_bytes (processes=1 runs the chunks in this process)
+    Every block of seed_block replicates has its own seed spawned from seed and every chunk is made of whole blocks (a block larger than
+    max_bytes is drawn in pieces from its generator), so with the same seed the results are the same with any max_bytes and any number of processes
+    Returns a dict with the labels Geo, Year, Sex, Reference and Replicates, and for every statistic the observed value and the lower and upper
+    percentiles (e.g. "Std", "Std lower", "Std upper"), as arrays indexed by [geo, year, sex] (alpha can be a list, adding a last axis to lower and upper)
+    """
+    if ref not in cube["Geo"]:
+        raise ValueError(f"Reference not found among the geos: {ref}")
+    if n_replicates < 1:
+        raise ValueError("At least one replicate is needed")
+    r = cube["Geo"].index(ref)
+    deaths, population, pop_std = cube["Deaths"], cube["Total"], cube["Pop_Std"]
+    # about 8 arrays of the size of the cube are used for every replicate (draws, rates and the temporaries of the Kitagawa decomposition)
+    chunk_size = int(max(1, min(n_replicates, max_bytes // (deaths.size * 8 * 8))))
+    sizes = [min(seed_block, n_replicates - start) for start in range(0, n_replicates, seed_block)]
+    blocks = list(zip(np.random.SeedSequence(seed).spawn(len(sizes)), sizes))
+    blocks_per_chunk = max(1, chunk_size // seed_block)
+    jobs = [(blocks[start:start + blocks_per_chunk], min(chunk_size, seed_block), deaths, population, pop_std, r)
+            for start in range(0, len(blocks), blocks_per_chunk)]
+    if processes == 1 or len(jobs) == 1:
+        chunks = [_simulate_chunk(job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            chunks = list(executor.map(_simulate_chunk, jobs))
+    observed = cube_statistics(deaths, population, pop_std, r)
+    alpha = np.asarray(alpha, dtype=np.float64)
+    results = {"Geo": cube["Geo"], "Year": cube["Year"], "Sex": cube["Sex"], "Reference": ref, "Replicates": n_replicates}
+    for statistic in bootstrap_statistics:
+        replicates = np.concatenate([chunk[statistic] for chunk in chunks])
+        # percentiles on the replicate axis, moved to the last axis when alpha is a list
+        lower = np.moveaxis(np.nanpercentile(replicates, 100*alpha/2, axis=0), 0, -1) if alpha.ndim else np.nanpercentile(replicates, 100*alpha/2, axis=0)
+        upper = np.moveaxis(np.nanpercentile(replicates, 100*(1 - alpha/2), axis=0), 0, -1) if alpha.ndim else np.nanpercentile(replicates, 100*(1 - alpha/2), axis=0)
+        results[statistic], results[f"{statistic} lower"], results[f"{statistic} upper"] = observed[statistic], lower, upper
+    return results
+
+def dataframe_bootstrap(results, alpha=0.05):
+    """
+    From the results of bootstrap_cube (with a single alpha) it returns a df with Geo, Year, Sex, Reference and, for every statistic,
+    the observed value with the percentile interval (e.g. "Std", "95% PI lower Std", "95% PI upper Std")
+    """
+    level = f"{round(100*(1 - alpha))}%"
+    index = pd.MultiIndex.from_product([results["Geo"], results["Year"], results["Sex"]], names=["Geo", "Year", "Sex"])
+    data = {"Reference": results["Reference"]}
+    for statistic in bootstrap_statistics:
+        data[statistic] = results[statistic].ravel()
+        data[f"{level} PI lower {statistic}"] = results[f"{statistic} lower"].ravel()
+        data[f"{level} PI upper {statistic}"] = results[f"{statistic} upper"].ravel()
+    return pd.DataFrame(data, index=index).reset_index()
@@ -0,0 +1,134 @@
+# content-hashed columnar cache for the dfs returned by the loaders
+
+import functools
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+# version of the format used to store the dfs, change it to invalidate all the cache entries
+CACHE_FORMAT = "2"
+# settings of the cache, the cache is disabled until set_cache is called
+cache_settings = {"dir": None, "max_bytes": 512 * 1024**2}
+
+def set_cache(cache_dir, max_bytes=512 * 1024**2):
+    """
+    Function used to enable the cache (or to disable it if cache_dir is None)
+    max_bytes is the maximum size of the cache, the least recently used entries are removed when it's exceeded
+    """
+    cache_settings["dir"] = None if cache_dir is None else Path(cache_dir)
+    cache_settings["max_bytes"] = max_bytes
+    if cache_settings["dir"] is not None:
+        cache_settings["dir"].mkdir(parents=True, exist_ok=True)
+
+def file_hash(path, block_size=1024**2):
+    """
+    Function used to calculate the sha256 of the content of a file, reading it in blocks
+    Returns the hexadecimal digest
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def write_frame(df, entry):
+    """
+    Function used to save a df as one .npy file for each column, plus a json file with names and types of the columns (and the categories of categorical columns)
+    The entry is written in a temporary folder and then renamed, so a half-written entry is never read
+    """
+    entry = Path(entry)
+    temp_dir = Path(tempfile.mkdtemp(dir=entry.parent, prefix=".tmp-"))
+    columns = []
+    for i, column in enumerate(df.columns):
+        if isinstance(df[column].dtype, pd.CategoricalDtype):
+            # categorical columns (e.g. Age) are saved as codes, with categories and order in the json file
+            dtype = df[column].dtype
+            np.save(temp_dir / f"{i}.npy", df[column].cat.codes.to_numpy(), allow_pickle=False)
+            columns.append({"name": column, "kind": "category", "categories": [str(category) for category in dtype.categories], "ordered": bool(dtype.ordered)})
+            continue
+        values = df[column].to_numpy()
+        kind = "str" if values.dtype == object else "num"
+        if kind == "str":
+            values = values.astype(str)
+        np.save(temp_dir / f"{i}.npy", values, allow_pickle=False)
+        columns.append({"name": column, "kind": kind})
+    (temp_dir / "columns.json").write_text(json.dumps(columns))
+    try:
+        os.rename(temp_dir, entry)
+    except OSError:
+        # another process has already written the same entry
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+def read_frame(entry):
+    """
+    Function used to read a df saved by write_frame
+    Numeric columns are memory-mapped (copy-on-write), so they are not read until they are used
+    Returns a df
+    """
+    entry = Path(entry)
+    columns = json.loads((entry / "columns.json").read_text())
+    data = {}
+    for i, column in enumerate(columns):
+        values = np.load(entry / f"{i}.npy", mmap_mode="c", allow_pickle=False)
+        if column["kind"] == "category":
+            data[column["name"]] = pd.Categorical.from_codes(np.asarray(values), categories=column["categories"], ordered=column["ordered"])
+        else:
+            data[column["name"]] = values.astype(object) if column["kind"] == "str" else values
+    return pd.DataFrame(data, copy=False)
+
+def _entry_size(entry):
+    """
+    Function used to calculate the size in bytes of a cache entry
+    """
+    return sum(file.stat().st_size for file in entry.iterdir())
+
+def evict(cache_dir=None, max_bytes=None):
+    """
+    Function used to keep the cache under max_bytes, removing the least recently used entries first
+    Returns the number of entries removed
+    """
+    cache_dir = cache_settings["dir"] if cache_dir is None else Path(cache_dir)
+    max_bytes = cache_settings["max_bytes"] if max_bytes is None else max_bytes
+    entries = [entry for entry in cache_dir.iterdir() if entry.is_dir() and not entry.name.startswith(".tmp-")]
+    entries = sorted(entries, key=lambda entry: entry.stat().st_mtime)
+    sizes = {entry: _entry_size(entry) for entry in entries}
+    total = sum(sizes.values())
+    removed = 0
+    for entry in entries:
+        if total <= max_bytes:
+            break
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= sizes[entry]
+        removed += 1
+    return removed
+
+def cached_loader(version):
+    """
+    Decorator used to cache the df returned by a loader whose first argument is the path of the input file
+    The key of the cache is the hash of the content of the file, the name and the version of the loader and the other arguments:
+    change the version every time the loader changes the df it returns
+    When the cache is disabled (see set_cache) the loader is called directly
+    """
+    def decorator(loader):
+        @functools.wraps(loader)
+        def wrapper(path, *args, **kwargs):
+            cache_dir = cache_settings["dir"]
+            if cache_dir is None:
+                return loader(path, *args, **kwargs)
+            key = "|".join([CACHE_FORMAT, loader.__module__, loader.__qualname__, version, file_hash(path), repr(args), repr(sorted(kwargs.items()))])
+            entry = cache_dir / hashlib.sha256(key.encode("utf-8")).hexdigest()
+            if entry.is_dir():
+                # updating the time of the entry, used by evict to find the least recently used entries
+                os.utime(entry)
+                return read_frame(entry)
+            df = loader(path, *args, **kwargs)
+            write_frame(df, entry)
+            evict(cache_dir)
+            return df
+        return wrapper
+    return decorator
@@ -0,0 +1,186 @@
+# functions to stream the Eurostat bulk files (SDMX-CSV and TSV, also gzip-compressed) with filters and age aggregation
+
+import gzip
+import re
+import pandas as pd
+from utility import age_groups, to_age_category, compact_counts
+from cache import cached_loader
+
+# dict used to change the sex codes of the Eurostat bulk files
+sex_conversion_bulk = {"T": "Tot", "M": "M", "F": "F"}
+# dict used to rename the dimensions of the Eurostat bulk files
+dimension_conversion_bulk = {"geo": "Geo", "sex": "Sex", "icd10": "Cause", "TIME_PERIOD": "Year"}
+# columns of the SDMX-CSV files that are not dimensions (attributes of the dataflow and of the observations)
+attributes_sdmx = ["DATAFLOW", "LAST UPDATE", "STRUCTURE", "STRUCTURE_ID", "STRUCTURE_NAME", "ACTION", "OBS_VALUE", "OBS_FLAG", "CONF_STATUS"]
+
+def age_code_to_class(code):
+    """
+    Function used to convert an Eurostat age code into the age classes of the analysis (0, 1-4, 5-9, ..., 90-94, 95+)
+    Single ages (Y_LT1, Y1, ..., Y99, Y_OPEN) are assigned to their class, 5-year classes (Y1-4, ..., Y90-94, Y_GE95) are kept
+    Returns a tuple (age class, kind) where kind is "single" or "class"; (None, None) for codes that are not used (TOTAL, UNK, Y_GE85, ...)
+    """
+    if code == "Y_LT1":
+        return "0", None
+    if code == "Y_OPEN":
+        return "95+", "single"
+    if code == "Y_GE95":
+        return "95+", "class"
+    single = re.fullmatch(r"Y(\d+)", code)
+    if single:
+        age = int(single.group(1))
+        if age < 5:
+            return "1-4", "single"
+        if age >= 95:
+            return "95+", "single"
+        start = age - age % 5
+        return f"{start}-{start+4}", "single"
+    interval = re.fullmatch(r"Y(\d+)-(\d+)", code)
+    if interval and f"{interval.group(1)}-{interval.group(2)}" in age_groups:
+        return f"{interval.group(1)}-{interval.group(2)}", "class"
+    return None, None
+
+def _aggregate_chunk(df, keys, value, age_cache, kinds):
+    """
+    Function used to aggregate a filtered chunk in the age classes of the analysis
+    age_cache is a dict with the conversions already done, kinds collects the kind of age codes found
+    Returns the chunk summed by keys and Age
+    """
+    for code in pd.unique(df["age"]):
+        if code not in age_cache:
+            age_cache[code] = age_code_to_class(code)
+    ages = df["age"].map(lambda code: age_cache[code][0])
+    kinds.update(age_cache[code][1] for code in pd.unique(df["age"]) if age_cache[code][1] is not None)
+    df = df.assign(Age=ages).loc[ages.notna()]
+    return df.groupby(keys + ["Age"], sort=False)[value].sum(min_count=1)
+
+def _finalize(partials, keys, value):
+    """
+    Function used to merge the partial sums of the chunks and to rename dimensions and codes
+    Returns a long df with Geo, Year, Sex, (Cause), Age and value
+    """
+    if not partials:
+        raise ValueError("No rows left after filtering the bulk file")
+    df = pd.concat(partials).groupby(level=list(range(len(keys)+1)), sort=False).sum(min_count=1).reset_index()
+    df = df.rename(columns=dimension_conversion_bulk)
+    df["Year"] = pd.to_numeric(df["Year"])
+    if "Sex" in df.columns:
+        df["Sex"] = df["Sex"].replace(sex_conversion_bulk)
+    df["Age"] = to_age_category(df["Age"])
+    df[value] = compact_counts(df[value])
+    columns = [column for column in ["Geo", "Year", "Sex", "Cause"] if column in df.columns]
+    return df[columns + ["Age", value]].sort_values(columns + ["Age"]).reset_index(drop=True)
+
+def _check_kinds(kinds):
+    """
+    Function used to avoid double counting when a file has both single ages and 5-year age classes
+    """
+    if len(kinds) > 1:
+        raise ValueError("The bulk file has both single ages and age classes, filter the age codes before loading it")
+
+def _collect_codes(df, dimensions, codes):
+    """
+    Function used to collect, chunk by chunk, the codes of the dimensions that are summed (all the dimensions that are not keys or age)
+    codes is a dict dimension -> set of the codes found
+    """
+    for dimension in dimensions:
+        codes.setdefault(dimension, set()).update(pd.unique(df[dimension]))
+
+def _check_codes(codes):
+    """
+    Function used to avoid double counting when a dimension that is summed has more than one code left after filtering
+    (e.g. resid with TOT_IN, RES_IN and NRSD_IN, where TOT_IN is the sum of the others)
+    """
+    for dimension, found in codes.items():
+        if len(found) > 1:
+            raise ValueError(f"The bulk file has more than one code of {dimension} ({', '.join(sorted(map(str, found)))}), filter {dimension} before loading it")
+
+def read_bulk_sdmx(path, value="Deaths", filters=None, years=None, chunksize=200000):
+    """
+    Function used to stream an Eurostat bulk file in SDMX-CSV format (e.g. hlth_cd_aro or demo_pjan, also .csv.gz)
+    The file is read in chunks: rows are filtered while reading and single ages are aggregated in the age classes of the analysis,
+    so the memory used depends on the size of the chunks and of the result, not on the size of the file
+    filters is a dict with the Eurostat codes to keep for each dimension, e.g. {"geo": ["IT", "EU27_2020"], "icd10": ["C"], "resid": ["TOT_IN"]}
+    years is a list with the years to keep (all the years if None)
+    The other dimensions (e.g. freq, unit and resid) are summed, so they must have a single code after filtering (a ValueError is raised otherwise)
+    Returns a long df with Geo, Year, Sex, (Cause), Age and value (value is the name given to OBS_VALUE)
+    """
+    filters = {} if filters is None else {dimension: set(codes) for dimension, codes in filters.items()}
+    header = pd.read_csv(path, nrows=0).columns
+    keys = [dimension for dimension in ["geo", "TIME_PERIOD", "sex", "icd10"] if dimension in header]
+    for column in ["geo", "sex", "age", "TIME_PERIOD", "OBS_VALUE"] + list(filters):
+        if column not in header:
+            raise ValueError(f"Required column missing: {column}")
+    others = [column for column in header if column not in keys + ["age"] + attributes_sdmx]
+    usecols = list(dict.fromkeys(keys + ["age", "OBS_VALUE"] + list(filters) + others))
+    age_cache, kinds, summed, partials = {}, set(), {}, []
+    for chunk in pd.read_csv(path, usecols=usecols, chunksize=chunksize, dtype={column: str for column in usecols if column != "OBS_VALUE"}):
+        mask = pd.Series(True, index=chunk.index)
+        for dimension, codes in filters.items():
+            mask &= chunk[dimension].isin(codes)
+        if years is not None:
+            mask &= pd.to_numeric(chunk["TIME_PERIOD"]).isin(years)
+        chunk = chunk.loc[mask].rename(columns={"OBS_VALUE": value})
+        if chunk.empty:
+            continue
+        chunk[value] = pd.to_numeric(chunk[value], errors="coerce")
+        _collect_codes(chunk, others, summed)
+        partials.append(_aggregate_chunk(chunk, keys, value, age_cache, kinds))
+    _check_kinds(kinds)
+    _check_codes(summed)
+    return _finalize(partials, keys, value)
+
+def _open_text(path):
+    """
+    Function used to open a text file, also if gzip-compressed
+    """
+    return gzip.open(path, "rt", encoding="utf-8") if str(path).endswith(".gz") else open(path, encoding="utf-8")
+
+def read_bulk_tsv(path, value="Deaths", filters=None, years=None, chunksize=200000):
+    """
+    Function used to stream an Eurostat bulk file in TSV format (e.g. hlth_cd_aro.tsv.gz)
+    The first column has the dimensions separated by "," (e.g. freq,unit,sex,age,icd10,resid,geo\\TIME_PERIOD) and there is one column for each year,
+    with values like "123", "123 p" or ":" for missing values
+    Only the columns of the selected years are read, rows are filtered and aggregated chunk by chunk like in read_bulk_sdmx
+    (also here the dimensions that are not keys or age must have a single code after filtering)
+    Returns a long df with Geo, Year, Sex, (Cause), Age and value
+    """
+    filters = {} if filters is None else {dimension: set(codes) for dimension, codes in filters.items()}
+    with _open_text(path) as file:
+        header = file.readline().rstrip("\n").split("\t")
+    dimensions = header[0].split("\\")[0].split(",")
+    for column in ["geo", "sex", "age"] + list(filters):
+        if column not in dimensions:
+            raise ValueError(f"Required column missing: {column}")
+    year_columns = {column: int(column.strip()) for column in header[1:] if years is None or int(column.strip()) in years}
+    keys = ["geo", "TIME_PERIOD"] + [dimension for dimension in ["sex", "icd10"] if dimension in dimensions]
+    others = [dimension for dimension in dimensions if dimension not in keys + ["age"]]
+    age_cache, kinds, summed, partials = {}, set(), {}, []
+    for chunk in pd.read_csv(path, sep="\t", usecols=[header[0]] + list(year_columns), chunksize=chunksize, dtype=str):
+        chunk_dimensions = chunk[header[0]].str.split(",", expand=True)
+        chunk_dimensions.columns = dimensions
+        mask = pd.Series(True, index=chunk.index)
+        for dimension, codes in filters.items():
+            mask &= chunk_dimensions[dimension].isin(codes)
+        if not mask.any():
+            continue
+        _collect_codes(chunk_dimensions.loc[mask], others, summed)
+        chunk = pd.concat([chunk_dimensions.loc[mask], chunk.loc[mask, list(year_columns)]], axis=1)
+        chunk = chunk.melt(id_vars=dimensions, value_vars=list(year_columns), var_name="TIME_PERIOD", value_name=value)
+        chunk["TIME_PERIOD"] = chunk["TIME_PERIOD"].map(year_columns)
+        # removing the flags (e.g. "123 p") and the missing values (":")
+        chunk[value] = pd.to_numeric(chunk[value].str.strip().str.split(" ").str[0], errors="coerce")
+        partials.append(_aggregate_chunk(chunk, keys, value, age_cache, kinds))
+    _check_kinds(kinds)
+    _check_codes(summed)
+    return _finalize(partials, keys, value)
+
+@cached_loader("3")
+def load_bulk(path, value="Deaths", filters=None, years=None, chunksize=200000):
+    """
+    Function used to read an Eurostat bulk file choosing the reader from the extension (.tsv, .tsv.gz, .csv, .csv.gz)
+    Returns a long df with Geo, Year, Sex, (Cause), Age and value, that can be used with rate_cube.rate_cube
+    """
+    name = str(path).lower()
+    if name.endswith(".tsv") or name.endswith(".tsv.gz"):
+        return read_bulk_tsv(path, value=value, filters=filters, years=years, chunksize=chunksize)
+    return read_bulk_sdmx(path, value=value, filters=filters, years=years, chunksize=chunksize)
@@ -0,0 +1,155 @@
+# instrumentation of the stages of the analysis: wall and cpu time, peak memory and rows, saved in a run report
+
+import contextlib
+import cProfile
+import csv
+import functools
+import json
+import platform
+import time
+import tracemalloc
+from pathlib import Path
+import pandas as pd
+try:
+    import resource
+except ImportError:
+    # not available on Windows, the peak RSS is not recorded
+    resource = None
+
+# settings and records of the instrumentation, it's disabled until enable_instrumentation is called
+instrument_settings = {"enabled": False, "trace_memory": False, "profile": None, "profile_dir": None, "records": [], "stack": []}
+# columns of the csv report
+report_columns = ["name", "kind", "parent", "wall_seconds", "cpu_seconds", "peak_traced_bytes", "rss_increase_bytes", "process_peak_rss_bytes", "rows", "info"]
+
+def enable_instrumentation(trace_memory=False, profile=None, profile_dir=None):
+    """
+    Function used to enable the instrumentation and to clear the records of previous runs
+    trace_memory enables tracemalloc, to record the peak of the memory allocated by python in each block (it slows down the code)
+    profile is the name of a block (e.g. "render") to run under cProfile, the stats are saved in profile_dir/profile_<name>.prof
+    """
+    instrument_settings.update({"enabled": True, "trace_memory": trace_memory, "profile": profile,
+                                "profile_dir": None if profile_dir is None else Path(profile_dir), "records": [], "stack": []})
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+def disable_instrumentation():
+    """
+    Function used to disable the instrumentation (the records are kept until the next enable_instrumentation)
+    """
+    if instrument_settings["trace_memory"] and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    instrument_settings.update({"enabled": False, "trace_memory": False, "profile": None, "stack": []})
+
+def _peak_rss():
+    """
+    Function used to read the peak resident memory of the process
+    Returns the bytes (None if the resource module is not available)
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    return peak if platform.system() == "Darwin" else peak*1024
+
+def count_rows(result):
+    """
+    Function used to count the rows of the result of a block: the rows of a df, the sum of the rows of the dfs in a dict or list,
+    otherwise the length of the dict or list
+    Returns the number of rows (None for other objects)
+    """
+    if isinstance(result, pd.DataFrame):
+        return len(result)
+    if isinstance(result, (dict, list, tuple)):
+        values = result.values() if isinstance(result, dict) else result
+        dfs = [value for value in values if isinstance(value, pd.DataFrame)]
+        return sum(len(df) for df in dfs) if dfs else len(result)
+    return None
+
+@contextlib.contextmanager
+def _record(name, kind, info):
+    """
+    Function used to measure a block and to append its record to instrument_settings["records"]
+    The peak of tracemalloc is reset at the start of every block: the peak of a nested block is passed to the block that contains it
+    The peak RSS can't be reset, so every block records how much the block raised it (rss_increase_bytes, 0 if the block stayed below
+    the peak reached before it) and the peak of the whole process so far (process_peak_rss_bytes)
+    """
+    stack = instrument_settings["stack"]
+    parent = stack[-1]["name"] if stack else None
+    entry = {"name": name, "kind": kind, "parent": parent, "rows": None, "info": dict(info), "peak": 0}
+    tracing = instrument_settings["trace_memory"] and tracemalloc.is_tracing()
+    if tracing:
+        if stack:
+            stack[-1]["peak"] = max(stack[-1]["peak"], tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+    profiler = cProfile.Profile() if instrument_settings["profile"] == name else None
+    stack.append(entry)
+    rss = _peak_rss()
+    wall, cpu = time.perf_counter(), time.process_time()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield entry
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+        stack.pop()
+        peak = None
+        if tracing:
+            peak = max(entry["peak"], tracemalloc.get_traced_memory()[1])
+            if stack:
+                stack[-1]["peak"] = max(stack[-1]["peak"], peak)
+            tracemalloc.reset_peak()
+        if profiler is not None:
+            profile_dir = instrument_settings["profile_dir"] or Path(".")
+            profile_dir.mkdir(parents=True, exist_ok=True)
+            profiler.dump_stats(profile_dir / f"profile_{name}.prof")
+        process_rss = _peak_rss()
+        instrument_settings["records"].append({"name": name, "kind": kind, "parent": parent, "wall_seconds": wall, "cpu_seconds": cpu,
+                                               "peak_traced_bytes": peak,
+                                               "rss_increase_bytes": None if rss is None else process_rss - rss, "process_peak_rss_bytes": process_rss, "rows": entry["rows"], "info": entry["info"]})
+
+def block(name, kind="block", **info):
+    """
+    Context manager used to measure a block of code: wall time, cpu time, peak memory (tracemalloc and RSS) and rows
+    The rows can be set inside the block with entry["rows"] = ..., info are other values saved in the record (e.g. the stratum)
+    When the instrumentation is disabled it returns a context manager that does nothing, so it can be left in the code
+    """
+    if not instrument_settings["enabled"]:
+        return contextlib.nullcontext({"rows": None, "info": {}})
+    return _record(name, kind, info)
+
+def instrumented(name=None, kind="block"):
+    """
+    Decorator used to measure every call of a function like block, the rows are counted on the result (see count_rows)
+    When the instrumentation is disabled the function is called directly
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not instrument_settings["enabled"]:
+                return function(*args, **kwargs)
+            with _record(name or function.__name__, kind, {}) as entry:
+                result = function(*args, **kwargs)
+                entry["rows"] = count_rows(result)
+            return result
+        return wrapper
+    return decorator
+
+def write_report(output_dir, name="run_report"):
+    """
+    Function used to save the records in output_dir/<name>.json (with the settings of the run) and output_dir/<name>.csv
+    Returns the paths of the json and csv files
+    """
+    output_dir = Path(output_dir)
+    records = instrument_settings["records"]
+    json_path, csv_path = output_dir / f"{name}.json", output_dir / f"{name}.csv"
+    report = {"created": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": platform.python_version(),
+              "trace_memory": instrument_settings["trace_memory"], "profile": instrument_settings["profile"], "records": records}
+    json_path.write_text(json.dumps(report, indent=2, default=str))
+    with open(csv_path, "w", newline="") as file:
+        writer = csv.DictWriter(file, fieldnames=report_columns)
+        writer.writeheader()
+        for record in records:
+            writer.writerow({**record, "info": json.dumps(record["info"], default=str)})
+    return json_path, csv_path
@@ -1,19 +1,20 @@
 # functions for the kitagawa decomposition
 
 import pandas as pd
+import numpy as np
+from rate_cube import align_on_age
+from standardize_rates import suffix_it, suffix_eu
 
 def initial_kit(df, df1):
     """
-    This function starts the Kitagawa decomposition by merging two dataframes: the firt one with the Italian deaths, population and rates; 
+    This function starts the Kitagawa decomposition by combining two dataframes: the firt one with the Italian deaths, population and rates; 
     the second one with the same informations but for Europe.
+    The dataframes are aligned by position on the Age column (see rate_cube.align_on_age).
     Both dataframes must have the following columns: "Age", "Deaths", "Total" and "Death_Rate_per_100k".
     Returns a df with both the "Structure_Effect" and "Rates_Effect" in each age class.
     """
-    df_initial_kit = pd.merge(df, df1, how="inner", on="Age")
-    assert set(df["Age"]) == set(df1["Age"]), "Ages don't coincides between the dataframes (df and df1)"
-    df_initial_kit = df_initial_kit.rename(columns={"Deaths_x": "Deaths_It", "Total_x": "Total_It", "Death_Rate_per_100k_x": "Death_Rate_per_100k_It", 
-                                          "Deaths_y": "Deaths_EU", "Total_y": "Total_EU", "Death_Rate_per_100k_y": "Death_Rate_per_100k_EU"
-                                          })
+    df_initial_kit = pd.concat([df.reset_index(drop=True).rename(columns=suffix_it), 
+                                align_on_age(df, df1.drop(columns=["Year"], errors="ignore")).rename(columns=suffix_eu)], axis=1)
     df_initial_kit[["Deaths_It", "Deaths_EU", "Total_It", "Total_EU", "Death_Rate_per_100k_It", "Death_Rate_per_100k_EU"]]=df_initial_kit[["Deaths_It", "Deaths_EU", "Total_It", "Total_EU", "Death_Rate_per_100k_It", "Death_Rate_per_100k_EU"]].apply(pd.to_numeric)
     for column in ["Total_It", "Total_EU", "Death_Rate_per_100k_It", "Death_Rate_per_100k_EU"]:
       if column not in df_initial_kit:
@@ -32,6 +33,25 @@ def initial_kit(df, df1):
     df_initial_kit["Rates_Effect"] = (df_initial_kit["Death_Rate_per_100k_It"] - df_initial_kit["Death_Rate_per_100k_EU"]) * ((df_initial_kit["Prop_It"]+df_initial_kit["Prop_EU"])/2)
     return df_initial_kit
 
+def kitagawa_effects(population, rates, population_ref, rates_ref):
+    """
+    Vectorized version of initial_kit + final_kit: it works on arrays with the age classes on the last axis (e.g. [geo, year, sex, age]).
+    population and population_ref are the population counts, rates and rates_ref the age-specific rates per 100k.
+    The reference arrays are broadcasted, so a single reference can be compared with many populations at once.
+    Returns 2 arrays (per 100k, without the age axis): the effect of the age structure and the effect of the rates.
+    """
+    population = np.asarray(population, dtype=np.float64)
+    population_ref = np.asarray(population_ref, dtype=np.float64)
+    if (population.sum(axis=-1) <= 0).any() or (population_ref.sum(axis=-1) <= 0).any():
+      raise ValueError("Population sum is negative or zero, cannot calculate proportion")
+    prop = population/population.sum(axis=-1, keepdims=True)
+    prop_ref = population_ref/population_ref.sum(axis=-1, keepdims=True)
+    rates = np.asarray(rates, dtype=np.float64)/100000
+    rates_ref = np.asarray(rates_ref, dtype=np.float64)/100000
+    structure_effect = np.nansum((prop - prop_ref) * ((rates + rates_ref)/2), axis=-1)*100000
+    rates_effect = np.nansum((rates - rates_ref) * ((prop + prop_ref)/2), axis=-1)*100000
+    return structure_effect, rates_effect
+
 def final_kit(df, year, sex):
     """
     Starting from the df of the previous function, it returns a dictionary with the "Year", "Sex", "Effect of Age Structure", "Effect of Rates" and "Difference".
@@ -43,9 +63,34 @@ def final_kit(df, year, sex):
     difference = structure_effect + rates_effect
     return {"Year": year, "Sex": sex, "Effect of Age Structure": structure_effect, "Effect of Rates": rates_effect, "Difference": difference}
 
+def kitagawa_all_pairs(cube):
+    """
+    All-pairs Kitagawa decomposition: every geo of the cube (see rate_cube.rate_cube) is compared with every other geo.
+    It uses broadcasting over the age axis (kitagawa_effects), without merging dataframes.
+    Returns a dictionary with the labels Geo, Year and Sex and the arrays Structure_Effect and Rates_Effect indexed by [year, sex, geo, reference] (per 100k).
+    """
+    # moving the geo axis next to the age axis: [year, sex, geo, age]
+    population = np.moveaxis(cube["Total"], 0, -2)
+    rates = np.moveaxis(cube["Death_Rate_per_100k"], 0, -2)
+    structure_effect, rates_effect = kitagawa_effects(population[..., :, None, :], rates[..., :, None, :], 
+                                                      population[..., None, :, :], rates[..., None, :, :])
+    return {"Geo": list(cube["Geo"]), "Year": list(cube["Year"]), "Sex": list(cube["Sex"]), 
+            "Structure_Effect": structure_effect, "Rates_Effect": rates_effect}
+
 def dataframe_final_kit(results):
     """
-    It creates a df from the results of the previous function.
+    It creates a df from the results of the previous functions.
+    results can be a list of dictionaries returned by final_kit or the dictionary returned by kitagawa_all_pairs:
+    in the second case the matrices are flattened in a df with Year, Sex, Geo, Reference, "Effect of Age Structure", "Effect of Rates" and "Difference"
+    (the comparisons of a geo with itself are dropped).
     """
+    if isinstance(results, dict):
+        index = pd.MultiIndex.from_product([results["Year"], results["Sex"], results["Geo"], results["Geo"]], names=["Year", "Sex", "Geo", "Reference"])
+        structure_effect = results["Structure_Effect"].ravel()
+        rates_effect = results["Rates_Effect"].ravel()
+        df_final_kit = pd.DataFrame({"Effect of Age Structure": structure_effect, "Effect of Rates": rates_effect, 
+                                     "Difference": structure_effect + rates_effect}, index=index).reset_index()
+        df_final_kit = df_final_kit.loc[df_final_kit["Geo"] != df_final_kit["Reference"]].reset_index(drop=True)
+        return df_final_kit
     df_final_kit = pd.DataFrame(results)
     return df_final_kit
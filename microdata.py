@@ -0,0 +1,204 @@
+# streaming aggregation of individual death records (one row per death) in the counts by year, sex and age class used by the analysis
+
+import argparse
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from utility import age_groups, age_conversion_it, age_dtype, compact_counts
+
+# default names of the columns of the record files, keys are the roles used by the aggregator (cause and residence are needed only to filter or group)
+microdata_columns = {"age": "age", "sex": "sex", "year": "year", "cause": "cause", "residence": "residence"}
+# codes of the sex in the record files (ISTAT microdata use 1 and 2), converted in the labels of the analysis
+sex_conversion_microdata = {"M": "M", "F": "F", "1": "M", "2": "F"}
+# sexes of the accumulators, in this order (the total is added at the end)
+microdata_sexes = ["M", "F"]
+
+def age_class_codes(ages):
+    """
+    Function used to assign single ages (in completed years) to the age classes of the analysis (0, 1-4, 5-9, ..., 90-94, 95+) with vectorized operations
+    Returns an int8 array with the code of every age class (its position in age_groups), -1 for missing or negative ages
+    """
+    ages = np.floor(pd.to_numeric(pd.Series(ages), errors="coerce").to_numpy(dtype=np.float64))
+    valid = ages >= 0
+    ages = np.where(valid, ages, 0).astype(np.int64)
+    codes = np.where(ages == 0, 0, np.where(ages < 5, 1, np.minimum(ages // 5 + 1, len(age_groups) - 1)))
+    return np.where(valid, codes, -1).astype(np.int8)
+
+def _convert_distinct(values, convert):
+    """
+    Function used to convert a column with few distinct values (ages, sexes, years, codes): every distinct value is converted only once,
+    then the results are spread to the rows with a positional take
+    convert is a function applied to the array of the distinct values
+    Returns an array with one value for each row
+    """
+    inverse, uniques = pd.factorize(values)
+    return np.asarray(convert(np.asarray(uniques, dtype=object)))[inverse]
+
+def _aggregate_chunk(chunk, columns, counts, geo, by_residence):
+    """
+    Function used to add the records of a chunk to counts, a dict (geo, year) -> int64 array indexed by [sex (M, F), age]
+    Every group of the chunk is counted with a single bincount
+    Returns the number of records dropped (missing or unknown year, sex or age)
+    """
+    ages = _convert_distinct(chunk[columns["age"]], age_class_codes)
+    sex_codes = {code: microdata_sexes.index(sex) for code, sex in sex_conversion_microdata.items()}
+    sexes = _convert_distinct(chunk[columns["sex"]], lambda codes: [sex_codes.get(code.strip(), -1) for code in codes])
+    years = _convert_distinct(chunk[columns["year"]], lambda years: pd.to_numeric(pd.Series(years), errors="coerce").to_numpy(dtype=np.float64))
+    valid = (ages >= 0) & (sexes >= 0) & ~np.isnan(years)
+    if not valid.any():
+        return len(chunk)
+    if by_residence:
+        geo_codes, geo_labels = pd.factorize(_convert_distinct(chunk.loc[valid, columns["residence"]], lambda codes: [code.strip() for code in codes]))
+    else:
+        geo_codes, geo_labels = np.zeros(valid.sum(), dtype=np.int64), [geo]
+    year_codes, year_labels = pd.factorize(years[valid].astype(np.int64))
+    n_ages, n_groups = len(age_groups), len(geo_labels) * len(year_labels)
+    groups = geo_codes * len(year_labels) + year_codes
+    chunk_counts = np.bincount((groups * len(microdata_sexes) + sexes[valid]) * n_ages + ages[valid], minlength=n_groups * len(microdata_sexes) * n_ages)
+    chunk_counts = chunk_counts.reshape(len(geo_labels), len(year_labels), len(microdata_sexes), n_ages)
+    for g, label in enumerate(geo_labels):
+        for y, year in enumerate(year_labels):
+            if chunk_counts[g, y].any():
+                key = (label, int(year))
+                counts[key] = counts[key] + chunk_counts[g, y] if key in counts else chunk_counts[g, y].astype(np.int64)
+    return int((~valid).sum())
+
+def aggregate_file(path, columns=None, causes=None, residences=None, years=None, by_residence=False, geo="IT", chunksize=500000, sep=","):
+    """
+    Function used to stream a file of death records (csv, also compressed, e.g. .csv.gz) and to count the deaths by geo, year, sex and age class
+    Only the needed columns are read, in chunks of chunksize rows, so the memory used depends on chunksize and not on the size of the file
+    columns maps the roles (age, sex, year, cause, residence) to the names of the columns of the file (see microdata_columns)
+    causes is a list of prefixes of the cause codes to keep (e.g. ["C"] for all the ICD-10 cancers), residences a list of residence codes to keep,
+    years a list of years to keep; with by_residence the residence is used as geo, otherwise all the deaths are counted in geo
+    Returns a tuple (counts, dropped): counts is a dict (geo, year) -> int64 array indexed by [sex (M, F), age], dropped the number of records
+    with missing or unknown year, sex or age
+    """
+    columns = {**microdata_columns, **(columns or {})}
+    roles = ["age", "sex", "year"] + (["cause"] if causes is not None else []) + (["residence"] if residences is not None or by_residence else [])
+    header = pd.read_csv(path, sep=sep, nrows=0).columns
+    for role in roles:
+        if columns[role] not in header:
+            raise ValueError(f"Required column missing: {columns[role]}")
+    usecols = list(dict.fromkeys(columns[role] for role in roles))
+    counts, dropped = {}, 0
+    for chunk in pd.read_csv(path, sep=sep, usecols=usecols, chunksize=chunksize, dtype=str, keep_default_na=False):
+        mask = np.ones(len(chunk), dtype=bool)
+        if causes is not None:
+            mask &= _convert_distinct(chunk[columns["cause"]], lambda codes: [code.strip().startswith(tuple(causes)) for code in codes]).astype(bool)
+        if residences is not None:
+            mask &= _convert_distinct(chunk[columns["residence"]], lambda codes: [code.strip() in residences for code in codes]).astype(bool)
+        if years is not None:
+            mask &= _convert_distinct(chunk[columns["year"]], lambda values: pd.to_numeric(pd.Series(values), errors="coerce").isin(years).to_numpy())
+        if mask.any():
+            dropped += _aggregate_chunk(chunk.loc[mask], columns, counts, geo, by_residence)
+    return counts, dropped
+
+def _aggregate_shard(job):
+    """
+    Function used to run aggregate_file in a process of the pool
+    job is a tuple (path, kwargs)
+    """
+    path, kwargs = job
+    return aggregate_file(path, **kwargs)
+
+def merge_counts(partials):
+    """
+    Function used to merge the counts of several files (or shards of a file), see aggregate_file
+    Returns a tuple (counts, dropped) with the sums
+    """
+    counts, dropped = {}, 0
+    for partial_counts, partial_dropped in partials:
+        for key, values in partial_counts.items():
+            counts[key] = counts[key] + values if key in counts else values.copy()
+        dropped += partial_dropped
+    return counts, dropped
+
+def counts_frame(counts):
+    """
+    Function used to convert the counts of aggregate_file in a long df, with all the age classes and the total of males and females
+    Returns a df with Geo, Year, Sex, Age and Deaths, in the same format of eurostat_bulk.load_bulk (it can be used with rate_cube.rate_cube)
+    """
+    if not counts:
+        raise ValueError("No records left after filtering the death records")
+    keys = sorted(counts)
+    array = np.stack([counts[key] for key in keys])
+    # sex axis in the order Tot, M, F
+    array = np.concatenate([array.sum(axis=1, keepdims=True), array], axis=1)
+    sexes, n_ages = ["Tot"] + microdata_sexes, len(age_groups)
+    df = pd.DataFrame({"Geo": np.repeat([geo for geo, _ in keys], len(sexes) * n_ages),
+                       "Year": np.repeat([year for _, year in keys], len(sexes) * n_ages),
+                       "Sex": np.tile(np.repeat(sexes, n_ages), len(keys)),
+                       "Age": pd.Categorical.from_codes(np.tile(np.arange(n_ages), len(keys) * len(sexes)), dtype=age_dtype),
+                       "Deaths": compact_counts(pd.Series(array.ravel()))})
+    return df
+
+def aggregate_microdata(paths, columns=None, causes=None, residences=None, years=None, by_residence=False, geo="IT", chunksize=500000, sep=",", processes=1):
+    """
+    Function used to aggregate one or more files of death records (e.g. the shards of a big extract) in the counts used by the analysis
+    Every file is streamed in chunks (see aggregate_file); with processes > 1 (all the CPUs if None) the files are aggregated in a pool of processes,
+    each one with its own chunk in memory, and the counts are merged at the end
+    Returns a df with Geo, Year, Sex, Age and Deaths (see counts_frame); the number of records dropped is in df.attrs["Dropped records"]
+    """
+    paths = [paths] if isinstance(paths, (str, Path)) else list(paths)
+    kwargs = {"columns": columns, "causes": causes, "residences": residences, "years": years, "by_residence": by_residence, "geo": geo,
+              "chunksize": chunksize, "sep": sep}
+    jobs = [(path, kwargs) for path in paths]
+    if processes == 1 or len(jobs) <= 1:
+        partials = [_aggregate_shard(job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            partials = list(executor.map(_aggregate_shard, jobs))
+    counts, dropped = merge_counts(partials)
+    df = counts_frame(counts)
+    df.attrs["Dropped records"] = dropped
+    return df
+
+def write_istat_deaths(df, data_dir, geo="IT"):
+    """
+    Function used to write the deaths of a geo of aggregate_microdata in the format of the ISTAT files (Deaths_Italy_{sex}.csv, read by
+    utility.load_data_ISTAT_Deaths), so the main analysis can be run on the records
+    Returns a list with the paths of the files written
+    """
+    if geo not in set(df["Geo"]):
+        raise ValueError(f"Geo not found: {geo}")
+    labels_it = {age: label for label, age in age_conversion_it.items()}
+    data_dir = Path(data_dir)
+    data_dir.mkdir(parents=True, exist_ok=True)
+    paths = []
+    for sex in ["Tot"] + microdata_sexes:
+        df_sex = df.loc[(df["Geo"] == geo) & (df["Sex"] == sex)]
+        df_istat = pd.DataFrame({"DATAFLOW": "microdata", "Età": df_sex["Age"].map(labels_it).astype(str), "TIME_PERIOD": df_sex["Year"], "Osservazione": df_sex["Deaths"]})
+        paths.append(data_dir / f"Deaths_Italy_{sex}.csv")
+        df_istat.to_csv(paths[-1], index=False)
+    return paths
+
+def main():
+    parser = argparse.ArgumentParser(description="Aggregation of death records in deaths by year, sex and age class")
+    parser.add_argument("paths", type=Path, nargs="+", help="files of death records (csv, also .gz), e.g. the shards of an extract")
+    parser.add_argument("--output", "-o", type=Path, default=Path("output") / "Deaths_Microdata.csv", help="csv with Geo, Year, Sex, Age and Deaths")
+    parser.add_argument("--columns", nargs="+", default=[], help="names of the columns of the files as role=name, e.g. age=eta sex=sesso year=anno")
+    parser.add_argument("--causes", nargs="+", default=None, help="prefixes of the cause codes to keep, e.g. C for all the cancers")
+    parser.add_argument("--residences", nargs="+", default=None, help="residence codes to keep")
+    parser.add_argument("--years", type=int, nargs="+", default=None)
+    parser.add_argument("--by-residence", action="store_true", help="count the deaths of every residence as a separate geo")
+    parser.add_argument("--sep", default=",")
+    parser.add_argument("--chunksize", type=int, default=500000, help="rows read at a time from each file")
+    parser.add_argument("--jobs", "-j", type=int, default=1, help="processes used to aggregate the files (all the CPUs if 0)")
+    parser.add_argument("--istat", type=Path, default=None, help="folder where Deaths_Italy_{sex}.csv are written for analysis.py")
+    args = parser.parse_args()
+    columns = dict(column.split("=", 1) for column in args.columns)
+    unknown = set(columns) - set(microdata_columns)
+    if unknown:
+        parser.error(f"Unknown roles: {', '.join(sorted(unknown))} (available: {', '.join(microdata_columns)})")
+    df = aggregate_microdata(args.paths, columns=columns, causes=args.causes, residences=args.residences, years=args.years, by_residence=args.by_residence,
+                             chunksize=args.chunksize, sep=args.sep, processes=args.jobs or None)
+    args.output.parent.mkdir(parents=True, exist_ok=True)
+    df.to_csv(args.output, index=False)
+    print(f"{df.loc[df['Sex'] == 'Tot', 'Deaths'].sum()} deaths aggregated in {args.output} ({df.attrs['Dropped records']} records dropped)")
+    if args.istat is not None:
+        write_istat_deaths(df, args.istat)
+        print(f"ISTAT deaths files written in {args.istat}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+# batch analysis of every cause of death in a multi-cause Eurostat extract, with the population shared by all the causes
+
+import argparse
+import pandas as pd
+from pathlib import Path
+from utility import load_standard_pop
+from eurostat_bulk import load_bulk
+from rate_cube import cause_cube
+from standardize_rates import rates_ci_batch
+from kitagawa_deco import kitagawa_effects
+from results_store import save_results, tidy_frame, data_vintage
+
+# codes used by the Eurostat bulk files for the EU27 aggregate and Italy
+EU27_code = "EU27_2020"
+IT_code = "IT"
+
+def select_cause(cube, cause):
+    """
+    Function used to extract a single cause from the cube of cause_cube
+    Returns a dictionary in the same format of rate_cube.rate_cube (arrays indexed by [geo, year, sex, age])
+    """
+    if cause not in cube["Cause"]:
+        raise ValueError(f"Cause not found: {cause}")
+    c = cube["Cause"].index(cause)
+    return {key: (value[c] if key in ["Deaths", "Death_Rate_per_100k", "Exp_Deaths_on_Std", "Ratio_Exp_on_Std"] else value)
+            for key, value in cube.items() if key != "Cause"}
+
+def causes_results(cube, ref, alpha=0.05):
+    """
+    Function used to calculate, for every cause and geo of the cube (see rate_cube.cause_cube) at once, the crude rates,
+    the standardized rates with CIs and the Kitagawa decomposition against the reference geo ref
+    The population and its age proportions are shared by all the causes: rates_ci_batch and kitagawa_effects broadcast them over the cause axis
+    Returns a df with Cause, Geo, Year, Sex, Reference, crude and standardized rates with CIs, Effect of Age Structure, Effect of Rates and Difference
+    """
+    if ref not in cube["Geo"]:
+        raise ValueError(f"Reference not found among the geos: {ref}")
+    r = cube["Geo"].index(ref)
+    ci = rates_ci_batch(cube["Deaths"], cube["Total"], cube["Pop_Std"], alpha)
+    structure_effect, rates_effect = kitagawa_effects(cube["Total"], cube["Death_Rate_per_100k"], cube["Total"][r], cube["Death_Rate_per_100k"][:, r:r+1])
+    index = pd.MultiIndex.from_product([cube["Cause"], cube["Geo"], cube["Year"], cube["Sex"]], names=["Cause", "Geo", "Year", "Sex"])
+    df_causes = pd.DataFrame({"Reference": ref,
+                              "Crude": ci["Crude"].ravel(), "95% CI lower Crude": ci["Crude lower"].ravel(), "95% CI upper Crude": ci["Crude upper"].ravel(),
+                              "Std": ci["Std"].ravel(), "95% CI lower Std": ci["Std lower"].ravel(), "95% CI upper Std": ci["Std upper"].ravel(),
+                              "Effect of Age Structure": structure_effect.ravel(), "Effect of Rates": rates_effect.ravel(),
+                              "Difference": (structure_effect + rates_effect).ravel()}, index=index)
+    df_causes = df_causes.reset_index()
+    assert (df_causes["Crude"]>=0).all(), "Negative crude rates found"
+    assert (df_causes["Std"]>=0).all(), "Negative standardized rates found"
+    return df_causes
+
+def main(data_dir=Path("data"), output_dir=Path("output"), ref=EU27_code, geos=(IT_code, EU27_code), causes=None, years=None, filters={"resid": ["TOT_IN"]}, store=None):
+    """
+    Runs the multi-cause analysis: Deaths_Bulk.csv is an extract of hlth_cd_aro with the icd10 dimension (one or more causes, see download_data.md)
+    and Population_Bulk.csv an extract of demo_pjan, both in SDMX-CSV format (also .tsv or .gz, see eurostat_bulk.load_bulk)
+    causes is a list with the icd10 codes to keep (all the causes of the file if None), geos the geo codes (all the geos if None)
+    filters are the other codes to keep in the deaths file (by default the deaths of all the residents, so they are not counted twice)
+    The results of every cause are written in a single table, and also saved in the SQLite database store if given (see results_store.py)
+    """
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    deaths_filters = dict(filters or {})
+    if causes is not None:
+        deaths_filters["icd10"] = list(causes)
+    if geos is not None:
+        deaths_filters["geo"] = list(geos)
+    df_deaths = load_bulk(Path(data_dir) / "Deaths_Bulk.csv", value="Deaths", filters=deaths_filters, years=years)
+    df_pop = load_bulk(Path(data_dir) / "Population_Bulk.csv", value="Total", filters=None if geos is None else {"geo": list(geos)}, years=years)
+    df_Pop_Std = load_standard_pop(Path(data_dir) / "ESP2013.csv")
+    print("Data loading completed")
+    cube = cause_cube(df_deaths, df_pop, df_Pop_Std, causes=causes, geos=geos)
+    df_causes = causes_results(cube, ref)
+    df_causes.to_csv(output_dir / "Table_Results_Causes.csv", index=False)
+    print(f"Results for {len(cube['Cause'])} causes and {len(cube['Geo'])} geos written in Table_Results_Causes.csv")
+    if store is not None:
+        vintage = data_vintage([Path(data_dir) / name for name in ["Deaths_Bulk.csv", "Population_Bulk.csv", "ESP2013.csv"]])
+        run_id = save_results(store, tidy_frame(df_causes, "causes"), vintage, settings={"reference": ref, "geos": geos, "causes": causes, "years": years, "filters": filters})
+        print(f"Results saved in {store} (run {run_id}, data vintage {vintage})")
+
+def parse_args(argv=None):
+    """
+    Function used to read the arguments of the command line
+    Returns the namespace of argparse
+    """
+    parser = argparse.ArgumentParser(description="Multi-cause analysis of the Eurostat bulk files")
+    parser.add_argument("--input", "-i", type=Path, default=Path("data"))
+    parser.add_argument("--output", "-o", type=Path, default=Path("output"))
+    parser.add_argument("--reference", default=EU27_code, help="geo code used as reference (default EU27_2020)")
+    parser.add_argument("--geos", nargs="+", default=[IT_code, EU27_code], help="geo codes to analyse (default IT and EU27_2020)")
+    parser.add_argument("--causes", nargs="+", default=None, help="icd10 codes to analyse (all the causes of the file by default)")
+    parser.add_argument("--years", type=int, nargs="+", default=None)
+    parser.add_argument("--store", type=Path, default=None, help="SQLite database where the results are also saved (see results_store.py)")
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    args = parse_args()
+    geos = args.geos if args.reference in args.geos else [args.reference] + args.geos
+    main(args.input, args.output, ref=args.reference, geos=geos, causes=args.causes, years=args.years, store=args.store)
@@ -0,0 +1,99 @@
+# batch analysis of every country in a Eurostat extract with the Geopolitical entity dimension
+
+import argparse
+import pandas as pd
+from pathlib import Path
+from utility import load_data_EUROSTAT_geo, load_standard_pop
+from rate_cube import rate_cube
+from standardize_rates import rates_ci_batch
+from kitagawa_deco import kitagawa_effects, kitagawa_all_pairs, dataframe_final_kit
+from sensitivity_analysis import leave_one_out, dataframe_leave_one_out
+from results_store import save_results, tidy_frame, data_vintage
+
+# label used by Eurostat for the EU27 aggregate, used as default reference
+EU27_label = "European Union - 27 countries (from 2020)"
+# Eurostat codes of the labels of the Geopolitical entity dimension, the geos are saved in the results store with the codes used by pipeline.py
+# (e.g. IT and EU27_2020), so the same geo can be compared across the analyses; the labels not found are saved as they are
+geo_codes = {EU27_label: "EU27_2020", "European Union - 28 countries (2013-2020)": "EU28",
+             "Belgium": "BE", "Bulgaria": "BG", "Czechia": "CZ", "Czech Republic": "CZ", "Denmark": "DK", "Germany": "DE",
+             "Germany (until 1990 former territory of the FRG)": "DE", "Estonia": "EE", "Ireland": "IE", "Greece": "EL", "Spain": "ES",
+             "France": "FR", "Croatia": "HR", "Italy": "IT", "Cyprus": "CY", "Latvia": "LV", "Lithuania": "LT", "Luxembourg": "LU",
+             "Hungary": "HU", "Malta": "MT", "Netherlands": "NL", "Austria": "AT", "Poland": "PL", "Portugal": "PT", "Romania": "RO",
+             "Slovenia": "SI", "Slovakia": "SK", "Finland": "FI", "Sweden": "SE",
+             "Iceland": "IS", "Liechtenstein": "LI", "Norway": "NO", "Switzerland": "CH"}
+
+def countries_results(cube, ref, alpha=0.05):
+    """
+    Function used to calculate, for every geo of the cube (see rate_cube.rate_cube) at once, the crude rates,
+    the standardized rates with CIs and the Kitagawa decomposition against the reference geo ref.
+    The Kitagawa effects of the reference against itself are zero.
+    Returns a df with Geo, Year, Sex, Reference, crude and standardized rates with CIs, Effect of Age Structure, Effect of Rates and Difference
+    """
+    if ref not in cube["Geo"]:
+        raise ValueError(f"Reference not found among the geos: {ref}")
+    r = cube["Geo"].index(ref)
+    ci = rates_ci_batch(cube["Deaths"], cube["Total"], cube["Pop_Std"], alpha)
+    structure_effect, rates_effect = kitagawa_effects(cube["Total"], cube["Death_Rate_per_100k"], cube["Total"][r], cube["Death_Rate_per_100k"][r])
+    index = pd.MultiIndex.from_product([cube["Geo"], cube["Year"], cube["Sex"]], names=["Geo", "Year", "Sex"])
+    df_countries = pd.DataFrame({"Reference": ref,
+                                 "Crude": ci["Crude"].ravel(), "95% CI lower Crude": ci["Crude lower"].ravel(), "95% CI upper Crude": ci["Crude upper"].ravel(),
+                                 "Std": ci["Std"].ravel(), "95% CI lower Std": ci["Std lower"].ravel(), "95% CI upper Std": ci["Std upper"].ravel(),
+                                 "Effect of Age Structure": structure_effect.ravel(), "Effect of Rates": rates_effect.ravel(),
+                                 "Difference": (structure_effect + rates_effect).ravel()}, index=index)
+    df_countries = df_countries.reset_index()
+    assert (df_countries["Crude"]>=0).all(), "Negative crude rates found"
+    assert (df_countries["Std"]>=0).all(), "Negative standardized rates found"
+    return df_countries
+
+def main(data_dir=Path("data"), output_dir=Path("output"), ref=EU27_label, geos=None, years=None, sexes=None, store=None):
+    """
+    Runs the multi-country analysis: the deaths and population extracts must keep the Geopolitical entity dimension
+    (see download_data.md) and the results of every country are written in a single table.
+    The all-pairs Kitagawa decomposition is written in a second table and the reference without each country (leave-one-out sensitivity analysis) in a third one.
+    geos, years and sexes select the strata (all the ones of the deaths file if None), the reference is always kept
+    store is the path of a SQLite database where the results of every country are also saved (see results_store.py), with the Eurostat codes of the geos (see geo_codes)
+    """
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    if geos is not None and ref not in geos:
+        geos = [ref] + list(geos)
+    df_deaths = load_data_EUROSTAT_geo(Path(data_dir) / "Deaths_Europe_Countries.csv", value="Deaths")
+    df_pop = load_data_EUROSTAT_geo(Path(data_dir) / "Population_Europe_Countries.csv", value="Total")
+    df_Pop_Std = load_standard_pop(Path(data_dir) / "ESP2013.csv")
+    print("Data loading completed")
+    cube = rate_cube(df_deaths, df_pop, df_Pop_Std, geos=geos, years=years, sexes=sexes)
+    df_countries = countries_results(cube, ref)
+    df_countries.to_csv(output_dir / "Table_Results_Countries.csv", index=False)
+    print(f"Results for {len(cube['Geo'])} geos written in Table_Results_Countries.csv")
+    if store is not None:
+        vintage = data_vintage([Path(data_dir) / name for name in ["Deaths_Europe_Countries.csv", "Population_Europe_Countries.csv", "ESP2013.csv"]])
+        df_codes = df_countries.assign(Geo=df_countries["Geo"].replace(geo_codes), Reference=df_countries["Reference"].replace(geo_codes))
+        run_id = save_results(store, tidy_frame(df_codes, "countries"), vintage, settings={"reference": ref, "geos": geos, "years": years, "sexes": sexes})
+        print(f"Results saved in {store} (run {run_id}, data vintage {vintage})")
+    # kitagawa decomposition of every geo against every other geo
+    df_pairs = dataframe_final_kit(kitagawa_all_pairs(cube))
+    df_pairs.to_csv(output_dir / "Table_Results_Kit_Pairs.csv", index=False)
+    print("All-pairs Kitagawa decomposition written in Table_Results_Kit_Pairs.csv")
+    # sensitivity analysis: the reference without each one of the other geos
+    df_leave_one_out = dataframe_leave_one_out(leave_one_out(cube, ref))
+    df_leave_one_out.to_csv(output_dir / "Table_Results_Leave_One_Out.csv", index=False)
+    print("Leave-one-out sensitivity analysis written in Table_Results_Leave_One_Out.csv")
+
+def parse_args(argv=None):
+    """
+    Function used to read the arguments of the command line
+    Returns the namespace of argparse
+    """
+    parser = argparse.ArgumentParser(description="Multi-country analysis of a Eurostat extract")
+    parser.add_argument("--input", "-i", type=Path, default=Path("data"))
+    parser.add_argument("--output", "-o", type=Path, default=Path("output"))
+    parser.add_argument("--reference", default=EU27_label, help="geo used as reference (default the EU27 aggregate)")
+    parser.add_argument("--geos", nargs="+", default=None, help="geos to analyse, with the labels of the extract (all the geos by default)")
+    parser.add_argument("--years", type=int, nargs="+", default=None)
+    parser.add_argument("--sexes", nargs="+", choices=["Tot", "M", "F"], default=None)
+    parser.add_argument("--store", type=Path, default=None, help="SQLite database where the results are also saved (see results_store.py)")
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    args = parse_args()
+    main(args.input, args.output, ref=args.reference, geos=args.geos, years=args.years, sexes=args.sexes, store=args.store)
@@ -0,0 +1,437 @@
+# the analysis expressed as a graph of stages, with results fingerprinted by their inputs and reused between runs
+
+import hashlib
+import json
+import pickle
+import sys
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import utility
+import rate_cube
+import standardize_rates
+import sensitivity_analysis
+import kitagawa_deco
+import plots
+import tables
+from utility import load_data_ISTAT_Deaths, load_data_EUROSTAT_Deaths, load_standard_pop, load_data_ISTAT_Pop_long, load_data_Eurostat_Pop_long
+from rate_cube import stack_strata, stratum_std
+from standardize_rates import final_batch, final_standards, dataframe_final
+from standard_populations import observed_standard
+from sensitivity_analysis import leave_one_out, dataframe_final_sens
+from kitagawa_deco import kitagawa_effects, dataframe_final_kit
+from plots import graph_1, graph_2, graph_3, graph_4, table_image, render
+from tables import results_table, sensitivity_table, kitagawa_table, write_table
+from results_store import save_results, tidy_pipeline, data_vintage
+from artifacts import atomic_path, read_manifest, is_current, update_manifest
+from instrument import instrumented, enable_instrumentation, disable_instrumentation, write_report
+
+# geos compared in the analysis
+GEO_IT = "IT"
+GEO_EU = "EU27_2020"
+
+def fingerprint(*objects):
+    """
+    Function used to calculate a fingerprint (sha256) of dfs, arrays and simple python objects
+    Returns the hexadecimal digest
+    """
+    digest = hashlib.sha256()
+    for obj in objects:
+        if isinstance(obj, pd.DataFrame):
+            digest.update(json.dumps([str(column) for column in obj.columns]).encode("utf-8"))
+            digest.update(pd.util.hash_pandas_object(obj, index=False).to_numpy().tobytes())
+        elif isinstance(obj, np.ndarray):
+            digest.update(np.ascontiguousarray(obj).tobytes())
+        else:
+            digest.update(repr(obj).encode("utf-8"))
+        digest.update(b"|")
+    return digest.hexdigest()
+
+def code_fingerprint(*modules):
+    """
+    Function used to calculate a fingerprint of the source code of the modules, so results are recalculated when the code changes
+    Returns the hexadecimal digest
+    """
+    return fingerprint(*[Path(module.__file__).read_bytes() for module in modules])
+
+def strata_paths(state_dir, stage, fingerprints):
+    """
+    Function used to find the files where the results of a stage are saved for every stratum
+    Returns a dict stratum -> path
+    """
+    return {stratum: Path(state_dir) / f"{stage}-{fingerprint(stage, key)}.pkl" for stratum, key in fingerprints.items()}
+
+def memo_strata(state_dir, stage, fingerprints, compute):
+    """
+    Function used to reuse the results of a stage for the strata whose inputs didn't change
+    fingerprints is a dict stratum -> fingerprint of the inputs of the stratum
+    compute is a function that takes the list of the strata to recalculate and returns a dict stratum -> result
+    The files of the stage saved by the previous runs that don't belong to the current strata (e.g. results of an older version of the code) are deleted
+    Returns a dict stratum -> result and the list of the recalculated strata
+    """
+    paths = strata_paths(state_dir, stage, fingerprints)
+    results = {}
+    for stratum, path in paths.items():
+        if path.exists():
+            with open(path, "rb") as file:
+                results[stratum] = pickle.load(file)
+    missing = [stratum for stratum in fingerprints if stratum not in results]
+    if missing:
+        computed = instrumented(f"{stage}_strata", kind="strata")(compute)(missing)
+        for stratum in missing:
+            # written atomically, so runs sharing the output folder never read a half-written result
+            with atomic_path(paths[stratum]) as temp_path, open(temp_path, "wb") as file:
+                pickle.dump(computed[stratum], file)
+        results.update(computed)
+    current = set(paths.values())
+    for path in Path(state_dir).glob(f"{stage}-*.pkl"):
+        if path not in current:
+            path.unlink(missing_ok=True)
+    return results, missing
+
+def stage_load(context):
+    """
+    Stage used to read the input files (through the cache of the loaders) and to fingerprint every (year, sex) stratum
+    If the years are not given they are all the years found in both the italian and european deaths files (e.g. 1994-2023),
+    with an Italian_Population_YYYY.csv file for each year
+    Returns a dict with df_deaths, df_pop, df_Pop_Std, the fingerprints of the strata and the paths of the files read
+    """
+    data_dir = context["data_dir"]
+    deaths_paths = {(geo, sex): data_dir / f"Deaths_{country}_{sex}.csv" for geo, country in [(GEO_IT, "Italy"), (GEO_EU, "Europe")] for sex in context["sexes"]}
+    df_deaths = stack_strata([(load_data_ISTAT_Deaths(deaths_paths[GEO_IT, sex]), GEO_IT, sex) for sex in context["sexes"]] +
+                             [(load_data_EUROSTAT_Deaths(deaths_paths[GEO_EU, sex]), GEO_EU, sex) for sex in context["sexes"]])
+    years_found = sorted(set(df_deaths.loc[df_deaths["Geo"] == GEO_IT, "Year"]) & set(df_deaths.loc[df_deaths["Geo"] == GEO_EU, "Year"]))
+    if context["years"] is None:
+        context["years"] = years_found
+    missing_years = set(context["years"]) - set(years_found)
+    if missing_years:
+        raise ValueError(f"Years not found in the deaths files: {sorted(missing_years)}")
+    context["strata"] = [(year, sex) for sex in context["sexes"] for year in context["years"]]
+    df_deaths = df_deaths.loc[df_deaths["Year"].isin(context["years"])].reset_index(drop=True)
+    print(f"Mortality data loading completed ({len(context['years'])} years: {context['years'][0]}-{context['years'][-1]})")
+    pop_paths = [data_dir / f"Italian_Population_{year}.csv" for year in context["years"]] + [data_dir / "European_Population.csv"]
+    df_pop = pd.concat([load_data_ISTAT_Pop_long(path) for path in pop_paths[:-1]] + [load_data_Eurostat_Pop_long(pop_paths[-1])], ignore_index=True)
+    print("Population data loading completed")
+    std_path = data_dir / "ESP2013.csv"
+    df_Pop_Std = load_standard_pop(std_path)
+    print("ESP2013 loading completed")
+    # the fingerprint of a stratum depends on its deaths and population, on the standard population and on the code (also of this module)
+    code = code_fingerprint(utility, rate_cube, standardize_rates, sensitivity_analysis, kitagawa_deco, sys.modules[__name__])
+    deaths_groups = dict(list(df_deaths.groupby(["Year", "Sex"])))
+    pop_groups = dict(list(df_pop.groupby(["Year", "Sex"])))
+    fingerprints = {}
+    for stratum in context["strata"]:
+        if stratum not in deaths_groups or stratum not in pop_groups:
+            raise ValueError(f"Deaths or population missing for the stratum {stratum}")
+        fingerprints[stratum] = fingerprint(code, stratum, deaths_groups[stratum], pop_groups[stratum], df_Pop_Std)
+    return {"df_deaths": df_deaths, "df_pop": df_pop, "df_Pop_Std": df_Pop_Std, "fingerprints": fingerprints,
+            "paths": list(deaths_paths.values()) + pop_paths + [std_path]}
+
+def stage_rates(context):
+    """
+    Stage used to calculate crude rates and expected deaths on the standard population (rate_cube) for the strata that changed
+    Returns a dict stratum -> df in the format of standardize_rates.expected_deaths_year
+    """
+    load = context["load"]
+    def compute(missing):
+        years = sorted({year for year, sex in missing})
+        sexes = list(dict.fromkeys(sex for year, sex in missing))
+        cube = rate_cube.rate_cube(load["df_deaths"], load["df_pop"], load["df_Pop_Std"], geos=[GEO_IT, GEO_EU], years=years, sexes=sexes)
+        return {(year, sex): stratum_std(cube, GEO_IT, GEO_EU, year, sex) for year, sex in missing}
+    results, missing = memo_strata(context["state_dir"], "rates", load["fingerprints"], compute)
+    print(f"Rates calculation completed ({len(missing)} strata recalculated)")
+    return results
+
+def stage_final(context):
+    """
+    Stage used to calculate crude and standardized rates with CIs for the strata that changed
+    Returns the final df (see standardize_rates.dataframe_final)
+    """
+    rates = context["rates"]
+    def compute(missing):
+        collection = final_batch([(rates[stratum], *stratum) for stratum in missing])
+        return dict(zip(missing, collection))
+    results, missing = memo_strata(context["state_dir"], "final", context["load"]["fingerprints"], compute)
+    print(f"Creation of final dataframe completed ({len(missing)} strata recalculated)")
+    return dataframe_final([results[stratum] for stratum in context["strata"]])
+
+def stage_sensitivity(context):
+    """
+    Stage used to run the sensitivity analysis (EU vs EU without Italy) for the strata that changed, in a single vectorized call
+    Returns the final df of the sensitivity analysis (see sensitivity_analysis.dataframe_final_sens)
+    """
+    load = context["load"]
+    def compute(missing):
+        # EU without Italy is calculated for all the strata at once, with the subtraction broadcasted on the cube (see sensitivity_analysis.leave_one_out)
+        years = sorted({year for year, sex in missing})
+        sexes = list(dict.fromkeys(sex for year, sex in missing))
+        cube = rate_cube.rate_cube(load["df_deaths"], load["df_pop"], load["df_Pop_Std"], geos=[GEO_IT, GEO_EU], years=years, sexes=sexes)
+        ci = leave_one_out(cube, GEO_EU, members=[GEO_IT])
+        results = {}
+        for year, sex in missing:
+            y, s = years.index(year), sexes.index(sex)
+            results[year, sex] = {"Year": year, "Sex": sex, "Crude EU-It": float(ci["Crude"][0, y, s]), "95% CI lower EU-It Crude": float(ci["Crude lower"][0, y, s]),
+                                  "95% CI upper EU-It Crude": float(ci["Crude upper"][0, y, s]), "Std EU-It": float(ci["Std"][0, y, s]),
+                                  "95% CI lower EU-It Std": float(ci["Std lower"][0, y, s]), "95% CI upper EU-It Std": float(ci["Std upper"][0, y, s])}
+        return results
+    results, missing = memo_strata(context["state_dir"], "sensitivity", load["fingerprints"], compute)
+    print(f"Sensitivity analysis completed ({len(missing)} strata recalculated)")
+    return dataframe_final_sens([results[stratum] for stratum in context["strata"]])
+
+def stage_kitagawa(context):
+    """
+    Stage used to run the Kitagawa decomposition (Italy vs Europe) for the strata that changed, in a single vectorized call
+    Returns the final df of the Kitagawa decomposition (see kitagawa_deco.dataframe_final_kit)
+    """
+    rates = context["rates"]
+    def compute(missing):
+        arrays = {column: np.stack([rates[stratum][column].to_numpy(dtype=np.float64) for stratum in missing])
+                  for column in ["Total_It", "Death_Rate_per_100k_It", "Total_EU", "Death_Rate_per_100k_EU"]}
+        structure_effect, rates_effect = kitagawa_effects(arrays["Total_It"], arrays["Death_Rate_per_100k_It"], arrays["Total_EU"], arrays["Death_Rate_per_100k_EU"])
+        return {(year, sex): {"Year": year, "Sex": sex, "Effect of Age Structure": float(structure_effect[i]), "Effect of Rates": float(rates_effect[i]),
+                              "Difference": float(structure_effect[i] + rates_effect[i])}
+                for i, (year, sex) in enumerate(missing)}
+    results, missing = memo_strata(context["state_dir"], "kitagawa", context["load"]["fingerprints"], compute)
+    print(f"Kitagawa decomposition completed ({len(missing)} strata recalculated)")
+    return dataframe_final_kit([results[stratum] for stratum in context["strata"]])
+
+def default_standards(cube, df_Pop_Std):
+    """
+    Function used to create the default standard populations: ESP2013 from the data folder, ESP1976, WHO 2000, Segi
+    and the observed EU27 population of the cube, summed over the years (the total of the sexes if Tot is in the cube)
+    Returns a dict name -> standard (see standard_populations.standards_matrix)
+    """
+    population_eu = cube["Total"][cube["Geo"].index(GEO_EU)]
+    observed = population_eu[:, cube["Sex"].index("Tot")].sum(axis=0) if "Tot" in cube["Sex"] else observed_standard(population_eu)
+    return {"ESP2013": df_Pop_Std, "ESP1976": "ESP1976", "WHO2000": "WHO2000", "Segi": "Segi", "EU27 observed": observed}
+
+def stage_standards(context):
+    """
+    Stage used to calculate the standardized rates of Italy and Europe with every standard population given to run_pipeline
+    (by default ESP2013 from the data folder, ESP1976, WHO 2000, Segi and the observed EU27 population of the run, summed over the years)
+    with a single matrix product (see standardize_rates.final_standards), and to save them in output_dir/Table_Results_Standards.csv
+    Returns the df with the results
+    """
+    load = context["load"]
+    cube = rate_cube.rate_cube(load["df_deaths"], load["df_pop"], load["df_Pop_Std"], geos=[GEO_IT, GEO_EU], years=context["years"], sexes=context["sexes"])
+    standards = context["standard_populations"]
+    if standards is None:
+        standards = default_standards(cube, load["df_Pop_Std"])
+    df_standards = final_standards(cube, GEO_IT, GEO_EU, standards)
+    df_standards.to_csv(context["output_dir"] / "Table_Results_Standards.csv", index=False)
+    print(f"Standardized rates with {len(standards)} standard populations completed")
+    return df_standards
+
+def _write_table(context, name, df_table, caption, message):
+    """
+    Function used to write a result table in every table_format given to run_pipeline (see tables.write_table)
+    A file is skipped when the table, the caption and the code of tables.py didn't change since it was written (see artifacts.py),
+    message is printed only when at least one file is written
+    Returns a tuple (name, table, title) used by the render stage for the image of the table
+    """
+    output_dir = context["output_dir"]
+    manifest, code, entries, skipped = read_manifest(output_dir), code_fingerprint(tables), {}, []
+    for table_format in context["table_formats"]:
+        file = f"{name}.{table_format}"
+        key = fingerprint(code, df_table, caption, table_format)
+        if is_current(manifest, output_dir, file, key):
+            skipped.append(file)
+            continue
+        write_table(df_table, output_dir / file, caption=caption)
+        entries[file] = {"fingerprint": key, "files": [file]}
+    update_manifest(output_dir, entries)
+    if skipped:
+        print(f"{', '.join(skipped)} up to date")
+    if entries:
+        print(message)
+    return name, df_table, caption
+
+def stage_table_results(context):
+    """
+    Stage used to write the table with the final df with raw and standardized mortality rate per years, sex and country (see tables.results_table)
+    """
+    return _write_table(context, "Table_Results", results_table(context["final"]), "Raw and standardized mortality rates (per 100.000)",
+                        "Table 1 created, standardized and raw rates for Italy and Europe stratified by sex and year")
+
+def stage_table_sensitivity(context):
+    """
+    Stage used to write the table with raw and standardized mortality rate per years, sex and country for EU and EU without Italy (see tables.sensitivity_table)
+    """
+    return _write_table(context, "Table_Results_Sens", sensitivity_table(context["sensitivity"], context["final"]), "Raw and standardized mortality rates (per 100.000)",
+                        "Table 2 created, sensitivity analysis results")
+
+def stage_table_kitagawa(context):
+    """
+    Stage used to write the table with the Kitagawa decomposition (see tables.kitagawa_table)
+    """
+    return _write_table(context, "Table_Results_Kit", kitagawa_table(context["kitagawa"]), None, "Table 3 created, Kitagawa decomposition results")
+
+def stage_store(context):
+    """
+    Stage used to save the results computed by the run (final, sensitivity, kitagawa and standards) in the SQLite store given to run_pipeline,
+    with the vintage of the input files read by the load stage (see results_store.data_vintage) and the fingerprint of the code, in a single transaction
+    Nothing is saved if no store is given
+    Returns the run_id of the run in the store
+    """
+    if context["store_path"] is None:
+        return None
+    computed = {name: context[name] for name in ["final", "sensitivity", "kitagawa", "standards"] if name in context}
+    if not computed:
+        print("No results to save in the store")
+        return None
+    vintage = data_vintage(context["load"]["paths"])
+    code = code_fingerprint(utility, rate_cube, standardize_rates, sensitivity_analysis, kitagawa_deco, sys.modules[__name__])
+    run_id = save_results(context["store_path"], tidy_pipeline(computed, GEO_IT, GEO_EU), vintage, code=code,
+                          settings={"years": context["years"], "sexes": context["sexes"], "stages": list(computed)})
+    print(f"Results saved in {context['store_path']} (run {run_id}, data vintage {vintage})")
+    return run_id
+
+def stage_render(context):
+    """
+    Stage used to create graphs and images of the tables in a pool of processes (see plots.render), in the format and with the dpi given to run_pipeline
+    It's the only stage that uses matplotlib, a run without it (see analysis.py --no-render) never imports matplotlib
+    Graphs 1 and 2 need both sexes (M and F), graphs 3 and 4 the total (Tot): the graphs whose sexes are not in the run are skipped
+    Every graph and image is skipped when its inputs, format, dpi and the plotting code didn't change since it was created and its files exist,
+    with the fingerprints saved in the manifest of the output folder (see artifacts.py)
+    Returns the list of the files created
+    """
+    output_dir, fmt, dpi = context["output_dir"], context["fmt"], context["dpi"]
+    df_final = context["final"]
+    sexes = set(context["sexes"])
+    # every graph gets only the rows it draws, so a change in the other sexes doesn't create it again
+    df_sexes, df_tot = df_final.loc[df_final["Sex"].isin(["M", "F"])], df_final.loc[df_final["Sex"] == "Tot"]
+    df_age = [context["rates"][year, "Tot"] for year in context["years"]] if "Tot" in sexes else []
+    jobs = []
+    if {"M", "F"} <= sexes:
+        jobs += [
+            # "standardized rate: italy vs europe" graph
+            (graph_1, (df_sexes,), {"save_path": output_dir / f"Standardized_rates_Italy_vs_Europe.{fmt}"}, "Graph 1 created, standardized rates: Italy vs Europe"),
+            # "raw rates: italy vs europe" graph
+            (graph_2, (df_sexes,), {"save_path": output_dir / f"Raw_rates_Italy_vs_Europe.{fmt}"}, "Graph 2 created, raw rates: Italy vs Europe")]
+    if "Tot" in sexes:
+        jobs += [
+            # "standardized rates: italy vs europe age distribution" graph
+            (graph_3, tuple(df_age), {"save_path": output_dir / f"Age_distribution.{fmt}"}, "Graph 3 created, age distribution"),
+            # "bar graphs: standardized rates vs raw rates each year in italy and europe" graph
+            (graph_4, (df_tot,), {"save_path": output_dir / f"Raw_vs_Std.{fmt}"}, "Graph 4 created, standardized rates vs raw rates")]
+    if context["table_images"]:
+        # the images of the tables are optional, the other formats are written by the table stages
+        jobs += [(table_image, (df_table,), {"save_path": output_dir / f"{name}.{fmt}", "title": caption}, f"Image of {name} created")
+                 for name, df_table, caption in [context[stage] for stage in table_stages]]
+    manifest, code = read_manifest(output_dir), code_fingerprint(plots)
+    pending = []
+    for function, args, kwargs, message in jobs:
+        name = Path(kwargs["save_path"]).name
+        key = fingerprint(code, function.__name__, dpi, *args, name, kwargs.get("title"))
+        if not is_current(manifest, output_dir, name, key):
+            pending.append((function, args, kwargs, message, name, key))
+    results = render([(function, args, {**kwargs, "dpi": dpi}) for function, args, kwargs, *_ in pending], processes=context["jobs"])
+    entries = {}
+    for (function, args, kwargs, message, name, key), result in zip(pending, results):
+        # table_image returns the paths of its pages, the graphs are saved in save_path
+        files = [Path(path).name for path in result] if result else [name]
+        entries[name] = {"fingerprint": key, "files": files}
+        print(message)
+    update_manifest(output_dir, entries)
+    if len(pending) < len(jobs):
+        print(f"{len(jobs) - len(pending)} graphs and images of the tables are up to date")
+    return [file for entry in entries.values() for file in entry["files"]]
+
+# graph of the stages: every stage receives the results of its dependencies in the context
+STAGES = {"load": {"deps": [], "run": stage_load},
+          "rates": {"deps": ["load"], "run": stage_rates, "strata": True},
+          "final": {"deps": ["rates"], "run": stage_final, "strata": True},
+          "sensitivity": {"deps": ["load"], "run": stage_sensitivity, "strata": True},
+          "kitagawa": {"deps": ["rates"], "run": stage_kitagawa, "strata": True},
+          "standards": {"deps": ["load"], "run": stage_standards},
+          "table_results": {"deps": ["final"], "run": stage_table_results, "output": True},
+          "table_sensitivity": {"deps": ["final", "sensitivity"], "run": stage_table_sensitivity, "output": True},
+          "table_kitagawa": {"deps": ["kitagawa"], "run": stage_table_kitagawa, "output": True},
+          "store": {"deps": ["load"], "run": stage_store, "output": True, "last": True},
+          "render": {"deps": ["rates", "final", "table_results", "table_sensitivity", "table_kitagawa"], "run": stage_render}}
+# stages that write the result tables, their images are created by the render stage
+table_stages = ["table_results", "table_sensitivity", "table_kitagawa"]
+# stages that don't need matplotlib (all the stages except render)
+COMPUTE_STAGES = [name for name in STAGES if name != "render"]
+
+def stage_order(stages=STAGES, targets=None):
+    """
+    Function used to sort the stages so that every stage comes after its dependencies
+    If targets is given only the targets and the stages they depend on are returned, with the output stages (e.g. the tables)
+    whose dependencies are all among them, so that the results of the stages that run are written
+    The stages with "last" (the store, which saves the results of all the other stages) are moved to the end, whatever the order of targets
+    Returns a list with the names of the stages
+    """
+    order = []
+    def visit(name, path=()):
+        if name in path:
+            raise ValueError(f"Cycle found in the stages: {' -> '.join(path + (name,))}")
+        if name in order:
+            return
+        for dep in stages[name]["deps"]:
+            visit(dep, path + (name,))
+        order.append(name)
+    for name in (stages if targets is None else targets):
+        if name not in stages:
+            raise ValueError(f"Unknown stage: {name}")
+        visit(name)
+    for name, stage in stages.items():
+        if stage.get("output") and name not in order and all(dep in order for dep in stage["deps"]):
+            order.append(name)
+    return [name for name in order if not stages[name].get("last")] + [name for name in order if stages[name].get("last")]
+
+def plan_pipeline(context, order, stages=STAGES):
+    """
+    Function used to print the planned work without running it: the input files are read (load stage) to find, for every stage
+    with results saved by stratum, how many strata have to be recalculated
+    Returns a list of dicts with Stage, Dependencies, Strata and Recalculated
+    """
+    load = stage_load(context)
+    plan = []
+    for name in order:
+        row = {"Stage": name, "Dependencies": ", ".join(stages[name]["deps"]), "Strata": None, "Recalculated": None}
+        if stages[name].get("strata"):
+            paths = strata_paths(context["state_dir"], name, load["fingerprints"])
+            row["Strata"], row["Recalculated"] = len(paths), sum(not path.exists() for path in paths.values())
+        plan.append(row)
+    print(pd.DataFrame([{key: "" if value is None else value for key, value in row.items()} for row in plan]).to_string(index=False))
+    return plan
+
+def run_pipeline(data_dir, output_dir, years=None, sexes=("Tot", "M", "F"), targets=None, stages=STAGES, fmt="png", dpi=300, jobs=None,
+                 table_formats=("csv",), table_images=True, report=False, trace_memory=False, profile=None, standards=None, store=None, dry_run=False):
+    """
+    Function used to run the stages of the analysis in order of dependency
+    years can be any list of years (all the years found in the deaths files if None)
+    fmt (png, svg, pdf) and dpi are used for graphs and images of the tables, jobs is the number of processes used to create them (all the CPUs if None)
+    table_formats are the formats of the tables written without rendering (csv, html, tex, md), table_images=False skips the images of the tables
+    If report is True every stage and every group of recalculated strata is measured (see instrument.py) and the records are saved in
+    output_dir/run_report.json and output_dir/run_report.csv; trace_memory adds the peaks of tracemalloc, profile is the name of a stage
+    (or of a block like "final_strata") to run under cProfile, with the stats saved in output_dir/profile_<name>.prof
+    standards are the standard populations used by the standards stage (see standard_populations.standards_matrix), the default ones if None
+    store is the path of a SQLite database (see results_store.py) where the results of the run are saved, nothing is saved if None
+    The results of every (year, sex) stratum are saved in output_dir/.state and reused while the inputs of the stratum don't change
+    With dry_run=True the stages are not run: the planned work is printed (see plan_pipeline) and nothing is written in output_dir
+    Returns the context with the results of every stage
+    """
+    output_dir = Path(output_dir)
+    state_dir = output_dir / ".state"
+    context = {"data_dir": Path(data_dir), "output_dir": output_dir, "state_dir": state_dir,
+               "years": None if years is None else sorted(years), "sexes": list(sexes),
+               "fmt": fmt, "dpi": dpi, "jobs": jobs, "table_formats": list(table_formats), "table_images": table_images, "standard_populations": standards,
+               "store_path": None if store is None else Path(store)}
+    if dry_run:
+        context["plan"] = plan_pipeline(context, stage_order(stages, targets), stages)
+        return context
+    state_dir.mkdir(parents=True, exist_ok=True)
+    if report:
+        enable_instrumentation(trace_memory=trace_memory, profile=profile, profile_dir=output_dir)
+    try:
+        for name in stage_order(stages, targets):
+            context[name] = instrumented(name, kind="stage")(stages[name]["run"])(context)
+        if report:
+            json_path, csv_path = write_report(output_dir)
+            print(f"Run report saved in {json_path} and {csv_path}")
+    finally:
+        if report:
+            disable_instrumentation()
+    return context
@@ -1,15 +1,34 @@
 # functions to create plots for the paper
 
 import pandas as pd
-import matplotlib.pyplot as plt
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from utility import age_codes
+from tables import results_table, sensitivity_table, kitagawa_table, write_table
+from artifacts import atomic_path
+
+def _figure(**kwargs):
+    """
+    Function used to create a matplotlib Figure, matplotlib is imported the first time a graph or a table is drawn,
+    so the modules that import plots (e.g. pipeline.py) don't load it when nothing is rendered
+    """
+    from matplotlib.figure import Figure
+    return Figure(**kwargs)
+
+def _save(fig, save_path, dpi):
+    """
+    Function used to save a figure atomically (see artifacts.atomic_path), the format is given by the extension of save_path
+    """
+    with atomic_path(save_path) as temp_path:
+        fig.savefig(temp_path, dpi=dpi)
 
 """
 Creating the graphs
 """
-def graph_1(df, save_path=None):
+def graph_1(df, save_path=None, dpi=300):
     """
-    Graph 1 - standardized rates: italy vs europe from 2020 to 2022.
+    Graph 1 - standardized rates: italy vs europe for every year in the df.
     """
     df_final_m = df.loc[df["Sex"]== "M"]
     df_final_f = df.loc[df["Sex"]== "F"]
@@ -28,7 +47,8 @@ def graph_1(df, save_path=None):
     assert (df["95% CI upper It Std"] >= df["Std It"]).all(), "Upper CI lower than Std It"
     assert (df["95% CI upper EU Std"] >= df["Std EU"]).all(), "Upper CI lower than Std EU"
     assert set(df_final_m["Year"].unique()) == set(df_final_f["Year"].unique()), "Differente years between males and females"
-    fig, ax = plt.subplots(figsize=(10, 6))
+    fig = _figure(figsize=(10, 6))
+    ax = fig.subplots()
     ax.errorbar(years, rate_std_it_m, label = "Italy-M", marker=".", yerr=[df_final_m["Std It"] - df_final_m["95% CI lower It Std"], df_final_m["95% CI upper It Std"] - df_final_m["Std It"]], capsize=5)
     ax.errorbar(years, rate_std_it_f, label = "Italy-F", marker=".", yerr=[df_final_f["Std It"] - df_final_f["95% CI lower It Std"], df_final_f["95% CI upper It Std"] - df_final_f["Std It"]], capsize=5)
     ax.errorbar(years, rate_std_eu_m, label = "Europe-M", marker=".", yerr=[df_final_m["Std EU"] - df_final_m["95% CI lower EU Std"], df_final_m["95% CI upper EU Std"] - df_final_m["Std EU"]], capsize=5)
@@ -39,12 +59,11 @@ def graph_1(df, save_path=None):
     ax.set_ylabel("Standardized rate (per 100.000)")
     ax.legend(loc="upper right", fontsize=9, framealpha=0.5)
     if save_path:
-        fig.savefig(save_path, dpi=300)
-    plt.close(fig)
+        _save(fig, save_path, dpi)
 
-def graph_2(df, save_path=None):
+def graph_2(df, save_path=None, dpi=300):
     """
-    Graph 2 - raw rates: italy vs europe from 2020 to 2022.
+    Graph 2 - raw rates: italy vs europe for every year in the df.
     """
     df_final_m = df.loc[df["Sex"] == "M"]
     df_final_f = df.loc[df["Sex"] == "F"]
@@ -63,7 +82,8 @@ def graph_2(df, save_path=None):
     assert (df["95% CI upper It Crude"] >= df["Crude It"]).all(), "Upper CI lower than Crude It"
     assert (df["95% CI upper EU Crude"] >= df["Crude EU"]).all(), "Upper CI lower than Crude EU"
     assert set(df_final_m["Year"].unique()) == set(df_final_f["Year"].unique()), "Differente years between males and females"
-    fig, ax = plt.subplots(figsize=(10, 6))
+    fig = _figure(figsize=(10, 6))
+    ax = fig.subplots()
     ax.errorbar(years, rate_raw_it_m, label = "Italy-M", marker=".", yerr=[df_final_m["Crude It"] - df_final_m["95% CI lower It Crude"], df_final_m["95% CI upper It Crude"] - df_final_m["Crude It"]], capsize=5)
     ax.errorbar(years, rate_raw_it_f, label = "Italy-F", marker=".", yerr=[df_final_f["Crude It"] - df_final_f["95% CI lower It Crude"], df_final_f["95% CI upper It Crude"] - df_final_f["Crude It"]], capsize=5)
     ax.errorbar(years, rate_raw_eu_m, label = "Europe-M", marker=".", yerr=[df_final_m["Crude EU"] - df_final_m["95% CI lower EU Crude"], df_final_m["95% CI upper EU Crude"] - df_final_m["Crude EU"]], capsize=5)
@@ -74,90 +94,74 @@ def graph_2(df, save_path=None):
     ax.set_ylabel("Crude rate (per 100.000)")
     ax.legend(loc="upper right", fontsize=9, framealpha=0.5)
     if save_path:
-        fig.savefig(save_path, dpi=300)
-    plt.close(fig)
+        _save(fig, save_path, dpi)
 
-def graph_3(df, df1, df2, save_path=None):
+def graph_3(*dfs, save_path=None, dpi=300, panels_per_page=6):
     """
     Graph 3 - standardized rates: italy vs europe age distribution.
+    It takes one df for each year (e.g. 2020, 2021 and 2022), each one in the format of standardize_rates.expected_deaths_year, and creates one panel for each year.
+    The panels are split in pages of panels_per_page panels, so the size of every image doesn't depend on the number of years:
+    the first page is saved in save_path and the others in save_path with the number of the page (e.g. Age_distribution_2.png), like table_image
+    Returns the list of the paths of the pages (empty if save_path is not given)
     """
-    ratio_it_tot_2020 = df["Ratio_Exp_It_on_Std"].values.tolist()
-    ratio_eu_tot_2020 = df["Ratio_Exp_EU_on_Std"].values.tolist()
-    ratio_it_tot_2021 = df1["Ratio_Exp_It_on_Std"].values.tolist()
-    ratio_eu_tot_2021 = df1["Ratio_Exp_EU_on_Std"].values.tolist()
-    ratio_it_tot_2022 = df2["Ratio_Exp_It_on_Std"].values.tolist()
-    ratio_eu_tot_2022 = df2["Ratio_Exp_EU_on_Std"].values.tolist()
-    ages = [0, 5, 10, 15, 20, 25, 30, 35, 40, 45, 50, 55, 60, 65, 70, 75, 80, 85, 90, 95, 100]
-    for column in ["Age", "Year", "Ratio_Exp_It_on_Std", "Ratio_Exp_EU_on_Std"]:
-        if column not in df.columns:
-            raise ValueError(f"Required column missing: {column}")
-    for column in ["Ratio_Exp_It_on_Std", "Ratio_Exp_EU_on_Std"]:
-        assert (df[column]>=0).all(), f"Negative rates found: {column}"
-    fig, axs = plt.subplots(1, 3, figsize=(20, 8))
-    axs[0].plot(ratio_it_tot_2020, label="Italy")
-    axs[0].plot(ratio_eu_tot_2020, label="Europe")
-    axs[0].set_xticks(np.arange(len(ages)))
-    axs[0].set_xticklabels(ages)
-    axs[0].set_xlabel("Age")
-    axs[0].set_ylabel("Age-Specific rate")
-    axs[0].set_title("2020")
-    axs[0].legend(loc="upper left", fontsize=9, framealpha=0.5)
-    axs[1].plot(ratio_it_tot_2021, label="Italy")
-    axs[1].plot(ratio_eu_tot_2021, label="Europe")
-    axs[1].set_xticks(np.arange(len(ages)))
-    axs[1].set_xticklabels(ages)
-    axs[1].set_xlabel("Age")
-    axs[1].set_ylabel("Age-Specific rate")
-    axs[1].set_title("2021")
-    axs[1].legend(loc="upper left", fontsize=9, framealpha=0.5)
-    axs[2].plot(ratio_it_tot_2022, label="Italy")
-    axs[2].plot(ratio_eu_tot_2022, label="Europe")
-    axs[2].set_xticks(np.arange(len(ages)))
-    axs[2].set_xticklabels(ages)
-    axs[2].set_xlabel("Age")
-    axs[2].set_ylabel("Age-Specific rate")
-    axs[2].set_title("2022")
-    axs[2].legend(loc="upper left", fontsize=9, framealpha=0.5)
-    if save_path:
-        fig.savefig(save_path, dpi=300)
-    plt.close(fig)
+    if not dfs:
+        raise ValueError("At least one df is needed")
+    for df in dfs:
+        for column in ["Age", "Year", "Ratio_Exp_It_on_Std", "Ratio_Exp_EU_on_Std"]:
+            if column not in df.columns:
+                raise ValueError(f"Required column missing: {column}")
+        for column in ["Ratio_Exp_It_on_Std", "Ratio_Exp_EU_on_Std"]:
+            assert (df[column]>=0).all(), f"Negative rates found: {column}"
+    pages = -(-len(dfs)//panels_per_page)
+    paths = []
+    for page in range(pages):
+        dfs_page = dfs[page*panels_per_page:(page + 1)*panels_per_page]
+        # 3 panels for each row
+        ncols = min(3, len(dfs_page))
+        nrows = int(np.ceil(len(dfs_page)/ncols))
+        fig = _figure(figsize=(20, 8*nrows))
+        axs = fig.subplots(nrows, ncols, squeeze=False)
+        for ax, df in zip(axs.ravel(), dfs_page):
+            # the rows are sorted by the codes of the age classes, so the order doesn't depend on the order of the rows in the df
+            df = df.iloc[np.argsort(age_codes(df["Age"]), kind="stable")]
+            ax.plot(df["Ratio_Exp_It_on_Std"].values.tolist(), label="Italy")
+            ax.plot(df["Ratio_Exp_EU_on_Std"].values.tolist(), label="Europe")
+            ax.set_xticks(np.arange(len(df)))
+            ax.set_xticklabels(df["Age"].astype(str), rotation=45)
+            ax.set_xlabel("Age")
+            ax.set_ylabel("Age-Specific rate")
+            ax.set_title(str(df["Year"].iloc[0]))
+            ax.legend(loc="upper left", fontsize=9, framealpha=0.5)
+        for ax in axs.ravel()[len(dfs_page):]:
+            ax.axis("off")
+        if save_path:
+            save_path = Path(save_path)
+            path = save_path if page == 0 else save_path.with_name(f"{save_path.stem}_{page + 1}{save_path.suffix}")
+            _save(fig, path, dpi)
+            paths.append(path)
+    return paths
 
-def graph_4(df, save_path=None):
+def graph_4(df, save_path=None, dpi=300):
     """
     Graph 4 - bar graphs: standardized rates vs raw rates each year in Italy and Europe.
     """
-    df_final_tot = df.loc[df["Sex"] == "Tot"]
-    df_final_tot_2020 = df_final_tot.loc[df_final_tot["Year"] == 2020]
-    df_final_tot_2021 = df_final_tot.loc[df_final_tot["Year"] == 2021]
-    df_final_tot_2022 = df_final_tot.loc[df_final_tot["Year"] == 2022]
-    rate_raw_it_2020 = float(df_final_tot_2020["Crude It"].iloc[0])
-    rate_raw_it_2021 = float(df_final_tot_2021["Crude It"].iloc[0])
-    rate_raw_it_2022 = float(df_final_tot_2022["Crude It"].iloc[0])
-    rate_std_it_2020 = float(df_final_tot_2020["Std It"].iloc[0])
-    rate_std_it_2021 = float(df_final_tot_2021["Std It"].iloc[0])
-    rate_std_it_2022 = float(df_final_tot_2022["Std It"].iloc[0])
-    rate_raw_eu_2020 = float(df_final_tot_2020["Crude EU"].iloc[0])
-    rate_raw_eu_2021 = float(df_final_tot_2021["Crude EU"].iloc[0])
-    rate_raw_eu_2022 = float(df_final_tot_2022["Crude EU"].iloc[0])
-    rate_std_eu_2020 = float(df_final_tot_2020["Std EU"].iloc[0])
-    rate_std_eu_2021 = float(df_final_tot_2021["Std EU"].iloc[0])
-    rate_std_eu_2022 = float(df_final_tot_2022["Std EU"].iloc[0])
+    df_final_tot = df.loc[df["Sex"] == "Tot"].sort_values("Year")
+    assert df_final_tot["Year"].is_unique, "More than one total row for the same year"
     years = df_final_tot["Year"].values.tolist()
-    italy = {"Raw Rate": [rate_raw_it_2020, rate_raw_it_2021, rate_raw_it_2022], "Standardized Rate": [rate_std_it_2020, rate_std_it_2021, rate_std_it_2022]}
-    europe = {"Raw Rate": [rate_raw_eu_2020, rate_raw_eu_2021, rate_raw_eu_2022], "Standardized Rate": [rate_std_eu_2020, rate_std_eu_2021, rate_std_eu_2022]}
-    df_italy = pd.DataFrame(data=italy)
-    df_europe = pd.DataFrame(data=europe)
-    fig, axs = plt.subplots(1, 2, figsize=(20, 8), layout="constrained")
+    df_italy = pd.DataFrame(data={"Raw Rate": df_final_tot["Crude It"].to_numpy(dtype=float), "Standardized Rate": df_final_tot["Std It"].to_numpy(dtype=float)})
+    df_europe = pd.DataFrame(data={"Raw Rate": df_final_tot["Crude EU"].to_numpy(dtype=float), "Standardized Rate": df_final_tot["Std EU"].to_numpy(dtype=float)})
+    fig = _figure(figsize=(20, 8), layout="constrained")
+    axs = fig.subplots(1, 2)
     section = np.arange(len(years))
     width = 0.25
     shift = 0
     for attribute, measurment in df_italy.items():
         if attribute == "Raw Rate":
-            lower = df_final_tot.loc[df_final_tot["Year"].isin(years), "95% CI lower It Crude"].values
-            upper = df_final_tot.loc[df_final_tot["Year"].isin(years), "95% CI upper It Crude"].values
+            lower = df_final_tot["95% CI lower It Crude"].values
+            upper = df_final_tot["95% CI upper It Crude"].values
         else:
-            lower = df_final_tot.loc[df_final_tot["Year"].isin(years), "95% CI lower It Std"].values
-            upper = df_final_tot.loc[df_final_tot["Year"].isin(years), "95% CI upper It Std"].values
+            lower = df_final_tot["95% CI lower It Std"].values
+            upper = df_final_tot["95% CI upper It Std"].values
         error_lower = measurment - lower
         error_upper = upper - measurment
         errors = [error_lower, error_upper]
@@ -173,11 +177,11 @@ def graph_4(df, save_path=None):
     shift = 0
     for attribute, measurment in df_europe.items():
         if attribute == "Raw Rate":
-            lower = df_final_tot.loc[df_final_tot["Year"].isin(years), "95% CI lower EU Crude"].values
-            upper = df_final_tot.loc[df_final_tot["Year"].isin(years), "95% CI upper EU Crude"].values
+            lower = df_final_tot["95% CI lower EU Crude"].values
+            upper = df_final_tot["95% CI upper EU Crude"].values
         else:
-            lower = df_final_tot.loc[df_final_tot["Year"].isin(years), "95% CI lower EU Std"].values
-            upper = df_final_tot.loc[df_final_tot["Year"].isin(years), "95% CI upper EU Std"].values
+            lower = df_final_tot["95% CI lower EU Std"].values
+            upper = df_final_tot["95% CI upper EU Std"].values
         error_lower = measurment - lower
         error_upper = upper - measurment
         errors = [error_lower, error_upper]
@@ -191,167 +195,98 @@ def graph_4(df, save_path=None):
     axs[1].set_xticks(section + width/2, years)
     axs[1].legend(loc="upper right")
     if save_path:
-        fig.savefig(save_path, dpi=300)
-    plt.close(fig)
+        _save(fig, save_path, dpi)
 
-def table_1(df, save_path=None, csv_path=None):
+"""
+Creating the tables
+"""
+def table_image(df_table, save_path, title=None, dpi=300, rows_per_page=40):
     """
-    Table 1 - raw and standardized mortality rate per years, sex and country.
+    Function used to draw a table in one or more images, with rows_per_page rows in each page
+    The width of every column depends on its longest text and the height of the figure on the rows of the page, so tables of any size can be drawn
+    The first page is saved in save_path and the others in save_path with the number of the page (e.g. Table_Results_2.png)
+    Returns the list of the paths of the pages
     """
-    df["Crude It"] = df["Crude It"].round(2)
-    df["Std It"] = df["Std It"].round(2)
-    df["Crude EU"] = df["Crude EU"].round(2)
-    df["Std EU"] = df["Std EU"].round(2)
-    df["95% CI lower It Crude"] = df["95% CI lower It Crude"].round(2)
-    df["95% CI lower EU Crude"] = df["95% CI lower EU Crude"].round(2)
-    df["95% CI lower It Std"] = df["95% CI lower It Std"].round(2)
-    df["95% CI lower EU Std"] = df["95% CI lower EU Std"].round(2)
-    df["95% CI upper It Crude"] = df["95% CI upper It Crude"].round(2)
-    df["95% CI upper EU Crude"] = df["95% CI upper EU Crude"].round(2)
-    df["95% CI upper It Std"] = df["95% CI upper It Std"].round(2)
-    df["95% CI upper EU Std"] = df["95% CI upper EU Std"].round(2)
-    base_table = {"Year": df["Year"], "Sex": df["Sex"], 
-                  "Crude Rate It (95% CI)": df["Crude It"].astype(str)+" ("+df["95% CI lower It Crude"].astype(str)+"-"+df["95% CI upper It Crude"].astype(str)+")", 
-                  "Crude Rate EU (95% CI)": df["Crude EU"].astype(str)+" ("+df["95% CI lower EU Crude"].astype(str)+"-"+df["95% CI upper EU Crude"].astype(str)+")",
-                  "Std Rate It (95% CI)": df["Std It"].astype(str) + " ("+df["95% CI lower It Std"].astype(str) + "-"+ df["95% CI upper It Std"].astype(str) + ")",
-                  "Std Rate EU (95% CI)": df["Std EU"].astype(str)+" ("+df["95% CI lower EU Std"].astype(str)+"-"+df["95% CI upper EU Std"].astype(str)+")"}
-    df_table = pd.DataFrame(base_table)
-    for column in ["Year", "Sex", "Std It", "Std EU", "Crude It", "Crude EU", "95% CI lower It Std", "95% CI upper It Std", "95% CI lower EU Std", "95% CI upper EU Std", "95% CI lower It Crude", "95% CI upper It Crude", "95% CI lower EU Crude", "95% CI upper EU Crude"]:
-        if column not in df.columns:
-            raise ValueError(f"Required column missing: {column}")
-    for column in ["Std It", "Std EU", "Crude It", "Crude EU", "95% CI lower It Std", "95% CI upper It Std", "95% CI lower EU Std", "95% CI upper EU Std", "95% CI lower It Crude", "95% CI upper It Crude", "95% CI lower EU Crude", "95% CI upper EU Crude"]:
-        assert (df[column]>=0).all(), f"Negative values found: {column}"
-    assert (df["95% CI lower It Std"] <= df["Std It"]).all(), "Lower CI bigger than Std It"
-    assert (df["95% CI lower EU Std"] <= df["Std EU"]).all(), "Lower CI bigger than Std EU"
-    assert (df["95% CI upper It Std"] >= df["Std It"]).all(), "Upper CI lower than Std It"
-    assert (df["95% CI upper EU Std"] >= df["Std EU"]).all(), "Upper CI lower than Std EU"
-    assert (df["95% CI lower It Crude"] <= df["Crude It"]).all(), "Lower CI bigger than Crude It"
-    assert (df["95% CI lower EU Crude"] <= df["Crude EU"]).all(), "Lower CI bigger than Crude EU"
-    assert (df["95% CI upper It Crude"] >= df["Crude It"]).all(), "Upper CI lower than Crude It"
-    assert (df["95% CI upper EU Crude"] >= df["Crude EU"]).all(), "Upper CI lower than Crude EU"
-    fig, ax = plt.subplots(figsize=(12, 4))
-    ax.axis("off")
-    table = ax.table(cellText=df_table.values, colLabels=df_table.columns, loc="center", cellLoc="center")
-    table.scale(1.25, 1)
-    cellDict=table.get_celld()
-    numbers = range(10)
-    for i in numbers:
-        cellDict[(i,0)].set_width(0.075)
-        cellDict[(i, 1)].set_width(0.05)
-        cellDict[(i,2)].set_width(0.225)
-        cellDict[(i, 3)].set_width(0.225)
-        cellDict[(i,4)].set_width(0.225)
-        cellDict[(i,5)].set_width(0.225)
-    table.auto_set_font_size(False)
-    table.set_fontsize(10)
-    for key, cell in table.get_celld().items():
-        if key[0]==0:
-            cell.set_fontsize(10)
-            cell.set_text_props(weight="bold")
-            cell.set_facecolor("#f0f0f0")
-    plt.title("Raw and standardized mortality rates (per 100.000)", loc="center")
+    save_path = Path(save_path)
+    header = [str(column) for column in df_table.columns]
+    cells = df_table.to_numpy().astype(str)
+    # characters of the longest text of every column (header included)
+    lengths = np.maximum([len(column) for column in header], np.strings.str_len(cells).max(axis=0) if len(cells) else 0)
+    widths = lengths/lengths.sum()
+    pages = max(1, -(-len(cells)//rows_per_page))
+    paths = []
+    for page in range(pages):
+        rows = cells[page*rows_per_page:(page + 1)*rows_per_page]
+        fig = _figure(figsize=(max(6, 0.11*lengths.sum() + 1), 0.3*(len(rows) + 1) + (0.8 if title else 0.4)))
+        ax = fig.subplots()
+        ax.axis("off")
+        table = ax.table(cellText=rows if len(rows) else None, colLabels=header, colWidths=widths, cellLoc="center", bbox=[0, 0, 1, 1])
+        table.auto_set_font_size(False)
+        table.set_fontsize(10)
+        for (row, column), cell in table.get_celld().items():
+            if row == 0:
+                cell.set_text_props(weight="bold")
+                cell.set_facecolor("#f0f0f0")
+        if title:
+            ax.set_title(title if pages == 1 else f"{title} ({page + 1}/{pages})", loc="center")
+        fig.tight_layout()
+        path = save_path if page == 0 else save_path.with_name(f"{save_path.stem}_{page + 1}{save_path.suffix}")
+        _save(fig, path, dpi)
+        paths.append(path)
+    return paths
+
+def table_1(df, save_path=None, csv_path=None, dpi=300):
+    """
+    Table 1 - raw and standardized mortality rate per years, sex and country (see tables.results_table), df is not modified.
+    """
+    df_table = results_table(df)
     if save_path:
-        fig.savefig(save_path, dpi=300)
+        table_image(df_table, save_path, title="Raw and standardized mortality rates (per 100.000)", dpi=dpi)
     if csv_path:
-        df_table.to_csv(csv_path, index=False)
-    plt.close(fig)
+        write_table(df_table, csv_path)
 
-def table_2(df, df1, save_path=None, csv_path=None):
+def table_2(df, df1, save_path=None, csv_path=None, dpi=300):
     """
-    Table 2 - raw and standardized mortality rate per years, sex and country for the sensitivity analysis.
+    Table 2 - raw and standardized mortality rate per years, sex and country for the sensitivity analysis (see tables.sensitivity_table), df and df1 are not modified.
     """
-    df["Crude EU-It"] = df["Crude EU-It"].round(2)
-    df["Std EU-It"] = df["Std EU-It"].round(2)
-    df1["Crude EU"] = df1["Crude EU"].round(2)
-    df1["Std EU"] = df1["Std EU"].round(2)
-    df["95% CI lower EU-It Crude"] = df["95% CI lower EU-It Crude"].round(2)
-    df1["95% CI lower EU Crude"] = df1["95% CI lower EU Crude"].round(2)
-    df["95% CI lower EU-It Std"] = df["95% CI lower EU-It Std"].round(2)
-    df1["95% CI lower EU Std"] = df1["95% CI lower EU Std"].round(2)
-    df["95% CI upper EU-It Crude"] = df["95% CI upper EU-It Crude"].round(2)
-    df1["95% CI upper EU Crude"] = df1["95% CI upper EU Crude"].round(2)
-    df["95% CI upper EU-It Std"] = df["95% CI upper EU-It Std"].round(2)
-    df1["95% CI upper EU Std"] = df1["95% CI upper EU Std"].round(2)
-    base_table = {"Year": df["Year"], "Sex": df["Sex"], 
-                  "Crude Rate EU (95% CI)": df1["Crude EU"].astype(str)+" ("+df1["95% CI lower EU Crude"].astype(str)+"-"+df1["95% CI upper EU Crude"].astype(str)+")", 
-                  "Crude Rate EU-It (95% CI)": df["Crude EU-It"].astype(str)+" ("+df["95% CI lower EU-It Crude"].astype(str)+"-"+df["95% CI upper EU-It Crude"].astype(str)+")",
-                  "Std Rate EU (95% CI)": df1["Std EU"].astype(str) + " ("+df1["95% CI lower EU Std"].astype(str) + "-"+ df1["95% CI upper EU Std"].astype(str) + ")",
-                  "Std Rate EU-It (95% CI)": df["Std EU-It"].astype(str)+" ("+df["95% CI lower EU-It Std"].astype(str)+"-"+df["95% CI upper EU-It Std"].astype(str)+")"}
-    df_table = pd.DataFrame(base_table)
-    for column in ["Year", "Sex", "Crude Rate EU (95% CI)", "Crude Rate EU-It (95% CI)", "Std Rate EU (95% CI)", "Std Rate EU-It (95% CI)"]:
-        if column not in df_table.columns:
-            raise ValueError(f"Required column missing: {column}")
-    for column in ["Std EU-It", "Crude EU-It", "95% CI lower EU-It Std", "95% CI upper EU-It Std", "95% CI lower EU-It Crude", "95% CI upper EU-It Crude"]:
-        assert (df[column]>=0).all(), f"Negative values found: {column}"
-    for column in ["Std EU", "Crude EU", "95% CI lower EU Std", "95% CI upper EU Std", "95% CI lower EU Crude", "95% CI upper EU Crude"]:
-        assert (df1[column]>=0).all(), f"Negative values found: {column}"
-    assert (df1["95% CI lower EU Std"] <= df1["Std EU"]).all(), "Lower CI bigger than Std EU"
-    assert (df["95% CI lower EU-It Std"] <= df["Std EU-It"]).all(), "Lower CI bigger than Std EU-It"
-    assert (df1["95% CI upper EU Std"] >= df1["Std EU"]).all(), "Upper CI lower than Std EU"
-    assert (df["95% CI upper EU-It Std"] >= df["Std EU-It"]).all(), "Upper CI lower than Std EU-It"
-    assert (df1["95% CI lower EU Crude"] <= df1["Crude EU"]).all(), "Lower CI bigger than Crude EU"
-    assert (df["95% CI lower EU-It Crude"] <= df["Crude EU-It"]).all(), "Lower CI bigger than Crude EU-It"
-    assert (df1["95% CI upper EU Crude"] >= df1["Crude EU"]).all(), "Upper CI lower than Crude EU"
-    assert (df["95% CI upper EU-It Crude"] >= df["Crude EU-It"]).all(), "Upper CI lower than Crude EU-It"
-    fig, ax = plt.subplots(figsize=(12, 4))
-    ax.axis("off")
-    table = ax.table(cellText=df_table.values, colLabels=df_table.columns, loc="center", cellLoc="center")
-    table.scale(1.25, 1)
-    cellDict=table.get_celld()
-    numbers = range(10)
-    for i in numbers:
-        cellDict[(i,0)].set_width(0.075)
-        cellDict[(i, 1)].set_width(0.05)
-        cellDict[(i,2)].set_width(0.225)
-        cellDict[(i, 3)].set_width(0.225)
-        cellDict[(i,4)].set_width(0.225)
-        cellDict[(i,5)].set_width(0.225)
-    table.auto_set_font_size(False)
-    table.set_fontsize(10)
-    for key, cell in table.get_celld().items():
-        if key[0]==0:
-            cell.set_fontsize(10)
-            cell.set_text_props(weight="bold")
-            cell.set_facecolor("#f0f0f0")
-    plt.title("Raw and standardized mortality rates (per 100.000)", loc="center")
+    df_table = sensitivity_table(df, df1)
     if save_path:
-        fig.savefig(save_path, dpi=300)
+        table_image(df_table, save_path, title="Raw and standardized mortality rates (per 100.000)", dpi=dpi)
     if csv_path:
-        df_table.to_csv(csv_path, index=False)
-    plt.close(fig)
+        write_table(df_table, csv_path)
 
-def table_3(df, save_path=None, csv_path=None):
+def table_3(df, save_path=None, csv_path=None, dpi=300):
     """
-    Table 3 - values of the Kitagawa decomposition.
+    Table 3 - values of the Kitagawa decomposition (see tables.kitagawa_table), df is not modified.
     """
-    df["Effect of Age Structure"] = df["Effect of Age Structure"].round(2)
-    df["Effect of Rates"] = df['Effect of Rates'].round(2)
-    df["Difference"] = df["Difference"].round(2)
-    for column in ["Year", "Sex", "Effect of Age Structure", "Effect of Rates", "Difference"]:
-        if column not in df.columns:
-            raise ValueError(f"Required column missing: {column}")
-    fig, ax = plt.subplots(figsize=(12, 4))
-    ax.axis("off")
-    table = ax.table(cellText=df.values, colLabels=df.columns, loc="center", cellLoc="center")
-    table.scale(1.25, 1)
-    cellDict=table.get_celld()
-    numbers = range(10)
-    for i in numbers:
-        cellDict[(i,0)].set_width(0.075)
-        cellDict[(i, 1)].set_width(0.05)
-        cellDict[(i,2)].set_width(0.225)
-        cellDict[(i, 3)].set_width(0.225)
-        cellDict[(i,4)].set_width(0.225)
-    table.auto_set_font_size(False)
-    table.set_fontsize(10)
-    for key, cell in table.get_celld().items():
-        if key[0]==0:
-            cell.set_fontsize(10)
-            cell.set_text_props(weight="bold")
-            cell.set_facecolor("#f0f0f0")
+    df_table = kitagawa_table(df)
     if save_path:
-        fig.savefig(save_path, dpi=300)
+        table_image(df_table, save_path, dpi=dpi)
     if csv_path:
-        df_table = pd.DataFrame(df)
-        df_table.to_csv(csv_path, index=False)
-    plt.close(fig)
+        write_table(df_table, csv_path)
+
+"""
+Rendering graphs and tables in parallel
+"""
+def _render_job(job):
+    """
+    Function used to run a single rendering job (function, args, kwargs) in a worker process
+    """
+    function, args, kwargs = job
+    return function(*args, **kwargs)
+
+def render(jobs, processes=None):
+    """
+    Function used to create many graphs and tables at once
+    jobs is a list of tuples (function, args, kwargs), e.g. (graph_1, (df_final,), {"save_path": "graph.svg", "dpi": 150}):
+    the format of each file is given by the extension of save_path (png, svg, pdf, ...)
+    The figures are built with the object-oriented Figure API (no pyplot global state), so they can be created in a pool of processes;
+    processes is the number of processes (all the CPUs if None), with processes=1 the jobs run one after another in this process
+    Returns the list of the results of the jobs, in the same order of jobs
+    """
+    if processes == 1 or len(jobs) <= 1:
+        return [_render_job(job) for job in jobs]
+    # matplotlib is imported before starting the pool, so the processes started with fork don't import it again
+    _figure()
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        return list(executor.map(_render_job, jobs))
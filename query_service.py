@@ -0,0 +1,189 @@
+# local HTTP service that answers queries on rates, CIs and Kitagawa effects from a cube loaded once in memory
+
+import argparse
+import functools
+import json
+import numpy as np
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import urlparse, parse_qs
+from cache import set_cache
+from rate_cube import rate_cube, crude_rates
+from standardize_rates import rates_ci_standards
+from standard_populations import standards_matrix
+from kitagawa_deco import kitagawa_all_pairs
+from pipeline import GEO_IT, GEO_EU, stage_load, default_standards
+
+# label of the EU27 without Italy, added to the geos of the cube
+GEO_EU_WITHOUT_IT = f"{GEO_EU}-{GEO_IT}"
+# alpha whose intervals are calculated when the service is loaded, other alphas are calculated on request and kept in an LRU cache
+default_alpha = 0.05
+# cube, standard populations and precomputed results, filled by load_service
+service_state = {"cube": None, "standards": None, "matrix": None, "intervals": None, "kitagawa": None}
+
+def load_service(data_dir, years=None, sexes=("Tot", "M", "F")):
+    """
+    Function used to read the input files once (through the cache of the loaders, see pipeline.stage_load) and to precompute, for every geo
+    (Italy, EU27 and EU27 without Italy), year and sex, the crude and standardized rates with CIs for all the default standard populations
+    (see pipeline.default_standards) and the Kitagawa decomposition of every geo against every other one
+    The results of previous loads kept in the LRU caches are cleared
+    Returns service_state
+    """
+    context = {"data_dir": Path(data_dir), "years": None if years is None else sorted(years), "sexes": list(sexes)}
+    load = stage_load(context)
+    cube = rate_cube(load["df_deaths"], load["df_pop"], load["df_Pop_Std"], geos=[GEO_IT, GEO_EU], years=context["years"], sexes=context["sexes"])
+    # EU27 without Italy, subtracting deaths and population on the whole cube
+    deaths = np.concatenate([cube["Deaths"], cube["Deaths"][1:2] - cube["Deaths"][0:1]])
+    population = np.concatenate([cube["Total"], cube["Total"][1:2] - cube["Total"][0:1]])
+    assert (deaths >= 0).all() and (population >= 0).all(), "Negative deaths or population found in EU27 without Italy"
+    cube = {**cube, "Geo": cube["Geo"] + [GEO_EU_WITHOUT_IT], "Deaths": deaths, "Total": population, "Death_Rate_per_100k": crude_rates(deaths, population)}
+    names, matrix = standards_matrix(default_standards(cube, load["df_Pop_Std"]), cube["Age"])
+    service_state.update({"cube": cube, "standards": names, "matrix": matrix, "kitagawa": kitagawa_all_pairs(cube)})
+    service_state["intervals"] = _compute_intervals(default_alpha)
+    _cached_intervals.cache_clear()
+    query.cache_clear()
+    return service_state
+
+def _compute_intervals(alpha):
+    """
+    Function used to calculate crude and standardized rates with CIs of every stratum and standard population with a single call (see standardize_rates.rates_ci_standards)
+    Returns a dict of arrays indexed by [geo, year, sex, standard]
+    """
+    cube = service_state["cube"]
+    return rates_ci_standards(cube["Deaths"], cube["Total"], service_state["matrix"], alpha)
+
+@functools.lru_cache(maxsize=32)
+def _cached_intervals(alpha):
+    """
+    Function used to keep the intervals of the alphas different from default_alpha in an LRU cache
+    """
+    return _compute_intervals(alpha)
+
+def intervals(alpha=default_alpha):
+    """
+    Function used to get the intervals of every stratum for an alpha: the precomputed ones for default_alpha, otherwise from the LRU cache
+    Returns a dict of arrays indexed by [geo, year, sex, standard]
+    """
+    if service_state["cube"] is None:
+        raise ValueError("The service is not loaded, call load_service first")
+    if not 0 < alpha < 1:
+        raise ValueError(f"alpha must be between 0 and 1: {alpha}")
+    return service_state["intervals"] if alpha == default_alpha else _cached_intervals(alpha)
+
+def _index(labels, value, name):
+    """
+    Function used to find the position of a label on an axis of the cube
+    """
+    if value not in labels:
+        raise ValueError(f"{name} not found: {value} (available: {', '.join(str(label) for label in labels)})")
+    return labels.index(value)
+
+@functools.lru_cache(maxsize=4096)
+def query(geo, year, sex, alpha=default_alpha, standard="ESP2013", reference=GEO_EU):
+    """
+    Function used to answer a query: crude and standardized rates (per 100k) of geo with their CIs at level 1-alpha on the standard population,
+    the rate ratio (Std of geo / Std of reference) and the Kitagawa decomposition of geo against reference
+    geo and reference can be IT, EU27_2020 or EU27_2020-IT (EU27 without Italy), standard one of the default standard populations
+    The answers are kept in an LRU cache, so the same query is answered without calculations (the returned dict must not be modified)
+    Returns a dict
+    """
+    cube = service_state["cube"]
+    if cube is None:
+        raise ValueError("The service is not loaded, call load_service first")
+    g, r = _index(cube["Geo"], geo, "Geo"), _index(cube["Geo"], reference, "Reference")
+    y, s = _index(cube["Year"], year, "Year"), _index(cube["Sex"], sex, "Sex")
+    k = _index(service_state["standards"], standard, "Standard")
+    ci = intervals(alpha)
+    kitagawa = service_state["kitagawa"]
+    level = f"{round(100*(1 - alpha), 2):g}%"
+    std, std_ref = float(ci["Std"][g, y, s, k]), float(ci["Std"][r, y, s, k])
+    structure_effect, rates_effect = float(kitagawa["Structure_Effect"][y, s, g, r]), float(kitagawa["Rates_Effect"][y, s, g, r])
+    return {"Geo": geo, "Year": year, "Sex": sex, "Reference": reference, "Standard": standard, "Level": level,
+            "Crude": float(ci["Crude"][g, y, s, k]), f"{level} CI lower Crude": float(ci["Crude lower"][g, y, s, k]), f"{level} CI upper Crude": float(ci["Crude upper"][g, y, s, k]),
+            "Std": std, f"{level} CI lower Std": float(ci["Std lower"][g, y, s, k]), f"{level} CI upper Std": float(ci["Std upper"][g, y, s, k]),
+            "Std Reference": std_ref, "Rate Ratio": std/std_ref if std_ref > 0 else None,
+            "Effect of Age Structure": structure_effect, "Effect of Rates": rates_effect, "Difference": structure_effect + rates_effect}
+
+def labels():
+    """
+    Function used to list the values accepted by query
+    Returns a dict
+    """
+    cube = service_state["cube"]
+    return {"Geo": cube["Geo"], "Year": [int(year) for year in cube["Year"]], "Sex": cube["Sex"], "Standard": service_state["standards"],
+            "Default alpha": default_alpha, "Cache": query.cache_info()._asdict()}
+
+def parse_query(parameters):
+    """
+    Function used to convert the parameters of the query string (e.g. geo=IT&year=2021&sex=F&alpha=0.1) in the arguments of query
+    Returns a dict
+    """
+    arguments = {name: values[-1] for name, values in parameters.items()}
+    unknown = set(arguments) - {"geo", "year", "sex", "alpha", "standard", "reference"}
+    if unknown:
+        raise ValueError(f"Unknown parameters: {', '.join(sorted(unknown))}")
+    for name in ["geo", "year", "sex"]:
+        if name not in arguments:
+            raise ValueError(f"Required parameter missing: {name}")
+    try:
+        arguments["year"] = int(arguments["year"])
+        if "alpha" in arguments:
+            arguments["alpha"] = float(arguments["alpha"])
+    except ValueError:
+        raise ValueError("year must be an integer and alpha a number")
+    return arguments
+
+class QueryHandler(BaseHTTPRequestHandler):
+    """
+    Handler of the requests: GET /rates?geo=...&year=...&sex=...[&alpha=...&standard=...&reference=...] and GET /labels, the answers are json
+    """
+    def do_GET(self):
+        url = urlparse(self.path)
+        try:
+            if url.path == "/rates":
+                status, answer = 200, query(**parse_query(parse_qs(url.query)))
+            elif url.path == "/labels":
+                status, answer = 200, labels()
+            else:
+                status, answer = 404, {"error": f"Unknown path: {url.path} (use /rates or /labels)"}
+        except ValueError as error:
+            status, answer = 400, {"error": str(error)}
+        body = json.dumps(answer).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # the requests are not logged, to keep the answers fast
+        pass
+
+def serve(data_dir=Path("data"), host="127.0.0.1", port=8000, years=None, sexes=("Tot", "M", "F")):
+    """
+    Function used to load the service and to answer the requests until the process is stopped (Ctrl+C)
+    """
+    load_service(data_dir, years=years, sexes=sexes)
+    server = ThreadingHTTPServer((host, port), QueryHandler)
+    print(f"Query service ready on http://{host}:{server.server_port} (e.g. /rates?geo=IT&year={service_state['cube']['Year'][-1]}&sex=F&alpha=0.1&reference={GEO_EU_WITHOUT_IT})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Local query service on the rates of the analysis")
+    parser.add_argument("--data", type=Path, default=Path("data"))
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--years", type=int, nargs="+", default=None)
+    parser.add_argument("--sexes", nargs="+", default=["Tot", "M", "F"])
+    args = parser.parse_args()
+    # the parsed input files are cached in data/.cache like in analysis.py
+    set_cache(args.data / ".cache")
+    serve(args.data, host=args.host, port=args.port, years=args.years, sexes=args.sexes)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+# functions to compute crude rates and expected deaths on a dense cube indexed by [geo, year, sex, age]
+
+import numpy as np
+import pandas as pd
+from utility import age_groups, age_dtype, age_codes
+
+def stack_strata(data):
+    """
+    Function used to stack dfs that refer to a single geo and sex into one long df
+    data must be a list of tuples (df, geo, sex), each df must have the columns Age and Year
+    Returns a long df with Geo, Year, Sex, Age and the other columns of the dfs
+    """
+    df_long = pd.concat([df.assign(Geo=geo, Sex=sex) for df, geo, sex in data], ignore_index=True)
+    columns = ["Geo", "Year", "Sex", "Age"]
+    return df_long[columns + [column for column in df_long.columns if column not in columns]]
+
+def build_cube(df, value, geos, years, sexes, ages=age_groups, causes=None):
+    """
+    Function used to align a long df into a dense array indexed by [geo, year, sex, age]
+    The df must have the columns Geo, Year, Sex, Age and the column named in value
+    Every row is placed with its position on each axis (the age classes by their codes, see utility.age_codes), without merges or a MultiIndex
+    If causes is a list, the df must also have the column Cause and the array has a leading cause axis: [cause, geo, year, sex, age]
+    Rows of geos, years, sexes, ages or causes not selected are ignored, cells not found in the df are filled with NaN
+    Returns an array with shape (len(geos), len(years), len(sexes), len(ages)), with (len(causes),) in front if causes is given
+    """
+    columns = ["Geo", "Year", "Sex", "Age", value] + ([] if causes is None else ["Cause"])
+    for column in columns:
+        if column not in df.columns:
+            raise ValueError(f"Required column missing: {column}")
+    shape = (len(geos), len(years), len(sexes), len(ages))
+    # position of every age class of age_groups in ages (-1 if not selected)
+    age_position = pd.Index(list(ages)).get_indexer(age_groups)
+    positions = (pd.Index(list(geos)).get_indexer(df["Geo"]), pd.Index(list(years)).get_indexer(df["Year"]),
+                 pd.Index(list(sexes)).get_indexer(df["Sex"]), age_position[age_codes(df["Age"])])
+    if causes is not None:
+        shape = (len(causes),) + shape
+        positions = (pd.Index(list(causes)).get_indexer(df["Cause"]),) + positions
+    keep = np.logical_and.reduce([position >= 0 for position in positions])
+    flat = np.ravel_multi_index(tuple(position[keep] for position in positions), shape)
+    assert (np.bincount(flat, minlength=int(np.prod(shape))) <= 1).all(), f"Duplicated strata found in the {value} df"
+    values = np.full(int(np.prod(shape)), np.nan)
+    values[flat] = pd.to_numeric(df[value]).to_numpy(dtype=np.float64)[keep]
+    return values.reshape(shape)
+
+def crude_rates(deaths, population):
+    """
+    Function used to calculate the age-specific death rates per 100k on arrays of any shape
+    Cells with zero population get NaN
+    Returns an array with the same shape of deaths and population
+    """
+    deaths = np.asarray(deaths, dtype=np.float64)
+    population = np.asarray(population, dtype=np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rates = (deaths/population)*100000
+    return np.where(population > 0, rates, np.nan)
+
+def expected_deaths(rates, pop_std):
+    """
+    Function used to calculate the expected deaths on the standard population
+    rates are per 100k and the last axis must be the age, pop_std is a 1-D array aligned with the age axis
+    Returns an array with the same shape of rates
+    """
+    return (np.asarray(rates, dtype=np.float64)/100000)*np.asarray(pop_std, dtype=np.float64)
+
+def ratio_on_std(exp_deaths, pop_std):
+    """
+    Function used to calculate the ratio between expected deaths and standard population (age-specific rates on the standard)
+    Returns an array with the same shape of exp_deaths
+    """
+    return np.asarray(exp_deaths, dtype=np.float64)/np.asarray(pop_std, dtype=np.float64)
+
+def _pop_std_array(df_pop_std):
+    """
+    Function used to place the standard population in a 1-D array aligned with age_groups, by the codes of the age classes
+    """
+    codes = age_codes(df_pop_std["Age"])
+    assert np.array_equal(np.sort(codes), np.arange(len(age_groups))), "Ages don't coincides between the standard population and the age classes"
+    pop_std = np.empty(len(age_groups))
+    pop_std[codes] = pd.to_numeric(df_pop_std["Pop_Std"]).to_numpy(dtype=np.float64)
+    return pop_std
+
+def rate_cube(df_deaths, df_pop, df_pop_std, geos=None, years=None, sexes=None):
+    """
+    Function used to align deaths, population and standard population once and to calculate,
+    for every stratum in a single vectorized pass, crude rates, expected deaths on the standard population and the ratio exp/pop_std
+    df_deaths must have the columns Geo, Year, Sex, Age and Deaths
+    df_pop must have the columns Geo, Year, Sex, Age and Total
+    df_pop_std must have the columns Age and Pop_Std
+    geos, years and sexes select (and order) the strata, by default all the ones found in df_deaths are used
+    Returns a dictionary with the labels of each axis and the arrays indexed by [geo, year, sex, age]
+    """
+    geos = list(pd.unique(df_deaths["Geo"])) if geos is None else list(geos)
+    years = sorted(pd.unique(df_deaths["Year"])) if years is None else list(years)
+    sexes = list(pd.unique(df_deaths["Sex"])) if sexes is None else list(sexes)
+    deaths = build_cube(df_deaths, "Deaths", geos, years, sexes)
+    population = build_cube(df_pop, "Total", geos, years, sexes)
+    pop_std = _pop_std_array(df_pop_std)
+    deaths = np.nan_to_num(deaths, nan=0.0)
+    assert not np.isnan(population).any(), "Population missing for some strata"
+    assert (deaths <= population).all(), "Deaths exceed population"
+    rates = crude_rates(deaths, population)
+    exp_deaths = expected_deaths(rates, pop_std)
+    return {"Geo": geos, "Year": years, "Sex": sexes, "Age": list(age_groups),
+            "Deaths": deaths, "Total": population, "Death_Rate_per_100k": rates,
+            "Pop_Std": pop_std, "Exp_Deaths_on_Std": exp_deaths, "Ratio_Exp_on_Std": ratio_on_std(exp_deaths, pop_std)}
+
+def cause_cube(df_deaths, df_pop, df_pop_std, causes=None, geos=None, years=None, sexes=None):
+    """
+    Function used to align the deaths of many causes and their shared population once
+    df_deaths must have the columns Cause, Geo, Year, Sex, Age and Deaths (e.g. from eurostat_bulk.load_bulk on a multi-cause extract)
+    df_pop must have the columns Geo, Year, Sex, Age and Total, df_pop_std must have the columns Age and Pop_Std
+    The population is aligned a single time and is not repeated for every cause: the arrays of the rates have the cause as leading axis
+    and are calculated by broadcasting deaths [cause, geo, year, sex, age] against population [geo, year, sex, age]
+    causes, geos, years and sexes select (and order) the strata, by default all the ones found in df_deaths are used
+    Returns a dictionary like rate_cube, with the labels Cause and the arrays Deaths, Death_Rate_per_100k, Exp_Deaths_on_Std and Ratio_Exp_on_Std
+    indexed by [cause, geo, year, sex, age] (Total stays indexed by [geo, year, sex, age])
+    """
+    if "Cause" not in df_deaths.columns:
+        raise ValueError("Required column missing: Cause")
+    causes = list(pd.unique(df_deaths["Cause"])) if causes is None else list(causes)
+    geos = list(pd.unique(df_deaths["Geo"])) if geos is None else list(geos)
+    years = sorted(pd.unique(df_deaths["Year"])) if years is None else list(years)
+    sexes = list(pd.unique(df_deaths["Sex"])) if sexes is None else list(sexes)
+    deaths = build_cube(df_deaths, "Deaths", geos, years, sexes, causes=causes)
+    population = build_cube(df_pop, "Total", geos, years, sexes)
+    pop_std = _pop_std_array(df_pop_std)
+    deaths = np.nan_to_num(deaths, nan=0.0)
+    assert not np.isnan(population).any(), "Population missing for some strata"
+    assert (deaths <= population).all(), "Deaths exceed population"
+    rates = crude_rates(deaths, population)
+    exp_deaths = expected_deaths(rates, pop_std)
+    return {"Cause": causes, "Geo": geos, "Year": years, "Sex": sexes, "Age": list(age_groups),
+            "Deaths": deaths, "Total": population, "Death_Rate_per_100k": rates,
+            "Pop_Std": pop_std, "Exp_Deaths_on_Std": exp_deaths, "Ratio_Exp_on_Std": ratio_on_std(exp_deaths, pop_std)}
+
+def _position(cube, geo, year, sex):
+    """
+    Function used to find the position of a stratum in the cube
+    Returns a tuple with the indexes of geo, year and sex
+    """
+    return cube["Geo"].index(geo), cube["Year"].index(year), cube["Sex"].index(sex)
+
+def stratum_rates(cube, geo, year, sex):
+    """
+    Function used to extract a stratum from the cube in the same format returned by compute_rates.ratio
+    Returns a df with Age, Year, Deaths, Total and Death_Rate_per_100k
+    """
+    g, y, s = _position(cube, geo, year, sex)
+    return pd.DataFrame({"Age": pd.Categorical(cube["Age"], dtype=age_dtype), "Year": year,
+                         "Deaths": cube["Deaths"][g, y, s], "Total": cube["Total"][g, y, s],
+                         "Death_Rate_per_100k": cube["Death_Rate_per_100k"][g, y, s]})
+
+def stratum_std(cube, geo, ref, year, sex):
+    """
+    Function used to extract two geos of the same stratum from the cube in the same format returned by standardize_rates.expected_deaths_year
+    geo takes the _It suffix and ref takes the _EU suffix
+    Returns a df with Age, Year, Deaths_It, Total_It, Death_Rate_per_100k_It, Deaths_EU, Total_EU, Death_Rate_per_100k_EU, Pop_Std,
+    Exp_Deaths_on_Std_It, Exp_Deaths_on_Std_EU, Ratio_Exp_It_on_Std and Ratio_Exp_EU_on_Std
+    """
+    g, y, s = _position(cube, geo, year, sex)
+    r = cube["Geo"].index(ref)
+    return pd.DataFrame({"Age": pd.Categorical(cube["Age"], dtype=age_dtype), "Year": year,
+                         "Deaths_It": cube["Deaths"][g, y, s], "Total_It": cube["Total"][g, y, s], "Death_Rate_per_100k_It": cube["Death_Rate_per_100k"][g, y, s],
+                         "Deaths_EU": cube["Deaths"][r, y, s], "Total_EU": cube["Total"][r, y, s], "Death_Rate_per_100k_EU": cube["Death_Rate_per_100k"][r, y, s],
+                         "Pop_Std": cube["Pop_Std"],
+                         "Exp_Deaths_on_Std_It": cube["Exp_Deaths_on_Std"][g, y, s], "Exp_Deaths_on_Std_EU": cube["Exp_Deaths_on_Std"][r, y, s],
+                         "Ratio_Exp_It_on_Std": cube["Ratio_Exp_on_Std"][g, y, s], "Ratio_Exp_EU_on_Std": cube["Ratio_Exp_on_Std"][r, y, s]})
+
+def align_on_age(df, df1):
+    """
+    Function used to align df1 on the Age column of df by position, without merging
+    Both dfs must have the column Age and the same age classes; the age classes are compared by their codes (see utility.age_codes),
+    so the rows of df1 are reordered with a positional take, without hashing the labels
+    Returns df1 without the Age column, in the same row order of df
+    """
+    codes, codes1 = age_codes(df["Age"]), age_codes(df1["Age"])
+    df1 = df1.drop(columns=["Age"])
+    if np.array_equal(codes, codes1):
+        return df1.reset_index(drop=True)
+    counts1 = np.bincount(codes1, minlength=len(age_groups))
+    assert (counts1 <= 1).all(), "Duplicated age classes found"
+    assert np.array_equal(np.bincount(codes, minlength=len(age_groups)) > 0, counts1 > 0), "Ages don't coincides between the dataframes"
+    position = np.empty(len(age_groups), dtype=np.intp)
+    position[codes1] = np.arange(len(codes1))
+    return df1.iloc[position[codes]].reset_index(drop=True)
@@ -0,0 +1,253 @@
+# local SQLite store of the results of every run, keyed by run and data vintage, with helpers to compare runs and vintages without recalculating
+
+import argparse
+import datetime
+import hashlib
+import json
+import sqlite3
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from cache import file_hash
+
+# key columns of the results table, None is stored as NULL
+result_keys = ["run_id", "vintage", "analysis", "geo", "reference", "year", "sex", "cause", "standard", "measure"]
+# estimates with CIs and their columns in the dfs of the analysis ("Crude It", "95% CI lower It Crude", ...)
+ci_measures = ["Crude", "Std"]
+# measures of the Kitagawa decomposition, stored without CIs
+kitagawa_measures = ["Effect of Age Structure", "Effect of Rates", "Difference"]
+
+schema = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    created TEXT NOT NULL,
+    vintage TEXT NOT NULL,
+    code TEXT,
+    settings TEXT
+);
+CREATE TABLE IF NOT EXISTS results (
+    run_id INTEGER NOT NULL REFERENCES runs(run_id),
+    vintage TEXT NOT NULL,
+    analysis TEXT NOT NULL,
+    geo TEXT NOT NULL,
+    reference TEXT,
+    year INTEGER NOT NULL,
+    sex TEXT NOT NULL,
+    cause TEXT,
+    standard TEXT,
+    measure TEXT NOT NULL,
+    value REAL,
+    lower REAL,
+    upper REAL
+);
+CREATE INDEX IF NOT EXISTS results_run ON results (run_id, analysis, measure);
+CREATE INDEX IF NOT EXISTS results_vintage ON results (vintage, analysis, measure, geo, year, sex);
+CREATE INDEX IF NOT EXISTS results_stratum ON results (geo, year, sex, measure, cause, standard);
+CREATE INDEX IF NOT EXISTS runs_vintage ON runs (vintage, run_id);
+"""
+
+def data_vintage(paths):
+    """
+    Function used to identify the version of the input data (e.g. the quarterly Eurostat release) from the content of the files
+    paths are the input files or a folder (all its files, the hidden ones like .cache excluded)
+    Returns the first 16 characters of the sha256 of the names and hashes of the files
+    """
+    paths = [paths] if isinstance(paths, (str, Path)) else list(paths)
+    files = sorted(file for path in map(Path, paths) for file in (path.iterdir() if path.is_dir() else [path])
+                   if file.is_file() and not file.name.startswith("."))
+    digests = json.dumps([[file.name, file_hash(file)] for file in files])
+    return hashlib.sha256(digests.encode("utf-8")).hexdigest()[:16]
+
+def open_store(path):
+    """
+    Function used to open (and create, the first time) the SQLite database with the runs and their results
+    The database is in WAL mode, so dashboards can read it while a run is writing
+    Returns the connection
+    """
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    connection = sqlite3.connect(path)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA foreign_keys=ON")
+    connection.executescript(schema)
+    return connection
+
+def _tidy(df, analysis, geos, reference=None, standard=None):
+    """
+    Function used to convert a df of the analysis in tidy rows (one row for each geo, year, sex, cause, standard and measure)
+    geos is a dict geo -> suffix of its columns (e.g. {"IT": "It", "EU27_2020": "EU"}, "" for columns without suffix like "Crude" and "95% CI lower Crude")
+    reference and standard are used when the df has no Reference or Standard column
+    Returns a df with the columns of the results table (without run_id and vintage)
+    """
+    keys = pd.DataFrame({"analysis": analysis, "year": df["Year"].astype(np.int64), "sex": df["Sex"],
+                         "reference": df["Reference"] if "Reference" in df.columns else reference,
+                         "cause": df["Cause"] if "Cause" in df.columns else None,
+                         "standard": df["Standard"] if "Standard" in df.columns else standard})
+    parts = []
+    for geo, suffix in geos.items():
+        label = f" {suffix}" if suffix else ""
+        for measure in ci_measures + kitagawa_measures:
+            if f"{measure}{label}" not in df.columns:
+                continue
+            lower, upper = f"95% CI lower{label} {measure}", f"95% CI upper{label} {measure}"
+            parts.append(keys.assign(geo=df["Geo"] if geo is None else geo, measure=measure, value=df[f"{measure}{label}"],
+                                     lower=df[lower] if lower in df.columns else np.nan, upper=df[upper] if upper in df.columns else np.nan))
+    if not parts:
+        raise ValueError(f"No measures found in the {analysis} df")
+    return pd.concat(parts, ignore_index=True)
+
+def tidy_pipeline(context, geo_it="IT", geo_eu="EU27_2020"):
+    """
+    Function used to collect the results of a run of pipeline.run_pipeline in tidy rows: final (Italy and EU27), sensitivity (EU27 without Italy),
+    kitagawa (Italy against EU27) and standards (Italy and EU27 with every standard population), the ones computed by the run
+    Returns a df with the columns of the results table (without run_id and vintage)
+    """
+    parts = []
+    if "final" in context:
+        parts.append(_tidy(context["final"], "final", {geo_it: "It", geo_eu: "EU"}, standard="ESP2013"))
+    if "sensitivity" in context:
+        parts.append(_tidy(context["sensitivity"], "sensitivity", {f"{geo_eu}-{geo_it}": "EU-It"}, standard="ESP2013"))
+    if "kitagawa" in context:
+        parts.append(_tidy(context["kitagawa"], "kitagawa", {geo_it: ""}, reference=geo_eu))
+    if "standards" in context:
+        parts.append(_tidy(context["standards"], "standards", {geo_it: "It", geo_eu: "EU"}))
+    return pd.concat(parts, ignore_index=True)
+
+def tidy_frame(df, analysis, standard="ESP2013"):
+    """
+    Function used to convert the results of multi_country.py, multi_cause.py or small_area.py (one row for each Geo, with Crude, Std,
+    their CIs and the Kitagawa effects) in tidy rows
+    Returns a df with the columns of the results table (without run_id and vintage)
+    """
+    return _tidy(df, analysis, {None: ""}, standard=standard)
+
+def record_run(connection, rows, vintage, code=None, settings=None):
+    """
+    Function used to save a run and its tidy rows (see tidy_pipeline and tidy_frame) in a single transaction
+    settings is a dict saved as json (e.g. years, sexes and the other arguments of the run)
+    Returns the run_id
+    """
+    created = datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds")
+    with connection:
+        cursor = connection.execute("INSERT INTO runs (created, vintage, code, settings) VALUES (?, ?, ?, ?)",
+                                    (created, vintage, code, json.dumps(settings or {}, default=str)))
+        run_id = cursor.lastrowid
+        rows = rows.assign(run_id=run_id, vintage=vintage)
+        columns = result_keys + ["value", "lower", "upper"]
+        # NaN (e.g. the masked strata of small_area.py) are stored as NULL
+        values = rows[columns].astype(object).where(rows[columns].notna(), None)
+        connection.executemany(f"INSERT INTO results ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})", values.itertuples(index=False, name=None))
+    return run_id
+
+def save_results(path, rows, vintage, code=None, settings=None):
+    """
+    Function used to open the store in path, save a run (see record_run) and close it
+    Returns the run_id
+    """
+    connection = open_store(path)
+    try:
+        return record_run(connection, rows, vintage, code=code, settings=settings)
+    finally:
+        connection.close()
+
+def list_runs(connection):
+    """
+    Function used to list the runs saved, with the number of results of each one
+    Returns a df with run_id, created, vintage, code, settings and rows
+    """
+    return pd.read_sql_query("SELECT runs.*, (SELECT COUNT(*) FROM results WHERE results.run_id = runs.run_id) AS rows FROM runs ORDER BY run_id", connection)
+
+def _conditions(filters, table="results"):
+    """
+    Function used to build the conditions of a query from a dict column -> value or list of values (None values are not used)
+    Returns the list of the conditions and their parameters
+    """
+    conditions, parameters = [], []
+    for column, value in filters.items():
+        if value is None:
+            continue
+        values = list(value) if isinstance(value, (list, tuple, set)) else [value]
+        conditions.append(f"{table}.{column} IN ({', '.join('?' * len(values))})")
+        parameters += values
+    return conditions, parameters
+
+def query_results(connection, run_id=None, vintage=None, analysis=None, geo=None, year=None, sex=None, cause=None, standard=None, measure=None):
+    """
+    Function used to read saved results; every argument can be a value or a list of values (all the values if None)
+    Returns a tidy df with the columns of the results table
+    """
+    conditions, parameters = _conditions({"run_id": run_id, "vintage": vintage, "analysis": analysis, "geo": geo, "year": year, "sex": sex,
+                                          "cause": cause, "standard": standard, "measure": measure})
+    where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+    return pd.read_sql_query(f"SELECT * FROM results{where} ORDER BY run_id, analysis, geo, cause, standard, measure, sex, year", connection, params=parameters)
+
+def latest_run(connection, vintage, analysis=None):
+    """
+    Function used to find the last run of a data vintage (also given as the first characters of the hash) with results of analysis
+    (a value or a list of values, any analysis if None), e.g. the last full run and not a later run of a single stage
+    Returns the run_id
+    """
+    vintages = [row[0] for row in connection.execute("SELECT DISTINCT vintage FROM runs WHERE substr(vintage, 1, ?) = ?", (len(vintage), vintage))]
+    if len(vintages) != 1:
+        raise ValueError(f"Vintage {'not found' if not vintages else 'ambiguous'}: {vintage}")
+    conditions, parameters = _conditions({"vintage": vintages, "analysis": analysis})
+    row = connection.execute(f"SELECT MAX(run_id) FROM results WHERE {' AND '.join(conditions)}", parameters).fetchone()
+    if row[0] is None:
+        raise ValueError(f"No results of {analysis} for the vintage {vintage}")
+    return row[0]
+
+def compare_runs(connection, run_a, run_b, **filters):
+    """
+    Function used to compare two runs on the same results (same analysis, geo, reference, year, sex, cause, standard and measure), with a join in SQLite
+    filters are the arguments of query_results (analysis, geo, year, sex, cause, standard, measure)
+    Returns a df with the keys, the values and CIs of the two runs (suffixes _a and _b), the difference b - a and the ratio b / a
+    """
+    conditions, parameters = _conditions(filters, "a")
+    keys = [key for key in result_keys if key not in ["run_id", "vintage"]]
+    join = " AND ".join(f"a.{key} IS b.{key}" for key in keys)
+    query = (f"SELECT {', '.join(f'a.{key}' for key in keys)}, a.value AS value_a, a.lower AS lower_a, a.upper AS upper_a, "
+             f"b.value AS value_b, b.lower AS lower_b, b.upper AS upper_b FROM results AS a JOIN results AS b ON {join} "
+             f"WHERE {' AND '.join(['a.run_id = ?', 'b.run_id = ?'] + conditions)} "
+             f"ORDER BY a.analysis, a.geo, a.cause, a.standard, a.measure, a.sex, a.year")
+    df = pd.read_sql_query(query, connection, params=[run_a, run_b] + parameters)
+    df["difference"] = df["value_b"] - df["value_a"]
+    df["ratio"] = df["value_b"]/df["value_a"].where(df["value_a"] != 0)
+    return df
+
+def compare_vintages(connection, vintage_a, vintage_b, **filters):
+    """
+    Function used to compare the last runs of two data vintages with results of the analysis in filters (see compare_runs)
+    Returns a df like compare_runs
+    """
+    analysis = filters.get("analysis")
+    return compare_runs(connection, latest_run(connection, vintage_a, analysis), latest_run(connection, vintage_b, analysis), **filters)
+
+def main():
+    parser = argparse.ArgumentParser(description="Results of the runs saved in the SQLite store")
+    parser.add_argument("store", type=Path, nargs="?", default=Path("output") / "results.sqlite")
+    parser.add_argument("--runs", type=int, nargs=2, default=None, help="compare two runs (run_id a and b)")
+    parser.add_argument("--vintages", nargs=2, default=None, help="compare the last runs of two data vintages (also the first characters of the hash)")
+    parser.add_argument("--analysis", nargs="+", default=None)
+    parser.add_argument("--geo", nargs="+", default=None)
+    parser.add_argument("--year", type=int, nargs="+", default=None)
+    parser.add_argument("--sex", nargs="+", default=None)
+    parser.add_argument("--measure", nargs="+", default=None)
+    parser.add_argument("--output", "-o", type=Path, default=None, help="csv where the comparison is written (printed if not given)")
+    args = parser.parse_args()
+    if not args.store.exists():
+        raise SystemExit(f"Store not found: {args.store}")
+    connection = open_store(args.store)
+    filters = {"analysis": args.analysis, "geo": args.geo, "year": args.year, "sex": args.sex, "measure": args.measure}
+    if args.runs:
+        df = compare_runs(connection, *args.runs, **filters)
+    elif args.vintages:
+        df = compare_vintages(connection, *args.vintages, **filters)
+    else:
+        df = list_runs(connection)
+    connection.close()
+    if args.output is None:
+        print(df.to_string(index=False))
+    else:
+        df.to_csv(args.output, index=False)
+
+if __name__ == "__main__":
+    main()
@@ -2,39 +2,35 @@
 
 import pandas as pd
 import numpy as np
-from scipy.stats import chi2
+from standardize_rates import rates_ci_batch
+from rate_cube import align_on_age
 
 def sensitivity(df, df1, df2, df3, df_pop_std):
     """
-    Function used to merge 4 dfs and to calculate expected deaths for Europe without Italy.
-    First it merges the dfs with Italian data, then it merges the df with the european data
-    In the end it merges the two new dataframes
+    Function used to combine 4 dfs and to calculate expected deaths for Europe without Italy.
+    The dfs with Italian population, European deaths and population and the standard population are aligned by position on the Age column of df
+    (see rate_cube.align_on_age), without merges
     All 4 dfs must have the column Age
     Return a df with Age, Deaths_It, Total_It, Deaths_EU, Total_EU, Deaths_EU_no_It, Total_EU_no_It, Raw_rate_EU_no_It, Exp_Deaths_EU_no_It
     """
-    # Creating a df with Age, Deaths_It, Total_It with Deaths and Total referring to Italy.
-    df_part1 = pd.merge(df, df1, on="Age", how = "inner")
-    assert set(df["Age"]) == set(df1["Age"]), "Ages don't coincides between the dataframes (df and df1)"
-    df_part1 = df_part1.rename(columns={"Deaths": "Deaths_It", "Total": "Total_It"})
-    # Creating a df with Age, Deaths_EU, Total_EU with Deaths and Total referring to Europe.
-    df_part2 = pd.merge(df2, df3, on="Age", how = "inner")
-    df_part2 = df_part2.rename(columns={"Deaths": "Deaths_EU", "Total": "Total_EU"})
-    assert set(df2["Age"]) == set(df3["Age"]), "Ages don't coincides between the dataframes (df2 and df3)"
-    # Creating a new df with deaths and population of Europe without Italy and it calculate expected deaths of Europe without Italy on the standard population.
-    df_sensitivity = pd.merge(df_part1, df_part2, how="inner", on="Age")
-    assert set(df_part1["Age"]) == set(df_part2["Age"]), "Ages don't coincides between the dataframes (df_part1 and df_part2)"
-    df_sensitivity["Deaths_It"] = df_sensitivity["Deaths_It"].fillna(0)
-    df_sensitivity["Deaths_EU"] = df_sensitivity["Deaths_EU"].fillna(0)
-    df_sensitivity[["Deaths_It", "Deaths_EU", "Total_It", "Total_EU"]]=df_sensitivity[["Deaths_It", "Deaths_EU", "Total_It", "Total_EU"]].apply(pd.to_numeric)
+    # Creating a df with Age, Deaths_It, Total_It, Deaths_EU, Total_EU, with Deaths and Total referring to Italy and Europe.
+    df_sensitivity = pd.concat([df.reset_index(drop=True).rename(columns={"Deaths": "Deaths_It"}),
+                                align_on_age(df, df1).rename(columns={"Total": "Total_It"}),
+                                align_on_age(df, df2.drop(columns=["Year"], errors="ignore")).rename(columns={"Deaths": "Deaths_EU"}),
+                                align_on_age(df, df3).rename(columns={"Total": "Total_EU"})], axis=1)
     for column in ["Deaths_It", "Deaths_EU", "Total_It", "Total_EU"]:
       if column not in df_sensitivity:
         raise ValueError(f"Required column missing: {column}")
+    df_sensitivity["Deaths_It"] = df_sensitivity["Deaths_It"].fillna(0)
+    df_sensitivity["Deaths_EU"] = df_sensitivity["Deaths_EU"].fillna(0)
+    df_sensitivity[["Deaths_It", "Deaths_EU", "Total_It", "Total_EU"]]=df_sensitivity[["Deaths_It", "Deaths_EU", "Total_It", "Total_EU"]].apply(pd.to_numeric)
+    # Calculating deaths and population of Europe without Italy and the expected deaths of Europe without Italy on the standard population.
     df_sensitivity["Deaths_EU_no_It"] = df_sensitivity["Deaths_EU"] - df_sensitivity["Deaths_It"]
     df_sensitivity["Total_EU_no_It"] = df_sensitivity["Total_EU"] - df_sensitivity["Total_It"]
     assert not (df_sensitivity["Deaths_EU_no_It"]<0).any(), "Negative Deaths after subtraction EU-It"
     assert not (df_sensitivity["Total_EU_no_It"]<0).any(),"Negative Population after subtraction EU-It"
     df_sensitivity["Raw_rate_EU_no_It"] = (df_sensitivity["Deaths_EU_no_It"]/df_sensitivity["Total_EU_no_It"])*100000
-    df_sens_std = pd.merge(df_sensitivity, df_pop_std, how="inner", on="Age")
+    df_sens_std = pd.concat([df_sensitivity, align_on_age(df, df_pop_std)], axis=1)
     df_sens_std["Exp_Deaths_EU_no_It"] = (df_sens_std["Raw_rate_EU_no_It"]/100000) * df_sens_std["Pop_Std"]
     return df_sens_std
 
@@ -42,35 +38,18 @@ def final_sens(df, year, sex, alpha=0.05):
     """
     Function used to calulate Standardized rates and use them to creathe the final df for the sensitivity analysis
     You need a df with the columns Deaths_It, Total_It, Deaths_EU, Total_EU, Deaths_EU_no_It and Total_EU_no_It which will be used to calculate general raw mortality rate
-    The df must also contain the columns Exp_Deaths_EU_no_It, Pop_Std, which will be used to calculate standardized rates
+    The df must also contain the column Pop_Std, which will be used to calculate standardized rates
+    The CIs are calculated with standardize_rates.rates_ci_batch, the df is not modified
     Returns a dictionary.
     """
     if df["Total_EU_no_It"].sum() <= 0:
       raise ValueError("Total_EU_no_It sum is negative or zero, cannot calculate crude rates")
-    rate_raw_eu_no_it = (df["Deaths_EU_no_It"].sum()/df["Total_EU_no_It"].sum())*100000
-    lower_count_eu_no_it = 0.5 * chi2.ppf(alpha/2, 2*(df["Deaths_EU_no_It"].sum())) if df["Deaths_EU_no_It"].sum() > 0 else 0.0
-    upper_count_eu_no_it = 0.5 * chi2.ppf(1 - alpha/2, 2*(df["Deaths_EU_no_It"].sum()+1))
-    lower_rate_eu_no_it = lower_count_eu_no_it / df["Total_EU_no_It"].sum() * 100000
-    upper_rate_eu_no_it = upper_count_eu_no_it / df["Total_EU_no_It"].sum() * 100000
-    # Calculating standardized rates and 95% CIs.
     if df["Pop_Std"].sum() <= 0:
       raise ValueError("Pop_Std sum is negative or zero, cannot calculate standardize rates")
-    df["weights"] = df["Pop_Std"]/(df["Pop_Std"].sum())
-    rate_std_eu_no_it = (df["Exp_Deaths_EU_no_It"].sum()/df["Pop_Std"].sum())
-    num_eu_no_it = (np.sum(df["weights"] * (df["Deaths_EU_no_It"]/df["Total_EU_no_It"]) ))**2
-    den_eu_no_it = np.sum((df["weights"]**2) * (df["Deaths_EU_no_It"] / (df["Total_EU_no_It"]**2)))
-    k = num_eu_no_it/den_eu_no_it if den_eu_no_it > 0 else 0
-    if k>0:
-        lower_std_eu_no_it = ((rate_std_eu_no_it*2*k) / ((chi2.ppf(1-(alpha/2), 2*k))))
-        lower_std_eu_no_it = lower_std_eu_no_it*100000
-        upper_std_eu_no_it = ((rate_std_eu_no_it*2*(k+1)) / (chi2.ppf(alpha/2, 2*(k+1))))
-        upper_std_eu_no_it = upper_std_eu_no_it*100000
-    else:
-        lower_std_eu_no_it, upper_std_eu_no_it = 0, 0
-    rate_std_eu_no_it = rate_std_eu_no_it*100000
-
-    return {"Year": year, "Sex": sex, "Crude EU-It": rate_raw_eu_no_it, "95% CI lower EU-It Crude": lower_rate_eu_no_it, "95% CI upper EU-It Crude": upper_rate_eu_no_it, 
-            "Std EU-It": rate_std_eu_no_it, "95% CI lower EU-It Std": lower_std_eu_no_it, "95% CI upper EU-It Std": upper_std_eu_no_it}
+    ci = rates_ci_batch(df["Deaths_EU_no_It"].to_numpy(dtype=np.float64), df["Total_EU_no_It"].to_numpy(dtype=np.float64), 
+                        df["Pop_Std"].to_numpy(dtype=np.float64), alpha)
+    return {"Year": year, "Sex": sex, "Crude EU-It": float(ci["Crude"]), "95% CI lower EU-It Crude": float(ci["Crude lower"]), "95% CI upper EU-It Crude": float(ci["Crude upper"]), 
+            "Std EU-It": float(ci["Std"]), "95% CI lower EU-It Std": float(ci["Std lower"]), "95% CI upper EU-It Std": float(ci["Std upper"])}
 
 def dataframe_final_sens(results):
     """
@@ -80,3 +59,44 @@ def dataframe_final_sens(results):
     assert (df_final_sens["Crude EU-It"]>=0).all(), "Negative Europe-Italy crude rates found"
     assert (df_final_sens["Std EU-It"]>=0).all(), "Negative Europe-Italy standardized rates found"
     return df_final_sens
+
+def leave_one_out(cube, aggregate, members=None, alpha=0.05):
+    """
+    Function used to calculate, for every member X of an aggregate (e.g. EU27) at once, the crude and standardized rates with CIs of the aggregate without X
+    The cube (see rate_cube.rate_cube) must have the aggregate and the members among its geos, members are all the other geos if None
+    The deaths and the population of the members are subtracted from the aggregate in a single broadcasted operation,
+    the same checks of sensitivity (no negative deaths or population after the subtraction) are done on the whole array
+    Returns a dictionary with the labels Geo (the member excluded), Year, Sex and Aggregate and the arrays of rates_ci_batch indexed by [geo, year, sex]
+    """
+    if aggregate not in cube["Geo"]:
+        raise ValueError(f"Aggregate not found among the geos: {aggregate}")
+    members = [geo for geo in cube["Geo"] if geo != aggregate] if members is None else list(members)
+    for geo in members:
+        if geo not in cube["Geo"]:
+            raise ValueError(f"Member not found among the geos: {geo}")
+    r = cube["Geo"].index(aggregate)
+    m = [cube["Geo"].index(geo) for geo in members]
+    deaths_out = cube["Deaths"][r] - cube["Deaths"][m]
+    population_out = cube["Total"][r] - cube["Total"][m]
+    negative_deaths = (deaths_out < 0).any(axis=(1, 2, 3))
+    negative_population = (population_out < 0).any(axis=(1, 2, 3))
+    assert not negative_deaths.any(), f"Negative Deaths after subtraction {aggregate}-X for: {[geo for geo, negative in zip(members, negative_deaths) if negative]}"
+    assert not negative_population.any(), f"Negative Population after subtraction {aggregate}-X for: {[geo for geo, negative in zip(members, negative_population) if negative]}"
+    if (population_out.sum(axis=-1) <= 0).any():
+        raise ValueError("Population of the aggregate without a member is zero, cannot calculate crude rates")
+    ci = rates_ci_batch(deaths_out, population_out, cube["Pop_Std"], alpha)
+    return {"Geo": members, "Year": cube["Year"], "Sex": cube["Sex"], "Aggregate": aggregate, **ci}
+
+def dataframe_leave_one_out(results):
+    """
+    From the results of the previous function it returns a df with Excluded, Year, Sex, Aggregate and the crude and standardized rates with CIs
+    of the aggregate without the excluded member
+    """
+    index = pd.MultiIndex.from_product([results["Geo"], results["Year"], results["Sex"]], names=["Excluded", "Year", "Sex"])
+    df_leave_one_out = pd.DataFrame({"Aggregate": results["Aggregate"],
+                                     "Crude": results["Crude"].ravel(), "95% CI lower Crude": results["Crude lower"].ravel(), "95% CI upper Crude": results["Crude upper"].ravel(),
+                                     "Std": results["Std"].ravel(), "95% CI lower Std": results["Std lower"].ravel(), "95% CI upper Std": results["Std upper"].ravel()},
+                                    index=index).reset_index()
+    assert (df_leave_one_out["Crude"]>=0).all(), "Negative crude rates found"
+    assert (df_leave_one_out["Std"]>=0).all(), "Negative standardized rates found"
+    return df_leave_one_out
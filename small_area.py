@@ -0,0 +1,174 @@
+# subnational analysis (provinces and regions): rates, CIs and Kitagawa decomposition of all the small areas against a reference in one vectorized pass
+
+import argparse
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from utility import age_groups, to_age_category, load_standard_pop
+from rate_cube import build_cube, _pop_std_array
+from standardize_rates import rates_ci_sparse
+from kitagawa_deco import kitagawa_effects
+from microdata import age_class_codes
+from results_store import save_results, tidy_frame, data_vintage
+
+# label of the sum of all the areas, added to the cube when it's used as reference
+national_label = "IT"
+
+def load_long(path, value, sep=","):
+    """
+    Function used to read a long file of a small-area analysis with the columns Geo, Year, Sex, Age and value
+    (e.g. the deaths written by microdata.py with --by-residence, or the resident population by province)
+    Age can have the labels of the age classes or single ages (in completed years), which are summed in the age classes
+    Returns a long df with Geo, Year, Sex, Age and value
+    """
+    df = pd.read_csv(path, sep=sep, dtype={"Geo": str, "Sex": str})
+    for column in ["Geo", "Year", "Sex", "Age", value]:
+        if column not in df.columns:
+            raise ValueError(f"Required column missing: {column}")
+    df["Year"] = pd.to_numeric(df["Year"])
+    df[value] = pd.to_numeric(df[value])
+    if pd.to_numeric(df["Age"], errors="coerce").notna().all():
+        codes = age_class_codes(df["Age"])
+        df["Age"] = pd.Categorical.from_codes(codes, categories=age_groups, ordered=True)
+        df = df.groupby(["Geo", "Year", "Sex", "Age"], observed=True, sort=False)[value].sum().reset_index()
+    else:
+        df["Age"] = to_age_category(df["Age"])
+    return df[["Geo", "Year", "Sex", "Age", value]]
+
+def masked_rates(deaths, population):
+    """
+    Function used to calculate the age-specific death rates per 100k as a masked array: the cells without population are masked instead of NaN
+    Returns a masked array with the same shape of deaths and population
+    """
+    population = np.ma.masked_less_equal(np.asarray(population, dtype=np.float64), 0)
+    return np.asarray(deaths, dtype=np.float64)/population*100000
+
+def small_area_cube(df_deaths, df_pop, df_pop_std, geos=None, years=None, sexes=None):
+    """
+    Function used to align deaths and population of many small areas once in arrays indexed by [geo, year, sex, age], like rate_cube.rate_cube
+    The cells not found in the files have zero deaths or zero population (small areas often have age classes without residents):
+    the rates of the cells without population are masked (see masked_rates)
+    geos, years and sexes select (and order) the strata, by default all the ones found in df_pop are used
+    Returns a dictionary with the labels of each axis, the arrays Deaths and Total and the masked array Death_Rate_per_100k
+    """
+    geos = list(pd.unique(df_pop["Geo"])) if geos is None else list(geos)
+    years = sorted(pd.unique(df_pop["Year"])) if years is None else list(years)
+    sexes = list(pd.unique(df_pop["Sex"])) if sexes is None else list(sexes)
+    deaths = np.nan_to_num(build_cube(df_deaths, "Deaths", geos, years, sexes), nan=0.0)
+    population = np.nan_to_num(build_cube(df_pop, "Total", geos, years, sexes), nan=0.0)
+    assert (deaths[population <= 0] == 0).all(), "Deaths found in age classes without population"
+    assert (deaths <= population).all(), "Deaths exceed population"
+    return {"Geo": geos, "Year": years, "Sex": sexes, "Age": list(age_groups), "Deaths": deaths, "Total": population,
+            "Death_Rate_per_100k": masked_rates(deaths, population), "Pop_Std": _pop_std_array(df_pop_std)}
+
+def aggregate_areas(cube, groups):
+    """
+    Function used to add to the cube the sums of groups of areas (e.g. the regions from their provinces, or the whole country)
+    groups is a dict label -> list of geos of the cube; all the groups are summed with one matrix product on the geo axis
+    Returns a new cube with the groups after the geos of cube
+    """
+    membership = np.zeros((len(groups), len(cube["Geo"])))
+    for i, members in enumerate(groups.values()):
+        missing = set(members) - set(cube["Geo"])
+        if missing:
+            raise ValueError(f"Geos not found: {sorted(missing)}")
+        membership[i, [cube["Geo"].index(geo) for geo in members]] = 1
+    deaths = np.concatenate([cube["Deaths"], np.tensordot(membership, cube["Deaths"], axes=1)])
+    population = np.concatenate([cube["Total"], np.tensordot(membership, cube["Total"], axes=1)])
+    return {**cube, "Geo": cube["Geo"] + list(groups), "Deaths": deaths, "Total": population, "Death_Rate_per_100k": masked_rates(deaths, population)}
+
+def small_area_results(cube, ref, alpha=0.05):
+    """
+    Function used to calculate, for every area, year and sex of the cube at once, crude and standardized rates with CIs that stay valid with
+    zero deaths (see standardize_rates.rates_ci_sparse) and the Kitagawa decomposition against the reference geo ref
+    In the Kitagawa decomposition the age classes without population have rate 0, so the two effects still add up to the difference of the crude rates
+    Returns a dictionary with the labels Geo, Year, Sex and Reference, the masked arrays indexed by [geo, year, sex] (the strata without population are masked)
+    and Empty age classes, the number of age classes without population of every stratum
+    """
+    if ref not in cube["Geo"]:
+        raise ValueError(f"Reference not found among the geos: {ref}")
+    r = cube["Geo"].index(ref)
+    population = cube["Total"]
+    empty = population.sum(axis=-1) <= 0
+    if empty[r].any():
+        raise ValueError(f"The reference has strata without population: {ref}")
+    results = rates_ci_sparse(cube["Deaths"], population, cube["Pop_Std"], alpha)
+    # the strata without population get a placeholder population (their effects are masked)
+    rates = cube["Death_Rate_per_100k"].filled(0.0)
+    structure_effect, rates_effect = kitagawa_effects(np.where(empty[..., None], 1.0, population), rates, population[r], rates[r])
+    results["Effect of Age Structure"] = np.ma.masked_array(structure_effect, mask=empty)
+    results["Effect of Rates"] = np.ma.masked_array(rates_effect, mask=empty)
+    results["Difference"] = results["Effect of Age Structure"] + results["Effect of Rates"]
+    return {"Geo": cube["Geo"], "Year": cube["Year"], "Sex": cube["Sex"], "Reference": ref,
+            "Deaths": cube["Deaths"].sum(axis=-1), "Population": population.sum(axis=-1), "Empty age classes": (population <= 0).sum(axis=-1), **results}
+
+def dataframe_small_area(results):
+    """
+    Function used to flatten the results of small_area_results in a df, one row for each area, year and sex (the masked values are empty)
+    Returns a df with Geo, Year, Sex, Reference, Deaths, Population, Empty age classes, crude and standardized rates with CIs and the Kitagawa effects
+    """
+    index = pd.MultiIndex.from_product([results["Geo"], results["Year"], results["Sex"]], names=["Geo", "Year", "Sex"])
+    names = {"Crude lower": "95% CI lower Crude", "Crude upper": "95% CI upper Crude", "Std lower": "95% CI lower Std", "Std upper": "95% CI upper Std"}
+    columns = ["Deaths", "Population", "Empty age classes", "Crude", "Crude lower", "Crude upper", "Std", "Std lower", "Std upper",
+               "Effect of Age Structure", "Effect of Rates", "Difference"]
+    df_small_area = pd.DataFrame({names.get(column, column): np.ma.filled(np.ma.asarray(results[column], dtype=np.float64), np.nan).ravel() for column in columns}, index=index)
+    df_small_area = df_small_area.reset_index()
+    df_small_area.insert(3, "Reference", results["Reference"])
+    df_small_area[["Deaths", "Population", "Empty age classes"]] = df_small_area[["Deaths", "Population", "Empty age classes"]].astype(np.int64)
+    assert (df_small_area["Std"].dropna()>=0).all(), "Negative standardized rates found"
+    return df_small_area
+
+def read_groups(path, sep=","):
+    """
+    Function used to read the areas of every group (e.g. the region of every province) from a file with the columns Area and Group
+    Returns a dict group -> list of areas
+    """
+    df = pd.read_csv(path, sep=sep, dtype=str)
+    for column in ["Area", "Group"]:
+        if column not in df.columns:
+            raise ValueError(f"Required column missing: {column}")
+    return {group: list(df_group["Area"]) for group, df_group in df.groupby("Group", sort=False)}
+
+def main(deaths_path, population_path, std_path=Path("data") / "ESP2013.csv", output_dir=Path("output"), ref=national_label, groups_path=None, years=None, sexes=None, store=None):
+    """
+    Runs the small-area analysis: deaths and population are long files with Geo, Year, Sex, Age and Deaths/Total (see load_long)
+    The groups of groups_path (see read_groups) and, if ref is national_label and it's not in the files, the sum of all the areas are added to the areas
+    The results of every area are written in a single table, and also saved in the SQLite database store if given (see results_store.py)
+    """
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    df_deaths, df_pop = load_long(deaths_path, "Deaths"), load_long(population_path, "Total")
+    cube = small_area_cube(df_deaths, df_pop, load_standard_pop(std_path), years=years, sexes=sexes)
+    groups = {} if groups_path is None else read_groups(groups_path)
+    if ref == national_label and ref not in cube["Geo"] and ref not in groups:
+        groups[ref] = list(cube["Geo"])
+    if groups:
+        cube = aggregate_areas(cube, groups)
+    df_small_area = dataframe_small_area(small_area_results(cube, ref))
+    df_small_area.to_csv(output_dir / "Table_Results_Small_Areas.csv", index=False)
+    print(f"Results for {len(cube['Geo'])} areas written in Table_Results_Small_Areas.csv ({int((df_small_area['Deaths'] == 0).sum())} strata without deaths)")
+    if store is not None:
+        vintage = data_vintage([path for path in [deaths_path, population_path, std_path, groups_path] if path is not None])
+        run_id = save_results(store, tidy_frame(df_small_area, "small_area"), vintage, settings={"reference": ref, "years": years, "sexes": sexes})
+        print(f"Results saved in {store} (run {run_id}, data vintage {vintage})")
+
+def parse_args(argv=None):
+    """
+    Function used to read the arguments of the command line
+    Returns the namespace of argparse
+    """
+    parser = argparse.ArgumentParser(description="Small-area analysis (provinces and regions)")
+    parser.add_argument("deaths", type=Path, help="long file with Geo, Year, Sex, Age and Deaths")
+    parser.add_argument("population", type=Path, help="long file with Geo, Year, Sex, Age and Total")
+    parser.add_argument("--std", type=Path, default=Path("data") / "ESP2013.csv", help="standard population (default data/ESP2013.csv)")
+    parser.add_argument("--output", "-o", type=Path, default=Path("output"))
+    parser.add_argument("--reference", default=national_label, help=f"geo used as reference (default {national_label}, the sum of all the areas)")
+    parser.add_argument("--groups", type=Path, default=None, help="file with the columns Area and Group, e.g. the region of every province")
+    parser.add_argument("--years", type=int, nargs="+", default=None)
+    parser.add_argument("--sexes", nargs="+", choices=["Tot", "M", "F"], default=None)
+    parser.add_argument("--store", type=Path, default=None, help="SQLite database where the results are also saved (see results_store.py)")
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    args = parse_args()
+    main(args.deaths, args.population, std_path=args.std, output_dir=args.output, ref=args.reference, groups_path=args.groups, years=args.years, sexes=args.sexes, store=args.store)
@@ -0,0 +1,59 @@
+# standard populations used for the direct standardization, aligned with the age classes of the analysis
+
+import numpy as np
+import pandas as pd
+from utility import age_groups, age_codes
+
+# The standards with an open class 85+ (ESP1976 and Segi) are divided in 85-89, 90-94 and 95+ with the proportions of the ESP2013 (1500:800:200),
+# the class 0-4 of the WHO 2000 standard is divided in 0 and 1-4 as 1/5 and 4/5 (its published values sum to 100035 because of rounding,
+# it doesn't matter since the weights are always divided by the total)
+standard_populations = {
+    "ESP2013": [1000, 4000, 5500, 5500, 5500, 6000, 6000, 6500, 7000, 7000, 7000, 7000, 6500, 6000, 5500, 5000, 4000, 2500, 1500, 800, 200],
+    "ESP1976": [1600, 6400, 7000, 7000, 7000, 7000, 7000, 7000, 7000, 7000, 7000, 7000, 6000, 5000, 4000, 3000, 2000, 1000, 600, 320, 80],
+    "WHO2000": [1772, 7088, 8690, 8600, 8470, 8220, 7930, 7610, 7150, 6590, 6040, 5370, 4550, 3720, 2960, 2210, 1520, 910, 440, 150, 45],
+    "Segi": [2400, 9600, 10000, 9000, 9000, 8000, 8000, 6000, 6000, 6000, 6000, 5000, 4000, 4000, 3000, 2000, 1000, 500, 300, 160, 40]}
+
+def standard_vector(standard, ages=age_groups):
+    """
+    Function used to convert a standard population in a 1-D array aligned with ages
+    standard can be the name of one of the standard_populations, a df with the columns Age and Pop_Std (e.g. from utility.load_standard_pop)
+    or an array already aligned with ages
+    Returns a 1-D array
+    """
+    if isinstance(standard, str):
+        if standard not in standard_populations:
+            raise ValueError(f"Unknown standard population: {standard}")
+        values = np.asarray(standard_populations[standard], dtype=np.float64)
+    elif isinstance(standard, pd.DataFrame):
+        for column in ["Age", "Pop_Std"]:
+            if column not in standard.columns:
+                raise ValueError(f"Required column missing: {column}")
+        codes = age_codes(standard["Age"])
+        assert np.array_equal(np.sort(codes), np.arange(len(age_groups))), "Ages don't coincides between the standard population and the age classes"
+        values = np.empty(len(age_groups))
+        values[codes] = pd.to_numeric(standard["Pop_Std"]).to_numpy(dtype=np.float64)
+        values = values[[age_groups.index(age) for age in ages]]
+    else:
+        values = np.asarray(standard, dtype=np.float64)
+    assert values.shape == (len(ages),), "The standard population must have one value for each age class"
+    assert (values >= 0).all() and values.sum() > 0, "Found negative values or zero total in the standard population"
+    return values
+
+def standards_matrix(standards, ages=age_groups):
+    """
+    Function used to stack many standard populations in a single matrix
+    standards is a dict name -> standard (see standard_vector) or a list with the names of standard_populations
+    Returns the list of the names and an array with shape (len(ages), number of standards)
+    """
+    if not isinstance(standards, dict):
+        standards = {name: name for name in standards}
+    names = list(standards)
+    return names, np.stack([standard_vector(standards[name], ages) for name in names], axis=-1)
+
+def observed_standard(population, axis=(0, 1)):
+    """
+    Function used to create a standard population from an observed population (e.g. the EU27 or the pooled population of the run)
+    population is an array with the age classes on the last axis (e.g. [year, sex, age]), the other axes in axis are summed
+    Returns a 1-D array aligned with the age axis
+    """
+    return np.nansum(np.asarray(population, dtype=np.float64), axis=axis)
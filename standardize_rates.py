@@ -2,92 +2,230 @@
 
 import pandas as pd
 import numpy as np
-from scipy.stats import chi2
+from rate_cube import align_on_age, expected_deaths, ratio_on_std
+from standard_populations import standards_matrix
+
+# dicts used to rename the columns of the italian and european dfs
+suffix_it = {"Deaths": "Deaths_It", "Total": "Total_It", "Death_Rate_per_100k": "Death_Rate_per_100k_It"}
+suffix_eu = {"Deaths": "Deaths_EU", "Total": "Total_EU", "Death_Rate_per_100k": "Death_Rate_per_100k_EU"}
 
 def expected_deaths_year(df, df1, df2):
     """
-    Function used to merge 3 dfs and to calculate expected deaths and the ratio exp/pop_std
-    First it merges the dfs with Italian and European raw rates and then it merges the df created with the df with standard population
+    Function used to combine 3 dfs and to calculate expected deaths and the ratio exp/pop_std
+    The dfs with Italian and European raw rates and the df with standard population are aligned by position on the Age column (align_on_age checks the age classes)
+    The arithmetic is done by the rate_cube functions, so it gives the same results of rate_cube.rate_cube
     All 3 dfs must have the column Age
     It's used to calculate expected deaths on the standard population, which will be used to calculate the standardized rate
     Return a df with Age, Deaths_It, Total_It, Death_Rate_per_100k_It, Deaths_EU, Total_EU, Death_Rate_per_100k_EU, Exp_Deaths_on_Std_IT, Exp_Deaths_on_Std_EU
     """
     df1 = df1.drop(columns=["Year"], errors="ignore")
-    df_merged_df1 = pd.merge(df, df1, how="inner", on="Age")
-    assert set(df["Age"]) == set(df1["Age"]), "Ages don't coincides between the dataframes (df and df1)"
-    df_ratio_std = pd.merge(df_merged_df1, df2, how="inner", on="Age")
-    assert set(df_merged_df1["Age"]) == set(df2["Age"]), "Ages don't coincides between the dataframes (df_merged_df1 and df2)"
-    df_ratio_std = df_ratio_std.rename(columns={"Deaths_x": "Deaths_It", "Total_x": "Total_It", "Death_Rate_per_100k_x": "Death_Rate_per_100k_It", 
-                                          "Deaths_y": "Deaths_EU", "Total_y": "Total_EU", "Death_Rate_per_100k_y": "Death_Rate_per_100k_EU"
-                                          })
+    df_ratio_std = pd.concat([df.reset_index(drop=True).rename(columns=suffix_it), 
+                              align_on_age(df, df1).rename(columns=suffix_eu), 
+                              align_on_age(df, df2)], axis=1)
     df_ratio_std[["Deaths_It", "Deaths_EU", "Total_It", "Total_EU", "Death_Rate_per_100k_It", "Death_Rate_per_100k_EU"]]=df_ratio_std[["Deaths_It", "Deaths_EU", "Total_It", "Total_EU", "Death_Rate_per_100k_It", "Death_Rate_per_100k_EU"]].apply(pd.to_numeric)
     df_ratio_std["Deaths_It"] = df_ratio_std["Deaths_It"].fillna(0)
     df_ratio_std["Deaths_EU"] = df_ratio_std["Deaths_EU"].fillna(0)
     for column in ["Death_Rate_per_100k_It", "Death_Rate_per_100k_EU", "Pop_Std"]:
       if column not in df_ratio_std.columns:
         raise ValueError(f"Required column missing: {column}")
-    df_ratio_std["Exp_Deaths_on_Std_It"] = (df_ratio_std["Death_Rate_per_100k_It"]/100000)*(df_ratio_std["Pop_Std"])
-    df_ratio_std["Exp_Deaths_on_Std_EU"] =(df_ratio_std["Death_Rate_per_100k_EU"]/100000)*(df_ratio_std["Pop_Std"])
-    df_ratio_std["Ratio_Exp_It_on_Std"] = (df_ratio_std["Exp_Deaths_on_Std_It"]/df_ratio_std["Pop_Std"])
-    df_ratio_std["Ratio_Exp_EU_on_Std"] = (df_ratio_std["Exp_Deaths_on_Std_EU"]/df_ratio_std["Pop_Std"])
+    df_ratio_std["Exp_Deaths_on_Std_It"] = expected_deaths(df_ratio_std["Death_Rate_per_100k_It"], df_ratio_std["Pop_Std"])
+    df_ratio_std["Exp_Deaths_on_Std_EU"] = expected_deaths(df_ratio_std["Death_Rate_per_100k_EU"], df_ratio_std["Pop_Std"])
+    df_ratio_std["Ratio_Exp_It_on_Std"] = ratio_on_std(df_ratio_std["Exp_Deaths_on_Std_It"], df_ratio_std["Pop_Std"])
+    df_ratio_std["Ratio_Exp_EU_on_Std"] = ratio_on_std(df_ratio_std["Exp_Deaths_on_Std_EU"], df_ratio_std["Pop_Std"])
     return df_ratio_std
 
+def rates_ci_batch(deaths, population, pop_std, alpha=0.05):
+    """
+    Function used to calculate crude and standardized rates with their CIs for N strata at once.
+    deaths and population must be arrays with the age classes on the last axis (e.g. shape (N, ages) or (geo, year, sex, ages)),
+    pop_std must be a 1-D array with the standard population (or the standard weights) aligned with the age axis.
+    alpha can be a number or a 1-D array (e.g. [0.10, 0.05, 0.01]): in the second case every output gets a last axis, one for each alpha.
+    Crude rates use the Exact Poisson limits, standardized rates use the gamma method by Fay & Feuer (same formulas of final).
+    Each bound is calculated with a single vectorized chi2.ppf call.
+    Returns a dictionary of arrays (per 100k) with Crude, Crude lower, Crude upper, Std, Std lower and Std upper.
+    """
+    deaths = np.asarray(deaths, dtype=np.float64)
+    population = np.asarray(population, dtype=np.float64)
+    pop_std = np.asarray(pop_std, dtype=np.float64)
+    alpha = np.asarray(alpha, dtype=np.float64)
+    deaths_sum = deaths.sum(axis=-1)
+    population_sum = population.sum(axis=-1)
+    if (population_sum <= 0).any():
+      raise ValueError("Total sum is negative or zero, cannot calculate crude rates")
+    if pop_std.sum() <= 0:
+      raise ValueError("Pop_Std sum is negative or zero, cannot calculate standardized rates")
+    weights = pop_std/pop_std.sum()
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rate_age = deaths/population
+        rate_std = np.sum(rate_age*pop_std, axis=-1)/pop_std.sum()
+        num = np.sum(weights*rate_age, axis=-1)**2
+        den = np.sum((weights**2)*(deaths/(population**2)), axis=-1)
+        k = np.where(den > 0, num/den, 0.0)
+    return _limits(deaths_sum, population_sum, rate_std, k, alpha)
+
+def _chi2_ppf(q, df):
+    """
+    Function used to calculate the quantiles of the chi-squared distribution (scipy.stats.chi2.ppf)
+    scipy.stats is imported the first time a CI is calculated, since it takes most of the import time of the analysis
+    """
+    from scipy.stats import chi2
+    return chi2.ppf(q, df)
+
+def _limits(deaths_sum, population_sum, rate_std, k, alpha):
+    """
+    Function used to calculate the Exact Poisson limits of the crude rates and the Fay & Feuer limits of the standardized rates
+    from the sums of deaths and population, the standardized rates and the k of the gamma method (all arrays with the same shape)
+    Returns a dictionary of arrays (per 100k) with Crude, Crude lower, Crude upper, Std, Std lower and Std upper.
+    """
+    if alpha.ndim:
+        # one more axis for the alpha values
+        deaths_sum, population_sum, rate_std, k = deaths_sum[..., None], population_sum[..., None], rate_std[..., None], k[..., None]
+    # Calculating the crude rates and lower and upper limits (Exact Poisson limits).
+    lower_count = np.where(deaths_sum > 0, 0.5 * _chi2_ppf(alpha/2, 2*np.where(deaths_sum > 0, deaths_sum, 1)), 0.0)
+    upper_count = 0.5 * _chi2_ppf(1 - alpha/2, 2*(deaths_sum+1))
+    # Calculating standardized rates and CIs using gamma method by Fay & Feuer.
+    k_safe = np.where(k > 0, k, 1)
+    lower_std = np.where(k > 0, (rate_std*2*k) / _chi2_ppf(1-(alpha/2), 2*k_safe), 0.0)
+    upper_std = np.where(k > 0, (rate_std*2*(k+1)) / _chi2_ppf(alpha/2, 2*(k_safe+1)), 0.0)
+    crude = np.broadcast_to(deaths_sum/population_sum*100000, lower_count.shape)
+    return {"Crude": crude, "Crude lower": lower_count/population_sum*100000, "Crude upper": upper_count/population_sum*100000, 
+            "Std": np.broadcast_to(rate_std*100000, lower_std.shape), "Std lower": lower_std*100000, "Std upper": upper_std*100000}
+
+def rates_ci_sparse(deaths, population, pop_std, alpha=0.05):
+    """
+    Function used to calculate crude and standardized rates with their CIs for N strata of small areas at once, where many cells have few or zero deaths
+    and some age classes have no population. deaths and population must be arrays with the age classes on the last axis (like in rates_ci_batch).
+    The age classes without population are masked: they have no rate and don't contribute to the standardized rate or its variance.
+    Crude rates use the Exact Poisson limits, standardized rates the gamma method of Fay & Feuer (1997) with the largest weight w_M of the stratum,
+    whose upper limit is positive also when the stratum has zero deaths (instead of the (0, 0) interval of rates_ci_batch).
+    Returns a dictionary of masked arrays (per 100k) with Crude, Crude lower, Crude upper, Std, Std lower and Std upper:
+    the strata without population are masked.
+    """
+    deaths = np.asarray(deaths, dtype=np.float64)
+    population = np.asarray(population, dtype=np.float64)
+    pop_std = np.asarray(pop_std, dtype=np.float64)
+    if pop_std.sum() <= 0:
+      raise ValueError("Pop_Std sum is negative or zero, cannot calculate standardized rates")
+    assert (deaths[population <= 0] == 0).all(), "Deaths found in age classes without population"
+    empty = population.sum(axis=-1) <= 0
+    population = np.ma.masked_less_equal(population, 0)
+    weights = pop_std/pop_std.sum()
+    deaths_sum = deaths.sum(axis=-1)
+    # variables of the gamma method: the standardized rate y, its variance v and the largest weight w_M = max(w_i/n_i)
+    rate_std = np.ma.sum(weights*deaths/population, axis=-1).filled(0.0)
+    variance = np.ma.sum((weights**2)*deaths/(population**2), axis=-1).filled(0.0)
+    weight_max = np.ma.max(weights/population, axis=-1).filled(0.0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        lower_std = np.where(rate_std > 0, variance/(2*rate_std)*_chi2_ppf(alpha/2, 2*rate_std**2/np.where(variance > 0, variance, 1)), 0.0)
+        upper_std = (variance + weight_max**2)/(2*(rate_std + weight_max))*_chi2_ppf(1 - alpha/2, 2*(rate_std + weight_max)**2/(variance + weight_max**2))
+        lower_count = np.where(deaths_sum > 0, 0.5*_chi2_ppf(alpha/2, 2*np.where(deaths_sum > 0, deaths_sum, 1)), 0.0)
+        upper_count = 0.5*_chi2_ppf(1 - alpha/2, 2*(deaths_sum + 1))
+        population_sum = population.sum(axis=-1).filled(np.nan)
+        results = {"Crude": deaths_sum/population_sum, "Crude lower": lower_count/population_sum, "Crude upper": upper_count/population_sum,
+                   "Std": rate_std, "Std lower": lower_std, "Std upper": upper_std}
+    return {key: np.ma.masked_array(values*100000, mask=empty) for key, values in results.items()}
+
+def rates_ci_standards(deaths, population, pop_std, alpha=0.05):
+    """
+    Function used to calculate crude and standardized rates with their CIs for N strata and S standard populations at once.
+    deaths and population must be arrays with the age classes on the last axis (like in rates_ci_batch),
+    pop_std must be a 2-D array (ages x standards), e.g. from standard_populations.standards_matrix.
+    The standardized rates and the k of the gamma method are calculated with matrix products (strata x ages) @ (ages x standards).
+    Returns a dictionary of arrays (per 100k) like rates_ci_batch, with one more axis for the standards (before the axis of alpha, if alpha is a list).
+    The crude rates don't depend on the standard, they are repeated for every standard.
+    """
+    deaths = np.asarray(deaths, dtype=np.float64)
+    population = np.asarray(population, dtype=np.float64)
+    pop_std = np.asarray(pop_std, dtype=np.float64)
+    alpha = np.asarray(alpha, dtype=np.float64)
+    if pop_std.ndim != 2 or pop_std.shape[0] != deaths.shape[-1]:
+        raise ValueError("pop_std must have shape (ages, standards)")
+    deaths_sum = deaths.sum(axis=-1)
+    population_sum = population.sum(axis=-1)
+    if (population_sum <= 0).any():
+      raise ValueError("Total sum is negative or zero, cannot calculate crude rates")
+    if (pop_std.sum(axis=0) <= 0).any():
+      raise ValueError("Pop_Std sum is negative or zero, cannot calculate standardized rates")
+    weights = pop_std/pop_std.sum(axis=0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rate_age = deaths/population
+        rate_std = rate_age @ weights
+        den = (deaths/(population**2)) @ (weights**2)
+        k = np.where(den > 0, (rate_std**2)/den, 0.0)
+    shape = rate_std.shape
+    return _limits(np.broadcast_to(deaths_sum[..., None], shape), np.broadcast_to(population_sum[..., None], shape), rate_std, k, alpha)
+
+def final_standards(cube, geo, ref, standards, alpha=0.05):
+    """
+    Function used to calculate the standardized rates with CIs of geo and ref for every (year, sex) of the cube (see rate_cube.rate_cube) and every standard population,
+    with a single rates_ci_standards call
+    standards is a dict name -> standard or a list of names (see standard_populations.standards_matrix)
+    Returns a df with Year, Sex, Standard, the standardized rates of geo (It) and ref (EU) with CIs, the Gap (Std It - Std EU) and the Ratio (Std It / Std EU)
+    """
+    names, matrix = standards_matrix(standards, cube["Age"])
+    g, r = cube["Geo"].index(geo), cube["Geo"].index(ref)
+    ci = rates_ci_standards(cube["Deaths"][[g, r]], cube["Total"][[g, r]], matrix, alpha)
+    index = pd.MultiIndex.from_product([cube["Year"], cube["Sex"], names], names=["Year", "Sex", "Standard"])
+    # the arrays are indexed by [geo, year, sex, standard]
+    df_standards = pd.DataFrame({"Std It": ci["Std"][0].ravel(), "95% CI lower It Std": ci["Std lower"][0].ravel(), "95% CI upper It Std": ci["Std upper"][0].ravel(),
+                                 "Std EU": ci["Std"][1].ravel(), "95% CI lower EU Std": ci["Std lower"][1].ravel(), "95% CI upper EU Std": ci["Std upper"][1].ravel()},
+                                index=index).reset_index()
+    df_standards["Gap"] = df_standards["Std It"] - df_standards["Std EU"]
+    df_standards["Ratio"] = df_standards["Std It"]/df_standards["Std EU"]
+    assert (df_standards["Std It"]>=0).all(), "Negative italian standardized rates found"
+    assert (df_standards["Std EU"]>=0).all(), "Negative european standardized rates found"
+    return df_standards
+
+def _final_dict(ci, i, r, year, sex):
+    """
+    Function used to build the dictionary returned by final from the arrays of rates_ci_batch
+    i is the position of Italy, r is the position of Europe
+    Returns a dictionary.
+    """
+    return {"Year": year, "Sex": sex, "Crude It": float(ci["Crude"][i]), "95% CI lower It Crude": float(ci["Crude lower"][i]), "95% CI upper It Crude": float(ci["Crude upper"][i]), 
+            "Crude EU": float(ci["Crude"][r]), "95% CI lower EU Crude": float(ci["Crude lower"][r]), "95% CI upper EU Crude": float(ci["Crude upper"][r]), 
+            "Std It": float(ci["Std"][i]), "95% CI lower It Std": float(ci["Std lower"][i]), "95% CI upper It Std": float(ci["Std upper"][i]), 
+            "Std EU": float(ci["Std"][r]), "95% CI lower EU Std": float(ci["Std lower"][r]), "95% CI upper EU Std": float(ci["Std upper"][r])}
+
 def final(df, year, sex, alpha=0.05):
     """
     Function used to calulate Standardized rates and use them to creathe the final df.
     You need a df with the columns Deaths_It, Total_It, Deaths_EU and Total_EU, which will be used to calculate general raw mortality rate.
-    The df must also contain the columns Exp_Deaths_on_Std_It, Exp_Deaths_on_Std_EU and Pop_Std, which will be used to calculate standardized rates.
+    The df must also contain the column Pop_Std, which will be used to calculate standardized rates.
+    Italy and Europe are calculated together with rates_ci_batch, the df is not modified.
     Returns a dictionary.
     """
-    # Calculating the crude rates and lower and upper limits for 95% CIs.
     if df["Total_It"].sum() <= 0:
       raise ValueError("Total_It sum is negative or zero, cannot calculate crude rates")
-    rate_raw_it = (df["Deaths_It"].sum()/df["Total_It"].sum())*100000
-    lower_count_it = 0.5 * chi2.ppf(alpha/2, 2*(df["Deaths_It"].sum())) if df["Deaths_It"].sum() > 0 else 0.0
-    upper_count_it = 0.5 * chi2.ppf(1 - alpha/2, 2*(df["Deaths_It"].sum()+1))
-    lower_rate_it = lower_count_it / df["Total_It"].sum() * 100000
-    upper_rate_it = upper_count_it / df["Total_It"].sum() * 100000
     if df["Total_EU"].sum() <= 0:
       raise ValueError("Total_EU sum is negative or zero, cannot calculate crude rates")
-    rate_raw_eu = (df["Deaths_EU"].sum()/df["Total_EU"].sum())*100000
-    lower_count_eu = 0.5 * chi2.ppf(alpha/2, 2*(df["Deaths_EU"].sum())) if df["Deaths_EU"].sum() > 0 else 0.0
-    upper_count_eu = 0.5 * chi2.ppf(1 - alpha/2, 2*(df["Deaths_EU"].sum()+1))
-    lower_rate_eu = lower_count_eu / df["Total_EU"].sum() * 100000
-    upper_rate_eu = upper_count_eu / df["Total_EU"].sum() * 100000
+    ci = rates_ci_batch(df[["Deaths_It", "Deaths_EU"]].to_numpy(dtype=np.float64).T, df[["Total_It", "Total_EU"]].to_numpy(dtype=np.float64).T, 
+                        df["Pop_Std"].to_numpy(dtype=np.float64), alpha)
+    return _final_dict(ci, 0, 1, year, sex)
+
+def final_batch(data, alpha=0.05):
     """
-    Calculating standardized rates and 95% CIs using gamma method by Fay & Feuer.
+    Function used to calculate the results of final for many strata with a single rates_ci_batch call.
+    data must be a list of tuples (df, year, sex) with the dfs in the format used by final (all with the same age classes).
+    Returns a list of dictionaries, in the same order of data.
     """
-    if df["Pop_Std"].sum() <= 0:
-      raise ValueError("Pop_Std sum is negative or zero, cannot calculate standardized rates")
-    df["weights"] = df["Pop_Std"]/(df["Pop_Std"].sum())
-    rate_std_it = (df["Exp_Deaths_on_Std_It"].sum()/df["Pop_Std"].sum())
-    num_it = (np.sum(df["weights"] * (df["Deaths_It"]/df["Total_It"]) ))**2
-    den_it = np.sum((df["weights"]**2) * (df["Deaths_It"] / (df["Total_It"]**2)))
-    k_it = num_it/den_it if den_it > 0 else 0
-    if k_it>0:
-        lower_std_it = ((rate_std_it*2*k_it) / ((chi2.ppf(1-(alpha/2), 2*k_it))))
-        lower_std_it = lower_std_it*100000
-        upper_std_it = ((rate_std_it*2*(k_it+1)) / (chi2.ppf(alpha/2, 2*(k_it+1))))
-        upper_std_it = upper_std_it*100000
-    else:
-        lower_std_it, upper_std_it = 0, 0
-    rate_std_eu = (df["Exp_Deaths_on_Std_EU"].sum()/df["Pop_Std"].sum())
-    num_eu = (np.sum(df["weights"] * (df["Deaths_EU"]/df["Total_EU"]) ))**2
-    den_eu = np.sum((df["weights"]**2) * (df["Deaths_EU"] / (df["Total_EU"]**2)))
-    k_eu = num_eu/den_eu if den_eu > 0 else 0
-    if k_eu>0:
-        lower_std_eu = ((rate_std_eu*2*k_eu) / ((chi2.ppf(1-(alpha/2), 2*k_eu))))
-        lower_std_eu = lower_std_eu*100000
-        upper_std_eu = ((rate_std_eu*2*(k_eu+1)) / (chi2.ppf(alpha/2, 2*(k_eu+1))))
-        upper_std_eu = upper_std_eu*100000
-    else:
-        lower_std_eu, upper_std_eu = 0, 0
-    rate_std_it = rate_std_it*100000
-    rate_std_eu = rate_std_eu*100000
-    return {"Year": year, "Sex": sex, "Crude It": rate_raw_it, "95% CI lower It Crude": lower_rate_it, "95% CI upper It Crude": upper_rate_it, 
-            "Crude EU": rate_raw_eu, "95% CI lower EU Crude": lower_rate_eu, "95% CI upper EU Crude": upper_rate_eu, 
-            "Std It": rate_std_it, "95% CI lower It Std": lower_std_it, "95% CI upper It Std": upper_std_it, 
-            "Std EU": rate_std_eu, "95% CI lower EU Std": lower_std_eu, "95% CI upper EU Std": upper_std_eu}
+    if not data:
+        return []
+    deaths = np.stack([df[["Deaths_It", "Deaths_EU"]].to_numpy(dtype=np.float64).T for df, year, sex in data])
+    population = np.stack([df[["Total_It", "Total_EU"]].to_numpy(dtype=np.float64).T for df, year, sex in data])
+    ci = rates_ci_batch(deaths, population, data[0][0]["Pop_Std"].to_numpy(dtype=np.float64), alpha)
+    return [_final_dict({key: value[i] for key, value in ci.items()}, 0, 1, year, sex) for i, (df, year, sex) in enumerate(data)]
+
+def final_cube(cube, geo, ref, alpha=0.05):
+    """
+    Function used to calculate the results of final for every (year, sex) of the cube (see rate_cube.rate_cube) with a single rates_ci_batch call.
+    geo takes the It columns and ref the EU columns.
+    Returns a list of dictionaries, ordered by sex and then by year.
+    """
+    g, r = cube["Geo"].index(geo), cube["Geo"].index(ref)
+    ci = rates_ci_batch(cube["Deaths"][[g, r]], cube["Total"][[g, r]], cube["Pop_Std"], alpha)
+    return [_final_dict({key: value[:, y, s] for key, value in ci.items()}, 0, 1, year, sex) 
+            for s, sex in enumerate(cube["Sex"]) for y, year in enumerate(cube["Year"])]
 
 def dataframe_final(results):
     """
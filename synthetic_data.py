@@ -0,0 +1,143 @@
+# synthetic input files, in the same formats of the ISTAT and Eurostat files, used to see how the analysis scales
+
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from utility import age_conversion_it, age_conversion_eu, age_groups
+from multi_country import EU27_label
+
+# labels of the sexes in the Eurostat files and in the bulk files
+sex_labels = {"Tot": "Total", "M": "Males", "F": "Females"}
+sex_codes_bulk = {"Tot": "T", "M": "M", "F": "F"}
+# age codes of the Eurostat bulk files, in the same order of age_groups
+age_codes_bulk = ["Y_LT1"] + [f"Y{age}" for age in age_groups[1:-1]] + ["Y_GE95"]
+# ESP2013, in the same order of age_groups
+esp2013 = [1000, 4000, 5500, 5500, 5500, 6000, 6000, 6500, 7000, 7000, 7000, 7000, 6500, 6000, 5500, 5000, 4000, 2500, 1500, 800, 200]
+
+def synthetic_arrays(years, n_geos=2, n_causes=1, seed=0):
+    """
+    Function used to create populations and deaths with a realistic age pattern
+    The first geo is Italy and the second one is EU27, the other geos are countries: the EU27 is the sum of all the countries and of a "rest of Europe",
+    so the sensitivity analysis (also leave-one-out) is always valid
+    Returns 2 arrays: population indexed by [geo, year, sex (M, F), age] and deaths indexed by [cause, geo, year, sex (M, F), age]
+    """
+    if n_geos < 2:
+        raise ValueError("At least 2 geos are needed (Italy and EU27)")
+    rng = np.random.default_rng(seed)
+    n_ages = len(age_groups)
+    members = [0] + list(range(2, n_geos))
+    population = rng.integers(100000, 2000000, size=(n_geos, len(years), 2, n_ages)).astype(np.int64)
+    # EU27 = all the other geos + rest of Europe
+    rest = rng.integers(1000000, 20000000, size=(len(years), 2, n_ages))
+    population[1] = population[members].sum(axis=0) + rest
+    # mortality rates growing with age, split among the causes
+    rates = np.geomspace(1e-6, 2e-2, n_ages)
+    shares = rng.dirichlet(np.ones(n_causes))
+    deaths = rng.poisson(shares[:, None, None, None, None] * rates * population)
+    deaths[:, 1] = deaths[:, members].sum(axis=1) + rng.poisson(shares[:, None, None, None] * rates * rest)
+    return population, deaths
+
+def _with_total(array, axis):
+    """
+    Function used to add the total of males and females to the sex axis (in the order Tot, M, F)
+    """
+    return np.concatenate([array.sum(axis=axis, keepdims=True), array], axis=axis)
+
+def generate(data_dir, years=(2020, 2021, 2022), sexes=("Tot", "M", "F"), n_geos=2, n_causes=1, seed=0):
+    """
+    Function used to write synthetic input files in data_dir, with the same columns and formats read by the loaders of utility.py and eurostat_bulk.py:
+    Deaths_Italy_{sex}.csv, Deaths_Europe_{sex}.csv, Italian_Population_{year}.csv, European_Population.csv, ESP2013.csv (used by analysis.py),
+    Deaths_Europe_Countries.csv, Population_Europe_Countries.csv (used by multi_country.py),
+    Deaths_Bulk.csv (SDMX-CSV with the icd10 dimension) and Population_Bulk.csv (SDMX-CSV like demo_pjan), used by multi_cause.py
+    The deaths of the files used by analysis.py are the sum of all the causes
+    Returns a dict with the paths of the files written
+    """
+    data_dir = Path(data_dir)
+    data_dir.mkdir(parents=True, exist_ok=True)
+    years = list(years)
+    population, deaths = synthetic_arrays(years, n_geos=n_geos, n_causes=n_causes, seed=seed)
+    population = _with_total(population, axis=2)
+    deaths = _with_total(deaths, axis=3)
+    all_sexes = ["Tot", "M", "F"]
+    geos = ["Italy", EU27_label] + [f"Country {i}" for i in range(1, n_geos - 1)]
+    geo_codes = ["IT", "EU27_2020"] + [f"G{i:02d}" for i in range(1, n_geos - 1)]
+    causes = [f"C{i:02d}" for i in range(n_causes)]
+    it_ages, eu_ages = list(age_conversion_it), list(age_conversion_eu)
+    total_deaths = deaths.sum(axis=0)
+    paths = {}
+    for sex in sexes:
+        s = all_sexes.index(sex)
+        index = pd.MultiIndex.from_product([years, it_ages], names=["TIME_PERIOD", "Età"]).to_frame(index=False)
+        df = pd.DataFrame({"DATAFLOW": "synthetic", "Età": index["Età"], "TIME_PERIOD": index["TIME_PERIOD"], "Osservazione": total_deaths[0, :, s].ravel()})
+        paths[f"Deaths_Italy_{sex}"] = data_dir / f"Deaths_Italy_{sex}.csv"
+        df.to_csv(paths[f"Deaths_Italy_{sex}"], index=False)
+        index = pd.MultiIndex.from_product([years, eu_ages], names=["TIME_PERIOD", "Age class"]).to_frame(index=False)
+        df = pd.DataFrame({"DATAFLOW": "synthetic", "Age class": index["Age class"], "TIME_PERIOD": index["TIME_PERIOD"], "OBS_VALUE": total_deaths[1, :, s].ravel()})
+        paths[f"Deaths_Europe_{sex}"] = data_dir / f"Deaths_Europe_{sex}.csv"
+        df.to_csv(paths[f"Deaths_Europe_{sex}"], index=False)
+    for y, year in enumerate(years):
+        df = pd.DataFrame({"Age_Group": it_ages, "Total_M": population[0, y, 1], "Total_F": population[0, y, 2], "Total": population[0, y, 0]})
+        paths[f"Italian_Population_{year}"] = data_dir / f"Italian_Population_{year}.csv"
+        df.to_csv(paths[f"Italian_Population_{year}"], sep=";", index=False)
+    df = pd.DataFrame({"Age Group": eu_ages})
+    for y, year in enumerate(years):
+        for s, sex in enumerate(all_sexes):
+            df[f"{sex_labels[sex]} {year}"] = population[1, y, s]
+    paths["European_Population"] = data_dir / "European_Population.csv"
+    df.to_csv(paths["European_Population"], sep=";", index=False)
+    paths["ESP2013"] = data_dir / "ESP2013.csv"
+    pd.DataFrame({"Age group": age_groups, "Standard population (ESP2013)": esp2013}).to_csv(paths["ESP2013"], sep=";", index=False)
+    # files with the Geopolitical entity dimension, in the order geo, year, sex, age
+    index = pd.MultiIndex.from_product([geos, years, [sex_labels[sex] for sex in all_sexes], eu_ages]).to_frame(index=False)
+    for name, values in [("Deaths_Europe_Countries", total_deaths), ("Population_Europe_Countries", population)]:
+        df = pd.DataFrame({"Geopolitical entity (reporting)": index[0], "Sex": index[2], "Age class": index[3], "TIME_PERIOD": index[1], "OBS_VALUE": values.ravel()})
+        paths[name] = data_dir / f"{name}.csv"
+        df.to_csv(paths[name], index=False)
+    # bulk file with the cause of death, in the order cause, geo, year, sex, age
+    index = pd.MultiIndex.from_product([causes, geo_codes, years, [sex_codes_bulk[sex] for sex in all_sexes], age_codes_bulk]).to_frame(index=False)
+    df = pd.DataFrame({"freq": "A", "unit": "NR", "sex": index[3], "age": index[4], "icd10": index[0], "resid": "TOT_IN", "geo": index[1],
+                       "TIME_PERIOD": index[2], "OBS_VALUE": deaths.ravel()})
+    paths["Deaths_Bulk"] = data_dir / "Deaths_Bulk.csv"
+    df.to_csv(paths["Deaths_Bulk"], index=False)
+    index = pd.MultiIndex.from_product([geo_codes, years, [sex_codes_bulk[sex] for sex in all_sexes], age_codes_bulk]).to_frame(index=False)
+    df = pd.DataFrame({"freq": "A", "unit": "NR", "age": index[3], "sex": index[2], "geo": index[0], "TIME_PERIOD": index[1], "OBS_VALUE": population.ravel()})
+    paths["Population_Bulk"] = data_dir / "Population_Bulk.csv"
+    df.to_csv(paths["Population_Bulk"], index=False)
+    return paths
+
+def generate_microdata(data_dir, years=(2020, 2021, 2022), n_geos=2, n_causes=1, seed=0, n_shards=1, n_unknown=0, n_regions=20):
+    """
+    Function used to write the deaths of Italy of synthetic_arrays as individual records (one row per death, with the columns of
+    microdata.microdata_columns: single age, sex coded 1/2, year, ICD-10 cause and region of residence), split in n_shards files
+    Deaths_Records_{shard}.csv; with the same arguments of generate the records add up to the deaths of Deaths_Italy_{sex}.csv
+    n_unknown records without age are added to the first shard (they are dropped by the aggregator)
+    The records are written one year at a time, so the memory used depends on the deaths of a year
+    Returns the list of the paths of the files written
+    """
+    data_dir = Path(data_dir)
+    data_dir.mkdir(parents=True, exist_ok=True)
+    years = list(years)
+    _, deaths = synthetic_arrays(years, n_geos=n_geos, n_causes=n_causes, seed=seed)
+    # deaths of Italy indexed by [cause, year, sex (M, F), age]
+    deaths = deaths[:, 0]
+    rng = np.random.default_rng(seed + 1)
+    # first and last single age of every age class (95+ up to 104)
+    starts = np.array([0, 1] + [int(age.split("-")[0]) for age in age_groups[2:-1]] + [95])
+    ends = np.array([0, 4] + [int(age.split("-")[1]) for age in age_groups[2:-1]] + [104])
+    paths = [data_dir / f"Deaths_Records_{shard}.csv" for shard in range(n_shards)]
+    for y, year in enumerate(years):
+        cells = deaths[:, y].ravel()
+        cause, sex, age = np.unravel_index(np.repeat(np.arange(cells.size), cells), deaths[:, y].shape)
+        shard = rng.integers(0, n_shards, size=age.size)
+        df = pd.DataFrame({"year": year, "sex": sex + 1, "age": rng.integers(starts[age], ends[age] + 1), "cause": np.char.add("C", np.char.zfill((cause * 97 // max(n_causes, 1)).astype(str), 2)),
+                           "residence": np.char.add("R", np.char.zfill(rng.integers(1, n_regions + 1, size=age.size).astype(str), 2))})
+        if y == 0 and n_unknown:
+            df = pd.concat([df, pd.DataFrame({"year": year, "sex": rng.integers(1, 3, size=n_unknown), "age": np.nan, "cause": "C00", "residence": "R01"})], ignore_index=True)
+            shard = np.concatenate([shard, np.zeros(n_unknown, dtype=shard.dtype)])
+        for s, path in enumerate(paths):
+            df.loc[shard == s].to_csv(path, mode="w" if y == 0 else "a", header=y == 0, index=False)
+    return paths
+
+if __name__ == "__main__":
+    # written in a separate folder, so the real data in data/ are never overwritten
+    generate(Path("data_synthetic"))
@@ -0,0 +1,177 @@
+# functions to build the result tables and to write them as CSV, HTML, LaTeX and Markdown without rendering them
+
+import functools
+import html
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from artifacts import atomic_path, write_text
+
+# formats written by write_table, chosen from the extension of the path
+table_formats = ["csv", "html", "tex", "md"]
+# special characters of LaTeX and their escapes, the backslash is replaced by a placeholder first (its escape has braces, escaped later)
+latex_escapes = [("\\", "\x1a"), ("&", r"\&"), ("%", r"\%"), ("$", r"\$"), ("#", r"\#"), ("_", r"\_"),
+                 ("{", r"\{"), ("}", r"\}"), ("~", r"\textasciitilde{}"), ("^", r"\textasciicircum{}"), ("\x1a", r"\textbackslash{}")]
+
+def format_numbers(values, decimals=2):
+    """
+    Function used to round an array of numbers and convert it in strings with a single vectorized call, without modifying values
+    The numbers are written like str(round(x, decimals)), e.g. 12.5 and not 12.50
+    Returns an array of strings
+    """
+    return np.round(np.asarray(values, dtype=np.float64), decimals).astype(np.dtypes.StringDType())
+
+def format_ci(value, lower, upper, decimals=2):
+    """
+    Function used to write estimates with their confidence intervals as "value (lower-upper)", with vectorized string ufuncs (numpy.strings)
+    Returns an array of strings
+    """
+    strings = [format_numbers(values, decimals) for values in (value, lower, upper)]
+    return functools.reduce(np.strings.add, [strings[0], " (", strings[1], "-", strings[2], ")"])
+
+def _check_ci(df, columns):
+    """
+    Function used to check that the columns of an estimate with its CI exist, are not negative and that the estimate is inside the CI
+    columns is a tuple (estimate, lower, upper)
+    """
+    for column in columns:
+        if column not in df.columns:
+            raise ValueError(f"Required column missing: {column}")
+    value, lower, upper = (df[column].to_numpy(dtype=np.float64) for column in columns)
+    for column, values in zip(columns, (value, lower, upper)):
+        assert (values >= 0).all(), f"Negative values found: {column}"
+    assert (lower <= value).all(), f"Lower CI bigger than {columns[0]}"
+    assert (upper >= value).all(), f"Upper CI lower than {columns[0]}"
+
+def ci_table(df, estimates, keys=("Year", "Sex"), decimals=2):
+    """
+    Function used to build a table with the key columns of df and one "value (lower-upper)" column for each estimate
+    estimates is a dict column of the table -> (estimate, lower, upper) columns of df, e.g. {"Std Rate It (95% CI)": ("Std It", "95% CI lower It Std", "95% CI upper It Std")}
+    df is not modified
+    Returns the table as a df
+    """
+    for column in keys:
+        if column not in df.columns:
+            raise ValueError(f"Required column missing: {column}")
+    for columns in estimates.values():
+        _check_ci(df, columns)
+    df_table = df[list(keys)].reset_index(drop=True)
+    for name, (value, lower, upper) in estimates.items():
+        df_table[name] = format_ci(df[value], df[lower], df[upper], decimals)
+    return df_table
+
+def results_table(df, decimals=2):
+    """
+    Table 1 - raw and standardized mortality rate per years, sex and country, from the final df (see standardize_rates.dataframe_final)
+    Returns the table as a df
+    """
+    return ci_table(df, {"Crude Rate It (95% CI)": ("Crude It", "95% CI lower It Crude", "95% CI upper It Crude"),
+                         "Crude Rate EU (95% CI)": ("Crude EU", "95% CI lower EU Crude", "95% CI upper EU Crude"),
+                         "Std Rate It (95% CI)": ("Std It", "95% CI lower It Std", "95% CI upper It Std"),
+                         "Std Rate EU (95% CI)": ("Std EU", "95% CI lower EU Std", "95% CI upper EU Std")}, decimals=decimals)
+
+def sensitivity_table(df, df1, decimals=2):
+    """
+    Table 2 - raw and standardized mortality rate per years, sex and country for the sensitivity analysis
+    df is the final df of the sensitivity analysis (EU without Italy) and df1 the final df (EU), with the strata in the same order
+    Returns the table as a df
+    """
+    df_eu = ci_table(df1, {"Crude Rate EU (95% CI)": ("Crude EU", "95% CI lower EU Crude", "95% CI upper EU Crude"),
+                           "Std Rate EU (95% CI)": ("Std EU", "95% CI lower EU Std", "95% CI upper EU Std")}, decimals=decimals)
+    df_eu_it = ci_table(df, {"Crude Rate EU-It (95% CI)": ("Crude EU-It", "95% CI lower EU-It Crude", "95% CI upper EU-It Crude"),
+                             "Std Rate EU-It (95% CI)": ("Std EU-It", "95% CI lower EU-It Std", "95% CI upper EU-It Std")}, decimals=decimals)
+    assert df_eu[["Year", "Sex"]].equals(df_eu_it[["Year", "Sex"]]), "The strata of the two dfs don't coincide"
+    return pd.concat([df_eu_it[["Year", "Sex"]], df_eu["Crude Rate EU (95% CI)"], df_eu_it["Crude Rate EU-It (95% CI)"],
+                      df_eu["Std Rate EU (95% CI)"], df_eu_it["Std Rate EU-It (95% CI)"]], axis=1)
+
+def kitagawa_table(df, decimals=2):
+    """
+    Table 3 - values of the Kitagawa decomposition, rounded on a copy of df
+    Returns the table as a df
+    """
+    columns = ["Year", "Sex", "Effect of Age Structure", "Effect of Rates", "Difference"]
+    for column in columns:
+        if column not in df.columns:
+            raise ValueError(f"Required column missing: {column}")
+    return df.round({"Effect of Age Structure": decimals, "Effect of Rates": decimals, "Difference": decimals}).reset_index(drop=True)
+
+def _cells(df_table):
+    """
+    Function used to convert the header and the cells of a table in arrays of strings
+    Returns the header (1-D) and the cells (one row for each row of the table)
+    """
+    return np.array([str(column) for column in df_table.columns], dtype=np.dtypes.StringDType()), df_table.to_numpy().astype(np.dtypes.StringDType())
+
+def _join_rows(cells, separator):
+    """
+    Function used to join the cells of every row, a column at a time for all the rows at once
+    Returns a 1-D array of strings
+    """
+    return functools.reduce(lambda left, right: np.strings.add(np.strings.add(left, separator), right), cells.T)
+
+def to_markdown(df_table):
+    """
+    Function used to write a table in Markdown (pipe table)
+    Returns a string
+    """
+    header, cells = _cells(df_table)
+    header, cells = np.strings.replace(header, "|", r"\|"), np.strings.replace(cells, "|", r"\|")
+    lines = ["| " + " | ".join(header) + " |", "|" + "|".join(["---"] * len(header)) + "|"]
+    if len(cells):
+        lines += list(np.strings.add(np.strings.add("| ", _join_rows(cells, " | ")), " |"))
+    return "\n".join(lines) + "\n"
+
+def _escape_latex(strings):
+    """
+    Function used to escape the special characters of LaTeX in an array of strings
+    """
+    for character, escape in latex_escapes:
+        strings = np.strings.replace(strings, character, escape)
+    return strings
+
+def to_latex(df_table, caption=None):
+    """
+    Function used to write a table in LaTeX (tabular environment with the rules of the booktabs package)
+    Returns a string
+    """
+    header, cells = _cells(df_table)
+    header, cells = _escape_latex(header), _escape_latex(cells)
+    lines = [r"\begin{table}[ht]", r"\centering"]
+    if caption:
+        lines.append(r"\caption{" + str(_escape_latex(np.array([caption], dtype=np.dtypes.StringDType()))[0]) + "}")
+    lines += [r"\begin{tabular}{" + "l" * len(header) + "}", r"\toprule", " & ".join(header) + r" \\", r"\midrule"]
+    if len(cells):
+        lines += list(np.strings.add(_join_rows(cells, " & "), r" \\"))
+    lines += [r"\bottomrule", r"\end{tabular}", r"\end{table}"]
+    return "\n".join(lines) + "\n"
+
+def to_html(df_table, caption=None):
+    """
+    Function used to write a table in HTML (pandas.DataFrame.to_html, the cells are escaped)
+    Returns a string
+    """
+    text = df_table.to_html(index=False, border=0, escape=True)
+    if caption:
+        text = text.replace(">", f">\n  <caption>{html.escape(caption)}</caption>", 1)
+    return text
+
+def write_table(df_table, path, caption=None):
+    """
+    Function used to write a table in the format given by the extension of path (.csv, .html, .tex or .md)
+    caption is used as title in HTML and LaTeX, the file is replaced atomically (see artifacts.atomic_path)
+    Returns the path
+    """
+    path = Path(path)
+    table_format = path.suffix.lstrip(".").lower()
+    if table_format not in table_formats:
+        raise ValueError(f"Unknown table format: {table_format} (available: {', '.join(table_formats)})")
+    if table_format == "csv":
+        with atomic_path(path) as temp_path:
+            df_table.to_csv(temp_path, index=False)
+    elif table_format == "html":
+        write_text(path, to_html(df_table, caption))
+    elif table_format == "tex":
+        write_text(path, to_latex(df_table, caption))
+    else:
+        write_text(path, to_markdown(df_table))
+    return path
@@ -1,5 +1,9 @@
 # utility functions for loading and saving data
+import re
+from pathlib import Path
+import numpy as np
 import pandas as pd
+from cache import cached_loader
 # dict used to change the age column for european data
 age_conversion_eu = {"Less than 1 year": "0", "From 1 to 4 years": "1-4", "From 5 to 9 years": "5-9", 
                   "From 10 to 14 years": "10-14", "From 15 to 19 years": "15-19", "From 20 to 24 years": "20-24", 
@@ -15,21 +19,69 @@ age_conversion_it = {"0 anni": "0", "1-4 anni": "1-4", "5-9 anni": "5-9", "10-14
                   "60-64 anni": "60-64", "65-69 anni": "65-69", "70-74 anni": "70-74", "75-79 anni": "75-79",
                   "80-84 anni": "80-84", "85-89 anni": "85-89", "90-94 anni": "90-94", "95 anni e più": "95+"}
 
+# ordered list of the age classes used in the analysis
+age_groups = list(age_conversion_it.values())
+# ordered categorical type of the age classes: the code of every age class is its position in age_groups
+age_dtype = pd.CategoricalDtype(age_groups, ordered=True)
+
+# dict used to change the sex labels of the population files
+sex_conversion_pop = {"Total": "Tot", "Males": "M", "Females": "F"}
+
+def to_age_category(values, type_of_conversion=None):
+    """
+    Function used to convert the labels of the age classes (italian, european or already converted) in the ordered categorical age_dtype
+    Every distinct label is converted only once, then the codes are spread to the rows with a positional take
+    type_of_conversion is the dict with the labels to convert (both the italian and the european ones if None)
+    Returns a categorical Series with the same index of values
+    """
+    values = pd.Series(values)
+    if values.dtype == age_dtype:
+        return values
+    conversion = {**age_conversion_it, **age_conversion_eu} if type_of_conversion is None else type_of_conversion
+    codes_map = {**{age: code for code, age in enumerate(age_groups)}, **{label: age_groups.index(age) for label, age in conversion.items()}}
+    inverse, uniques = pd.factorize(values)
+    codes = np.array([codes_map.get(str(label).strip(), -1) for label in uniques], dtype=np.int8)
+    unknown = [label for label, code in zip(uniques, codes) if code < 0]
+    if unknown or (inverse < 0).any():
+        raise ValueError(f"Unknown age classes: {unknown if unknown else 'missing values'}")
+    return pd.Series(pd.Categorical.from_codes(codes[inverse], dtype=age_dtype), index=values.index, name=values.name)
+
+def age_codes(values):
+    """
+    Function used to find the code (position in age_groups) of every age class
+    Returns an int8 array
+    """
+    return to_age_category(values).cat.codes.to_numpy()
+
+def compact_counts(values):
+    """
+    Function used to store counts (deaths and population) in a compact type: int32 when all the values are integers that fit in it,
+    float64 otherwise (e.g. when there are missing values)
+    Returns a Series
+    """
+    values = pd.to_numeric(values)
+    array = values.to_numpy(dtype=np.float64)
+    if not np.isnan(array).any() and (array == np.floor(array)).all() and (np.abs(array) < 2**31).all():
+        return values.astype(np.int32)
+    return values.astype(np.float64)
+
 def rename_age_column(df, type_of_conversion):
     """
     Function used to change the age columns, based on the type of conversion choosed (european or italian)
-    The df used must have the column "Age"
+    The df used must have the column "Age", which becomes an ordered categorical (see to_age_category)
     Returns a df
     """
     if "Age" in df.columns:
-        df["Age"] = df["Age"].replace(type_of_conversion)
+        df["Age"] = to_age_category(df["Age"], type_of_conversion)
     return df
 
-def load_data_ISTAT_Deaths(Istat_Deaths):
+@cached_loader("3")
+def load_data_ISTAT_Deaths(Istat_Deaths, years=None):
     """
     Function to read ISTAT deaths files.
     The file must contain the Età, TIME_PERIOD and Osservazione columns
     Changes the Age column to simplify the merging of dfs (from "Età" to "Age")
+    If years is given, it checks that the file has only those years
     Returns df with Age, Year and Deaths for Italy
     """
     df = pd.read_csv(Istat_Deaths, usecols=["Età", "TIME_PERIOD", "Osservazione"])
@@ -37,15 +89,19 @@ def load_data_ISTAT_Deaths(Istat_Deaths):
                             "TIME_PERIOD": "Year", 
                             "Osservazione": "Deaths"
                             })
-    df[["Year", "Deaths"]]=df[["Year", "Deaths"]].apply(pd.to_numeric)
+    df["Year"] = pd.to_numeric(df["Year"])
+    df["Deaths"] = compact_counts(df["Deaths"])
     df = rename_age_column(df, age_conversion_it)
-    assert df["Year"].isin([2020, 2021, 2022]).all(), "Unexpected years found"
+    if years is not None:
+        assert df["Year"].isin(years).all(), "Unexpected years found"
     return df
 
-def load_data_EUROSTAT_Deaths(Eurostat_Deaths):
+@cached_loader("3")
+def load_data_EUROSTAT_Deaths(Eurostat_Deaths, years=None):
     """
     Function to read Eurostat deaths files.
     The file must contain the Age class, TIME_PERIOD and OBS_VALUE columns
+    If years is given, it checks that the file has only those years
     Returns df with Age, Year and Deaths for Europe
     Changes the Age column to simplify the merging of dfs (from "Age class" to "Age")
     The Eurostat file must have the Age column as "Less than 1 year, From 1 to 4 years, ..., From 90 to 94 years, 95 years and more
@@ -56,11 +112,42 @@ def load_data_EUROSTAT_Deaths(Eurostat_Deaths):
                             "TIME_PERIOD": "Year", 
                             "OBS_VALUE": "Deaths"
                             })
-    df[["Year", "Deaths"]]=df[["Year", "Deaths"]].apply(pd.to_numeric)
+    df["Year"] = pd.to_numeric(df["Year"])
+    df["Deaths"] = compact_counts(df["Deaths"])
     df = rename_age_column(df, age_conversion_eu)
-    assert df["Year"].isin([2020, 2021, 2022]).all(), "Unexpected years found"
+    if years is not None:
+        assert df["Year"].isin(years).all(), "Unexpected years found"
     return df
 
+@cached_loader("2")
+def load_data_EUROSTAT_geo(Eurostat_File, value="Deaths"):
+    """
+    Function to read Eurostat files that keep the Geopolitical entity and Sex dimensions (one row for each geo, sex, age class and year)
+    It's used both for deaths and for population (already aggregated in the age classes of the deaths files)
+    The file must contain the Geopolitical entity, Sex, Age class, TIME_PERIOD and OBS_VALUE columns
+    value is the name given to the OBS_VALUE column ("Deaths" for deaths and "Total" for population)
+    Returns a long df with Geo, Year, Sex, Age and value
+    """
+    df = pd.read_csv(Eurostat_File, usecols=lambda column: column.startswith("Geopolitical entity") or column in ["Sex", "Age class", "TIME_PERIOD", "OBS_VALUE"])
+    geo_columns = [column for column in df.columns if column.startswith("Geopolitical entity")]
+    if len(geo_columns) != 1:
+        raise ValueError("The Eurostat file must have exactly one Geopolitical entity column")
+    for column in ["Sex", "Age class", "TIME_PERIOD", "OBS_VALUE"]:
+        if column not in df.columns:
+            raise ValueError(f"Required column missing: {column}")
+    df = df.rename(columns={geo_columns[0]: "Geo", 
+                            "Age class": "Age", 
+                            "TIME_PERIOD": "Year", 
+                            "OBS_VALUE": value
+                            })
+    df["Year"] = pd.to_numeric(df["Year"])
+    df[value] = compact_counts(df[value])
+    df["Sex"] = df["Sex"].replace(sex_conversion_pop)
+    df = rename_age_column(df, age_conversion_eu)
+    assert not (df[value]<0).any(), f"Found negative values in {value}"
+    return df[["Geo", "Year", "Sex", "Age", value]]
+
+@cached_loader("2")
 def load_standard_pop(std_pop):
     """
     Function used to read the file with the standard population (in this case the ESP2013)
@@ -71,48 +158,113 @@ def load_standard_pop(std_pop):
     df = pd.read_csv(std_pop, sep=";")
     df = df.rename(columns={"Age group": "Age", 
                             "Standard population (ESP2013)": "Pop_Std"})
+    df = rename_age_column(df, age_conversion_it)
     assert (df["Pop_Std"]>0).all(), "Found zero or negative population values"
     return df
 
-def year_subdivision(df):
+def year_partition(df):
+    """
+    Function used to divide a df in one df for each year, with a single groupby
+    The df must have the Year column
+    Returns a dict year -> df, sorted by year
+    """
+    return {year: df_year for year, df_year in df.groupby("Year", sort=True)}
+
+def year_subdivision(df, years=(2020, 2021, 2022)):
     """
     Function used to divide a df into 3 different dfs, each one with one of the 3 years in study (2020, 2021, 2022)
     The df must have the Year column
+    It's a view of year_partition, years can be changed to get other years
     Returns 3 dfs: df_2020, df_2021 and df_2022, each one with the information in the original file, but only for the year specified
     """
-    df_2020 = df.loc[df["Year"]==2020]
-    df_2021 = df.loc[df["Year"]==2021]
-    df_2022 = df.loc[df["Year"]==2022]
-    return df_2020, df_2021, df_2022
+    partition = year_partition(df)
+    return tuple(partition.get(year, df.iloc[0:0]) for year in years)
+
+def population_view(df, year=None, sex="Tot"):
+    """
+    Function used to extract a single stratum from a long population df (the one returned by the *_Pop_long loaders)
+    The df must have the columns Year, Sex, Age and Total; year can be None for files without a Year column
+    Returns a df with 2 columns, one with Age and one with Population, in the same format used by the old loaders
+    """
+    mask = df["Sex"] == sex
+    if year is not None:
+        mask = mask & (df["Year"] == year)
+    df_view = df.loc[mask, ["Age", "Total"]].reset_index(drop=True)
+    assert not df_view.empty, f"No population found for year {year} and sex {sex}"
+    return df_view
+
+@cached_loader("2")
+def _read_ISTAT_Pop(Istat_Pop):
+    """
+    Function used to read the ISTAT population file only once and to reshape it in a long format
+    Returns a df with Sex, Age and Total
+    """
+    df = pd.read_csv(Istat_Pop, sep=";", usecols=["Age_Group", "Total", "Total_M", "Total_F"])
+    df = df.rename(columns={"Age_Group": "Age", 
+                            "Total": "Tot", 
+                            "Total_M": "M", 
+                            "Total_F": "F"
+                            })
+    df = rename_age_column(df, age_conversion_it)
+    df = df.melt(id_vars="Age", value_vars=["Tot", "M", "F"], var_name="Sex", value_name="Total")
+    df["Total"] = compact_counts(df["Total"])
+    assert (df["Total"]>=0).all(), "Found zero or negative population values"
+    return df[["Sex", "Age", "Total"]]
+
+def load_data_ISTAT_Pop_long(Istat_Pop, year=None, geo="IT"):
+    """
+    Function used to read ISTAT files with the italian population in a single pass
+    ISTAT files don't have a year column, so if year is None it is taken from the file name (e.g. Italian_Population_2020.csv)
+    The file must have the columns Age_Group, Total, Total_M and Total_F
+    Returns a long df with Geo, Year, Sex, Age and Total
+    """
+    if year is None:
+        found = re.search(r"(\d{4})", Path(Istat_Pop).stem)
+        if found is None:
+            raise ValueError(f"Year not found in the file name {Istat_Pop}, pass it explicitly")
+        year = int(found.group(1))
+    df = _read_ISTAT_Pop(Istat_Pop)
+    df.insert(0, "Geo", geo)
+    df.insert(1, "Year", year)
+    return df
 
 def load_data_ISTAT_Pop(Istat_Pop):
     """
     Function used to read ISTAT files with the italian population
     Usually ISTAT has files divided by years that's why for ISTAT we have a different function than Eurostat, which has everything togheter
     The file must have the columns Age_Group, Total, Total_M and Total_F
-    Changes the Age column to simplify the merging of dfs (from "Age_Group" to "Age")
+    The file is read only once, the 3 dfs are views of the long df (see load_data_ISTAT_Pop_long)
     Return 3 dfs: df_Tot, df_M and df_F each one with 2 columns, one with Age and one with Population
     """
-    df_Tot = pd.read_csv(Istat_Pop, sep=";", usecols=["Age_Group", "Total"])
-    df_Tot = df_Tot.rename(columns={"Age_Group": "Age", 
-                           "Total": "Total"
-                           })
-    df_Tot = rename_age_column(df_Tot, age_conversion_it)
-    assert (df_Tot["Total"]>=0).all(), "Found zero or negative population values"
-    df_M = pd.read_csv(Istat_Pop, sep=";", usecols=["Age_Group", "Total_M"])
-    df_M = df_M.rename(columns={"Age_Group": "Age", 
-                           "Total_M": "Total"
-                           })
-    df_M = rename_age_column(df_M, age_conversion_it)
-    assert (df_M["Total"]>=0).all(), "Found zero or negative population values"
-    df_F = pd.read_csv(Istat_Pop, sep=";", usecols=["Age_Group", "Total_F"])
-    df_F = df_F.rename(columns={"Age_Group": "Age", 
-                           "Total_F": "Total"
-                           })
-    df_F = rename_age_column(df_F, age_conversion_it)
-    assert (df_F["Total"]>=0).all(), "Found zero or negative population values"
+    df = _read_ISTAT_Pop(Istat_Pop)
+    df_Tot = population_view(df, sex="Tot")
+    df_M = population_view(df, sex="M")
+    df_F = population_view(df, sex="F")
     return df_Tot, df_M, df_F
 
+@cached_loader("2")
+def load_data_Eurostat_Pop_long(Eurostat_Pop, geo="EU27_2020"):
+    """
+    Function used to read Eurostat files with population in a single pass
+    The file must contain the column Age Group and one column for each sex and year, named "Total YYYY", "Males YYYY" or "Females YYYY"
+    Other columns (e.g. "Flag and Footnotes") are ignored
+    Returns a long df with Geo, Year, Sex, Age and Total
+    """
+    pattern = re.compile(r"^(Total|Males|Females) (\d{4})$")
+    df = pd.read_csv(Eurostat_Pop, sep=";", usecols=lambda column: column == "Age Group" or pattern.match(column) is not None)
+    if df.shape[1] < 2:
+        raise ValueError("No population columns found in the Eurostat file")
+    df = df.rename(columns={"Age Group": "Age"})
+    df = rename_age_column(df, age_conversion_eu)
+    df = df.melt(id_vars="Age", var_name="Column", value_name="Total")
+    columns = df["Column"].str.extract(pattern)
+    df["Sex"] = columns[0].map(sex_conversion_pop)
+    df["Year"] = columns[1].astype(int)
+    df["Total"] = compact_counts(df["Total"])
+    assert (df["Total"]>0).all(), "Found zero or negative population values"
+    df.insert(0, "Geo", geo)
+    return df[["Geo", "Year", "Sex", "Age", "Total"]]
+
 def load_data_Eurostat_Pop(Eurostat_Pop):
     """
     Function used to read Eurostat files with population
@@ -121,54 +273,10 @@ def load_data_Eurostat_Pop(Eurostat_Pop):
                                      Total 2020, Males 2020, Females 2020,
                                      Total 2021, Males 2021, Females 2021,
                                      Total 2022, Males 2022, Females 2022
-    Changes the Age column to simplify the merging of dfs (from "Age Group" to "Age")
+    The file is read only once, the 9 dfs are views of the long df (see load_data_Eurostat_Pop_long)
     Returns 9 dfs: df_Tot_2020, df_Tot_2021, df_Tot_2022,
                   df_M_2020, df_M_2021, df_M_2022,
                   df_F_2020, df_F_2021, df_F_2022
     """
-    df_Tot_2020 = pd.read_csv(Eurostat_Pop, sep=";", usecols=["Age Group", "Total 2020"])
-    df_Tot_2020 = df_Tot_2020.rename(columns={"Age Group": "Age", 
-                                "Total 2020": "Total"})
-    df_Tot_2020 = rename_age_column(df_Tot_2020, age_conversion_eu)
-    assert (df_Tot_2020["Total"]>0).all(), "Found zero or negative population values"
-    df_M_2020 = pd.read_csv(Eurostat_Pop, sep=";", usecols=["Age Group", "Males 2020"])
-    df_M_2020 = df_M_2020.rename(columns={"Age Group": "Age", 
-                                "Males 2020": "Total"})
-    df_M_2020 = rename_age_column(df_M_2020, age_conversion_eu)
-    assert (df_M_2020["Total"]>0).all(), "Found zero or negative population values"
-    df_F_2020 = pd.read_csv(Eurostat_Pop, sep=";", usecols=["Age Group", "Females 2020"])
-    df_F_2020 = df_F_2020.rename(columns={"Age Group": "Age", 
-                                "Females 2020": "Total"})
-    df_F_2020 = rename_age_column(df_F_2020, age_conversion_eu)
-    assert (df_F_2020["Total"]>0).all(), "Found zero or negative population values"
-    df_Tot_2021 = pd.read_csv(Eurostat_Pop, sep=";", usecols=["Age Group", "Total 2021"])
-    df_Tot_2021 = df_Tot_2021.rename(columns={"Age Group": "Age", 
-                                "Total 2021": "Total"})
-    df_Tot_2021 = rename_age_column(df_Tot_2021, age_conversion_eu)
-    assert (df_Tot_2021["Total"]>0).all(), "Found zero or negative population values"
-    df_M_2021 = pd.read_csv(Eurostat_Pop, sep=";", usecols=["Age Group", "Males 2021"])
-    df_M_2021 = df_M_2021.rename(columns={"Age Group": "Age", 
-                                "Males 2021": "Total"})
-    df_M_2021 = rename_age_column(df_M_2021, age_conversion_eu)
-    assert (df_M_2021["Total"]>0).all(), "Found zero or negative population values"
-    df_F_2021 = pd.read_csv(Eurostat_Pop, sep=";", usecols=["Age Group", "Females 2021"])
-    df_F_2021 = df_F_2021.rename(columns={"Age Group": "Age", 
-                                "Females 2021": "Total"})
-    df_F_2021 = rename_age_column(df_F_2021, age_conversion_eu)
-    assert (df_F_2021["Total"]>0).all(), "Found zero or negative population values"
-    df_Tot_2022 = pd.read_csv(Eurostat_Pop, sep=";", usecols=["Age Group", "Total 2022"])
-    df_Tot_2022 = df_Tot_2022.rename(columns={"Age Group": "Age", 
-                                "Total 2022": "Total"})
-    df_Tot_2022 = rename_age_column(df_Tot_2022, age_conversion_eu)
-    assert (df_Tot_2022["Total"]>0).all(), "Found zero or negative population values"
-    df_M_2022 = pd.read_csv(Eurostat_Pop, sep=";", usecols=["Age Group", "Males 2022"])
-    df_M_2022 = df_M_2022.rename(columns={"Age Group": "Age", 
-                                "Males 2022": "Total"})
-    df_M_2022 = rename_age_column(df_M_2022, age_conversion_eu)
-    assert (df_M_2022["Total"]>0).all(), "Found zero or negative population values"
-    df_F_2022 = pd.read_csv(Eurostat_Pop, sep=";", usecols=["Age Group", "Females 2022"])
-    df_F_2022 = df_F_2022.rename(columns={"Age Group": "Age", 
-                                "Females 2022": "Total"})
-    df_F_2022 = rename_age_column(df_F_2022, age_conversion_eu)
-    assert (df_F_2022["Total"]>0).all(), "Found zero or negative population values"
-    return df_Tot_2020, df_Tot_2021, df_Tot_2022, df_M_2020, df_M_2021, df_M_2022, df_F_2020, df_F_2021, df_F_2022
+    df = load_data_Eurostat_Pop_long(Eurostat_Pop)
+    return tuple(population_view(df, year, sex) for sex in ["Tot", "M", "F"] for year in [2020, 2021, 2022])